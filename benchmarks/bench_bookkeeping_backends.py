@@ -0,0 +1,61 @@
+"""Selenium vs direct HTTP invoice registration against a local stand-in
+
+    python -m benchmarks.bench_bookkeeping_backends
+
+The Selenium backends only run when SELENIUM_WEBDRIVER is set, their
+browser must be able to reach the stand-in on localhost. selenium-fast
+fills the form in a single script, SELENIUM_FAST_FILL.
+"""
+import os
+import time
+from dataclasses import replace
+from functools import partial
+from typing import Any, Callable
+
+from ltd_invoice.bookkepping_http import HttpBookkeper
+from ltd_invoice.pdf_parse import Invoice
+from ltd_invoice.settings import get_settings
+from tests.conftest import ENVIRONMENT
+from tests.fakes import INVOICE_FIELDS, FakeBookkeepingServer
+
+INVOICES = 50
+# round trip to the platform
+LATENCY = 0.02
+
+
+def run(factory: Callable[..., Any], server: FakeBookkeepingServer) -> float:
+    settings = replace(get_settings(), bookkepping_platform_url=server.url)
+    invoice = Invoice.from_fields(b"", INVOICE_FIELDS, settings)
+    start = time.perf_counter()
+    bookkeper = factory(settings=settings)
+    for _ in range(INVOICES):
+        bookkeper.register_invoice(invoice)
+    elapsed = time.perf_counter() - start
+    bookkeper.close()
+    return elapsed
+
+
+def main() -> None:
+    selenium_webdriver = os.environ.get("SELENIUM_WEBDRIVER")
+    os.environ.update(ENVIRONMENT)
+    backends = {"http": HttpBookkeper}
+    if selenium_webdriver:
+        os.environ["SELENIUM_WEBDRIVER"] = selenium_webdriver
+        from ltd_invoice.bookkepping import Bookkeper
+
+        backends["selenium"] = partial(Bookkeper, fast_fill=False)
+        backends["selenium-fast"] = partial(Bookkeper, fast_fill=True)
+
+    print(f"{INVOICES} invoices, {LATENCY * 1e3:.0f}ms per request")
+    for name, factory in backends.items():
+        with FakeBookkeepingServer(latency=LATENCY) as server:
+            elapsed = run(factory, server)
+            assert len(server.invoices) == INVOICES
+        print(
+            f"{name:<14}{elapsed:8.2f}s total "
+            f"{elapsed / INVOICES * 1e3:8.1f}ms per invoice"
+        )
+
+
+if __name__ == "__main__":
+    main()
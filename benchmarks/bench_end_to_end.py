@@ -0,0 +1,150 @@
+"""process_invoices end to end, offline, across backlog sizes
+
+    python -m benchmarks.bench_end_to_end [SIZE ...]
+
+Gmail is a FakeGmailResource serving generated self bill pdfs, the
+bookkeeping platform the local stand-in, registered through the http
+backend. The Celery chains run eagerly, in process. Every size runs in
+a process of its own, so its peak RSS isn't the one of a previous size.
+Latencies per stage come from the stage histograms of ltd_invoice.metrics.
+"""
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from typing import Dict, List, Sequence
+
+from prometheus_client import REGISTRY
+
+from ltd_invoice.metrics import STAGES
+from tests.conftest import ENVIRONMENT
+from tests.fakes import (
+    FakeBookkeepingServer,
+    FakeGmailResource,
+    make_invoice_pdf,
+    make_raw_message,
+)
+
+BACKLOG_SIZES = (10, 100, 1000)
+# round trip to each service
+GMAIL_LATENCY = 0.005
+BOOKKEEPING_LATENCY = 0.005
+
+
+def make_backlog(size: int) -> tuple:
+    raw_messages = [
+        make_raw_message(
+            f"msg-{number}",
+            date=f"Tue, {1 + number % 28} Mar 2022 11:53:45 +0000 (GMT)",
+            history_id=str(1000 + number),
+        )
+        for number in range(size)
+    ]
+    attachments = {
+        f"attachment-msg-{number}": make_invoice_pdf(
+            invoice_number=f"SB-{number:06}"
+        )
+        for number in range(size)
+    }
+    return raw_messages, attachments
+
+
+def run(size: int) -> Dict[str, float]:
+    """Process a backlog of size emails, in a fresh process"""
+    raw_messages, attachments = make_backlog(size)
+    with tempfile.TemporaryDirectory() as workdir, FakeBookkeepingServer(
+        latency=BOOKKEEPING_LATENCY
+    ) as server:
+        os.chdir(workdir)
+        os.environ.update(
+            ENVIRONMENT,
+            INVOICE_DIR=workdir,
+            BOOKKEPPING_BACKEND="http",
+            BOOKKEPPING_PLATFORM_URL=server.url,
+        )
+        # the broker set by tests.conftest, celery reads it when imported
+        from ltd_invoice import tasks
+        from ltd_invoice.celeryapp import app
+        from ltd_invoice.gmail import GmailService
+
+        app.conf.task_always_eager = True
+        gmail = GmailService(
+            service=FakeGmailResource(
+                raw_messages, attachments, latency=GMAIL_LATENCY
+            )
+        )
+        tasks.get_gmail_service = lambda: gmail  # type: ignore
+
+        start = time.perf_counter()
+        tasks.process_invoices()
+        elapsed = time.perf_counter() - start
+        assert len(server.invoices) == size
+        tasks.get_session_pool().close()
+
+    result = {
+        "elapsed": elapsed,
+        # KiB on Linux
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        * 2**10,
+    }
+    for stage in STAGES:
+        labels = {"stage": stage}
+        count = REGISTRY.get_sample_value(
+            "ltd_invoice_stage_seconds_count", labels
+        )
+        if count:
+            result[stage] = (
+                REGISTRY.get_sample_value(
+                    "ltd_invoice_stage_seconds_sum", labels
+                )
+                / count
+            )
+    return result
+
+
+def main(sizes: Sequence[int]) -> None:
+    context = multiprocessing.get_context("spawn")
+    results: List[Dict[str, float]] = []
+    for size in sizes:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(run, (size,)))
+
+    print(
+        f"{GMAIL_LATENCY * 1e3:.0f}ms per Gmail request, "
+        f"{BOOKKEEPING_LATENCY * 1e3:.0f}ms per bookkeeping request"
+    )
+    print(f"{'emails':<24}" + "".join(f"{size:>10}" for size in sizes))
+    print(
+        f"{'total':<24}"
+        + "".join(f"{result['elapsed']:>9.2f}s" for result in results)
+    )
+    print(
+        f"{'emails/s':<24}"
+        + "".join(
+            f"{size / result['elapsed']:>10.1f}"
+            for size, result in zip(sizes, results)
+        )
+    )
+    print(
+        f"{'peak RSS':<24}"
+        + "".join(
+            f"{result['peak_rss'] / 2**20:>7.1f}MiB" for result in results
+        )
+    )
+    print("mean latency per stage")
+    for stage in STAGES:
+        print(
+            f"  {stage:<22}"
+            + "".join(
+                f"{result[stage] * 1e3:>8.1f}ms"
+                if stage in result
+                else f"{'-':>10}"
+                for result in results
+            )
+        )
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or BACKLOG_SIZES)
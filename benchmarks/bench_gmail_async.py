@@ -0,0 +1,68 @@
+"""Wall time of GmailService vs AsyncGmailService against the REST stand-in
+
+    python -m benchmarks.bench_gmail_async
+
+The stand-in doesn't serve batch requests, GmailService runs with one
+request per round trip, its default.
+"""
+import os
+import time
+from typing import Any
+
+import httplib2
+from googleapiclient.discovery import build
+
+from ltd_invoice.gmail import GmailService
+from ltd_invoice.gmail_async import AsyncGmailService
+from tests.conftest import ENVIRONMENT
+from tests.fake_gmail_api import FakeGmailApi
+from tests.fakes import make_raw_message
+
+BACKLOG_SIZES = (10, 50, 200)
+# round trip to the Gmail API
+LATENCY = 0.02
+CONCURRENCY = 10
+
+
+def run(gmail: Any, messages: int) -> float:
+    start = time.perf_counter()
+    emails = list(gmail.get_emails(None))
+    elapsed = time.perf_counter() - start
+    assert len(emails) == messages
+    return elapsed
+
+
+def main() -> None:
+    os.environ.update(ENVIRONMENT)
+    print(
+        f"{LATENCY * 1e3:.0f}ms per request, "
+        f"async concurrency {CONCURRENCY}"
+    )
+    print(f"{'emails':>8}{'sync':>10}{'async':>10}{'speedup':>10}")
+    for size in BACKLOG_SIZES:
+        raw_messages = [
+            make_raw_message(f"msg-{number}") for number in range(size)
+        ]
+        with FakeGmailApi(raw_messages, latency=LATENCY) as api:
+            service = build(
+                "gmail",
+                "v1",
+                http=httplib2.Http(),
+                static_discovery=True,
+                client_options={"api_endpoint": api.url[: -len("gmail/v1/")]},
+            )
+            sync_elapsed = run(GmailService(service=service), size)
+            async_elapsed = run(
+                AsyncGmailService(
+                    token="token", base_url=api.url, concurrency=CONCURRENCY
+                ),
+                size,
+            )
+        print(
+            f"{size:>8}{sync_elapsed:>9.2f}s{async_elapsed:>9.2f}s"
+            f"{sync_elapsed / async_elapsed:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""GmailService.build startup, cold process vs warm
+
+    python -m benchmarks.bench_gmail_startup
+
+Runs offline in a temporary directory with a token.json that doesn't
+need refreshing. cold is the first build in a new interpreter, what
+every new Celery task process pays on top of importing ltd_invoice.gmail
+(import). warm rebuilds it in a process that has built it before,
+cached is the lru_cache hit.
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from statistics import median
+from typing import Tuple
+
+from ltd_invoice.gmail import GmailService
+from tests.conftest import ENVIRONMENT
+
+RUNS = 5
+
+COLD_START = """
+import time
+start = time.perf_counter()
+from ltd_invoice.gmail import GmailService
+imported = time.perf_counter()
+GmailService.build()
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+def write_token(directory: str) -> None:
+    expiry = datetime.utcnow() + timedelta(hours=1)
+    with open(os.path.join(directory, "token.json"), "w") as f:
+        f.write(
+            json.dumps(
+                {
+                    "token": "token",
+                    "refresh_token": "refresh",
+                    "client_id": "client",
+                    "client_secret": "secret",
+                    "expiry": expiry.isoformat() + "Z",
+                }
+            )
+        )
+
+
+def cold(directory: str) -> Tuple[float, float]:
+    output = subprocess.run(
+        [sys.executable, "-c", COLD_START],
+        cwd=directory,
+        env={**os.environ, "PYTHONPATH": os.getcwd()},
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    import_time, build_time = map(float, output.split())
+    return import_time, build_time
+
+
+def warm() -> float:
+    GmailService.build.cache_clear()
+    start = time.perf_counter()
+    GmailService.build()
+    return time.perf_counter() - start
+
+
+def cached() -> float:
+    start = time.perf_counter()
+    GmailService.build()
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    os.environ.update(ENVIRONMENT)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        write_token(directory)
+        import_timings, cold_timings = zip(
+            *(cold(directory) for _ in range(RUNS))
+        )
+        os.chdir(directory)
+        try:
+            warm_timings = [warm() for _ in range(RUNS)]
+            cached_timings = [cached() for _ in range(RUNS)]
+        finally:
+            os.chdir(cwd)
+
+    print(f"median of {RUNS} runs")
+    for name, timings in (
+        ("import", import_timings),
+        ("cold", cold_timings),
+        ("warm", warm_timings),
+        ("cached", cached_timings),
+    ):
+        print(f"{name:<8}{median(timings) * 1e3:10.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Memory of a 10k invoice batch, slotted typed vs the former dataclasses
+
+    python -m benchmarks.bench_invoice_memory
+
+Every invoice has its own pdf. The former Invoice also kept its internal
+note once it had been rendered for the bookkeeping form. pickled is
+what parse_invoices workers used to send back per invoice, pdf included,
+and what they send now, only the fields.
+"""
+import os
+import pickle
+import tracemalloc
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import cached_property
+from typing import Callable, Dict, List, Optional
+
+from ltd_invoice.gmail import EmailMessage
+from ltd_invoice.pdf_parse import Invoice
+from ltd_invoice.settings import get_settings
+from tests.conftest import ENVIRONMENT
+from tests.fakes import INVOICE_FIELDS
+
+BATCH_SIZE = 10_000
+PDF_SIZE = 20 * 2**10
+
+
+@dataclass(frozen=True)
+class LegacyEmailMessage:
+    id: str
+    thread_id: str
+    subject: str
+    body: str = field(repr=False)
+    attachment: bytes = field(repr=False)
+    sender: str
+    receiver: str
+    date: datetime
+    history_id: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class LegacyInvoice:
+    """Fields kept as strings, the dates already formatted"""
+
+    raw_pdf: bytes = field(repr=False)
+    client_name: str
+    gross_value: str
+    hour_rate: str
+    hours_worked: str
+    invoice_date: str
+    invoice_number: str
+    net_value: str
+    payment_due_date: str
+    timesheet_id: str
+    vat_rate: str
+    vat_value: str
+
+    @cached_property
+    def internal_note(self) -> str:
+        return (
+            str(self)
+            .replace("LegacyInvoice(", "")
+            .replace(",", "\n")
+            .replace("'", "")
+            .replace(")", "")
+            .replace(" ", "")
+            .replace("_", " ")
+            .replace("=", " = ")
+            .title()
+        )
+
+
+def fields(number: int) -> Dict[str, str]:
+    """New strings for every invoice, like the ones matched in each pdf"""
+    return {
+        **{name: f"{value} "[:-1] for name, value in INVOICE_FIELDS.items()},
+        "invoice_number": f"SB-{number:06}",
+    }
+
+
+def email_fields(number: int, attachment: bytes) -> dict:
+    return dict(
+        id=f"msg-{number}",
+        thread_id=f"thread-{number}",
+        subject="Invoice",
+        body="",
+        attachment=attachment,
+        sender="invoices@agency.com",
+        receiver="myself@gmail.com",
+        date=datetime(2022, 3, 8, 11, 53, 45),
+        history_id=str(1000 + number),
+    )
+
+
+def legacy_date(value: str) -> str:
+    settings = get_settings()
+    return datetime.strptime(value, settings.pdf_invoice_date_format).strftime(
+        settings.bookkepping_date_format
+    )
+
+
+def legacy_batch(pdfs: List[bytes]) -> list:
+    batch = []
+    for number, pdf in enumerate(pdfs):
+        invoice_fields = fields(number)
+        # what the former __post_init__ formatted them into
+        invoice_fields.update(
+            hours_worked=str(
+                float(invoice_fields["hours_worked"].replace(":", "."))
+            ),
+            vat_rate=str(int(float(invoice_fields["vat_rate"]))),
+            invoice_date=legacy_date(invoice_fields["invoice_date"]),
+            payment_due_date=legacy_date(invoice_fields["payment_due_date"]),
+        )
+        invoice = LegacyInvoice(raw_pdf=pdf, **invoice_fields)
+        invoice.internal_note
+        batch.append(
+            (LegacyEmailMessage(**email_fields(number, pdf)), invoice)
+        )
+    return batch
+
+
+def batch(pdfs: List[bytes]) -> list:
+    settings = get_settings()
+    return [
+        (
+            EmailMessage(**email_fields(number, pdf)),
+            Invoice.from_fields(pdf, fields(number), settings),
+        )
+        for number, pdf in enumerate(pdfs)
+    ]
+
+
+def measure(build: Callable[[List[bytes]], list], pdfs: List[bytes]) -> int:
+    tracemalloc.start()
+    built = build(pdfs)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del built
+    return size
+
+
+def main() -> None:
+    os.environ.update(ENVIRONMENT)
+    pdfs = [os.urandom(PDF_SIZE) for _ in range(BATCH_SIZE)]
+    pdfs_size = sum(map(len, pdfs))
+
+    print(f"{BATCH_SIZE} emails and invoices, {PDF_SIZE // 2**10}KiB pdfs")
+    for name, build in (("legacy", legacy_batch), ("slotted", batch)):
+        size = measure(build, pdfs)
+        print(
+            f"{name:<9}{size / 2**20:8.2f}MiB "
+            f"{size / BATCH_SIZE:8.0f}B per email and invoice"
+        )
+
+    _, legacy_invoice = legacy_batch(pdfs[:1])[0]
+    print(
+        f"pickled  {len(pickle.dumps(legacy_invoice)):8}B legacy invoice, "
+        f"{len(pickle.dumps(fields(0))):8}B fields"
+    )
+    print(f"pdfs     {pdfs_size / 2**20:8.2f}MiB shared by both, not counted")
+
+
+if __name__ == "__main__":
+    main()
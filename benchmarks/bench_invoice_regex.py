@@ -0,0 +1,66 @@
+"""findall per field vs precompiled search over invoice texts
+
+    python -m benchmarks.bench_invoice_regex
+"""
+import re
+import time
+from typing import Callable, Dict, List, Optional
+
+from ltd_invoice.pdf_parse import Invoice, match_invoice_fields
+from tests.fakes import make_invoice_lines
+
+TEXTS = 5_000
+TERMS = "\n\n".join(
+    f"Term {number}: the agency may amend this self bill at any time."
+    for number in range(40)
+)
+
+
+def findall_fields(pdf_text: str) -> Dict[str, Optional[str]]:
+    """How extract_invoice used to match the fields"""
+    return {
+        field_name: re.findall(regex_pattern, pdf_text, flags=re.DOTALL)[0]
+        for field_name, regex_pattern in Invoice.REGEX_MAPPING.items()
+    }
+
+
+def make_texts() -> List[str]:
+    return [
+        "\n\n".join(
+            make_invoice_lines(
+                invoice_number=f"SB-{number:06}",
+                timesheet_id=f"TS_{number:06}",
+                hours_worked=f"{number % 40}:{number % 60:02}",
+            )
+        )
+        + "\n\n\x0c"
+        + TERMS
+        for number in range(TEXTS)
+    ]
+
+
+def run(
+    texts: List[str], match: Callable[[str], Dict[str, Optional[str]]]
+) -> float:
+    start = time.perf_counter()
+    for text in texts:
+        match(text)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    texts = make_texts()
+    assert all(
+        findall_fields(text) == match_invoice_fields(text) for text in texts
+    )
+
+    findall_time = run(texts, findall_fields)
+    search_time = run(texts, match_invoice_fields)
+    print(f"{TEXTS} invoice texts")
+    print(f"findall  {findall_time / TEXTS * 1e6:8.1f}us per invoice")
+    print(f"compiled {search_time / TEXTS * 1e6:8.1f}us per invoice")
+    print(f"speedup  {findall_time / search_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
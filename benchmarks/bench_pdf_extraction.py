@@ -0,0 +1,52 @@
+"""Full vs fast (first page, layout-lite) invoice extraction
+
+    python -m benchmarks.bench_pdf_extraction
+"""
+import os
+import time
+from typing import Callable, List
+
+from ltd_invoice.pdf_parse import Invoice, extract_invoice
+from tests.conftest import ENVIRONMENT
+from tests.fakes import make_invoice_pdf
+
+CORPUS_SIZE = 50
+
+
+def make_corpus() -> List[bytes]:
+    return [
+        make_invoice_pdf(
+            extra_pages=number % 5,
+            invoice_number=f"SB-{number:06}",
+            timesheet_id=f"TS_{number:06}",
+            hour_rate=f"{20 + number % 10}.50",
+        )
+        for number in range(CORPUS_SIZE)
+    ]
+
+
+def run(corpus: List[bytes], extract: Callable[[bytes], Invoice]) -> float:
+    start = time.perf_counter()
+    for attachment in corpus:
+        extract(attachment)
+    return (time.perf_counter() - start) / len(corpus)
+
+
+def main() -> None:
+    os.environ.update(ENVIRONMENT)
+    corpus = make_corpus()
+
+    full = [extract_invoice(attachment, fast=False) for attachment in corpus]
+    fast = [extract_invoice(attachment, fast=True) for attachment in corpus]
+    assert full == fast, "fast extraction returned different invoices"
+
+    full_time = run(corpus, lambda pdf: extract_invoice(pdf, fast=False))
+    fast_time = run(corpus, lambda pdf: extract_invoice(pdf, fast=True))
+    print(f"{CORPUS_SIZE} invoices, 1 to 5 pages each")
+    print(f"full {full_time * 1e3:8.2f}ms per invoice")
+    print(f"fast {fast_time * 1e3:8.2f}ms per invoice")
+    print(f"speedup {full_time / fast_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Per-update cost of the processed email store as history grows
+
+    python -m benchmarks.bench_processed_store
+"""
+import json
+import os
+import tempfile
+import time
+from typing import Callable, List
+
+from ltd_invoice.processed_store import (
+    LEGACY_PROCESSED_EMAILS_FILE,
+    PROCESSED_EMAIL_STORES,
+)
+
+HISTORY_SIZES = (1_000, 10_000, 100_000)
+UPDATES = 200
+
+
+class LegacyStore:
+    """The JSON list Tracker used to rewrite on every update"""
+
+    def __init__(self) -> None:
+        with open(LEGACY_PROCESSED_EMAILS_FILE, "r+") as f:
+            self.processed_emails: List[str] = list(set(json.loads(f.read())))
+
+    def __contains__(self, email_id: str) -> bool:
+        return email_id in self.processed_emails
+
+    def add(self, email_id: str) -> None:
+        self.processed_emails.append(email_id)
+        with open(LEGACY_PROCESSED_EMAILS_FILE, "w+") as f:
+            f.write(json.dumps(list(set(self.processed_emails)), indent=4))
+
+
+def time_updates(
+    store_factory: Callable[[], object], history_size: int
+) -> float:
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        with open(LEGACY_PROCESSED_EMAILS_FILE, "w") as f:
+            f.write(json.dumps([f"id-{i}" for i in range(history_size)]))
+        store = store_factory()
+
+        start = time.perf_counter()
+        for i in range(UPDATES):
+            email_id = f"new-{i}"
+            if email_id not in store:  # type: ignore[operator]
+                store.add(email_id)  # type: ignore[attr-defined]
+        return (time.perf_counter() - start) / UPDATES
+
+
+def main() -> None:
+    cwd = os.getcwd()
+    stores = {"legacy json": LegacyStore}
+    stores.update(
+        {
+            name: (lambda store=store, path=path: store(path))
+            for name, (store, path) in PROCESSED_EMAIL_STORES.items()
+        }
+    )
+    try:
+        print(f"{'store':<12}" + "".join(f"{n:>14,}" for n in HISTORY_SIZES))
+        for name, factory in stores.items():
+            timings = [time_updates(factory, n) for n in HISTORY_SIZES]
+            print(
+                f"{name:<12}" + "".join(f"{t * 1e6:>12.1f}us" for t in timings)
+            )
+    finally:
+        os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
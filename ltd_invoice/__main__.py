@@ -1,14 +1,34 @@
-import logging
+"""python -m ltd_invoice [run]
 
-from ltd_invoice.bookkepping import Bookkeper
-from ltd_invoice.gmail import GmailService
-from ltd_invoice.pdf_parse import extract_invoice
-from ltd_invoice.tasks import process_invoices
-from ltd_invoice.tracker import Tracker
+run processes every new email in this process, without Celery. Modules
+are imported by the command using them, a stage's dependencies load
+when it runs.
+"""
+import argparse
+from typing import List, Optional
 
 
-def main() -> None:
-    process_invoices()
+def run(args: argparse.Namespace) -> None:
+    from ltd_invoice.pipeline import process_emails
+    from ltd_invoice.session_pool import close_sessions
+
+    try:
+        process_emails()
+    finally:
+        # a grid session left open outlives the process until it times out
+        close_sessions()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m ltd_invoice")
+    parser.set_defaults(command=run)
+    commands = parser.add_subparsers(title="commands")
+    commands.add_parser(
+        "run", help="process the new emails, without Celery"
+    ).set_defaults(command=run)
+
+    args = parser.parse_args(argv)
+    args.command(args)
 
 
 if __name__ == "__main__":
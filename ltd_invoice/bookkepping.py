@@ -1,41 +1,162 @@
 import logging
-import os
 import urllib.parse
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
 from selenium import webdriver
+from selenium.common.exceptions import (
+    InvalidElementStateException,
+    NoSuchElementException,
+    WebDriverException,
+)
+from selenium.webdriver.common.by import By
 from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
-from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.remote.webdriver import WebDriver
+from selenium.webdriver.remote.webelement import WebElement
+from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import Select
+from selenium.webdriver.support.wait import WebDriverWait
 
 from ltd_invoice.pdf_parse import Invoice
+from ltd_invoice.settings import Settings, get_settings
+from ltd_invoice.submissions import SubmissionStateUnknown
+from ltd_invoice.timing import StepTimings
 
+# Dropdowns of the invoice form, filled by the text of one of their options
+FORM_DROPDOWNS = ("client", "Service", "Type", "Vat")
 
-class Bookkeper:
-    def __init__(self) -> None:
+# Option text -> value of every dropdown
+FORM_OPTIONS_SCRIPT = """
+const options = {};
+for (const id of arguments[0]) {
+  const select = document.getElementById(id);
+  if (select) {
+    options[id] = Object.fromEntries(
+      Array.from(select.options, (option) => [option.text.trim(), option.value])
+    );
+  }
+}
+return options;
+"""
+
+# Set every field through the value setter of its prototype, like typing
+# does, so the page's listeners see the input and change events. Returns
+# the ids of the fields missing from the page.
+FILL_FORM_SCRIPT = """
+const missing = [];
+for (const [id, value] of Object.entries(arguments[0])) {
+  const element = document.getElementById(id);
+  if (!element) {
+    missing.push(id);
+    continue;
+  }
+  element.removeAttribute("readonly");
+  const setter = Object.getOwnPropertyDescriptor(
+    Object.getPrototypeOf(element), "value"
+  )?.set;
+  if (setter) {
+    setter.call(element, value);
+  } else {
+    element.value = value;
+  }
+  element.dispatchEvent(new Event("input", { bubbles: true }));
+  element.dispatchEvent(new Event("change", { bubbles: true }));
+}
+return missing;
+"""
+
+READ_FORM_SCRIPT = """
+const values = {};
+for (const id of arguments[0]) {
+  const element = document.getElementById(id);
+  values[id] = element ? element.value : null;
+}
+return values;
+"""
+
+
+class Bookkeper(StepTimings):
+    INVOICE_PAGE = "/salesinvoice/show"
+
+    def __init__(
+        self,
+        driver: Optional[WebDriver] = None,
+        settings: Optional[Settings] = None,
+        fast_fill: Optional[bool] = None,
+    ) -> None:
         logging.info("Creating Bookkeper")
+        self.settings = settings or get_settings()
+        if fast_fill is None:
+            fast_fill = self.settings.selenium_fast_fill
+        self.fast_fill = fast_fill
+        # option text -> value of the form dropdowns, kept for the session
+        self._form_options: Optional[Dict[str, Dict[str, str]]] = None
         self._is_logged = False
-        self.driver = self.get_webdriver()
+        self.driver = driver or self.get_webdriver(self.settings)
+        self.wait = WebDriverWait(
+            self.driver,
+            timeout=self.settings.selenium_wait_timeout,
+        )
+        self.timings = {}
         logging.info("Selenium window size %s", self.driver.get_window_size())
         self.driver.maximize_window()
-        self.base_url = os.environ["BOOKKEPPING_PLATFORM_URL"]
+        self.base_url = self.settings.bookkepping_platform_url
         self.driver.get(self.base_url)
         logging.info("Bookkeper created!")
 
     def __del__(self):
         try:
             self.driver.close()
-        except AttributeError:
+        except (AttributeError, WebDriverException):
             # can't close a driver that's not there
             pass
 
+    def close(self) -> None:
+        """End the browser session"""
+        try:
+            self.driver.quit()
+        except WebDriverException:
+            # the session is already gone
+            pass
+
+    def is_alive(self) -> bool:
+        try:
+            self.driver.current_url
+        except WebDriverException:
+            return False
+        return True
+
+    def login_required(self) -> bool:
+        return bool(self.driver.find_elements(By.NAME, "UserName"))
+
+    def find(
+        self,
+        locator: Tuple[str, str],
+        condition: Callable[
+            [Tuple[str, str]], Callable[[Any], Any]
+        ] = EC.presence_of_element_located,
+    ) -> WebElement:
+        """Wait for the element to meet the condition, then return it"""
+        element: WebElement = self.wait.until(condition(locator))
+        return element
+
     @staticmethod
-    def get_webdriver() -> WebDriver:
-        selenium_webdriver = os.environ["SELENIUM_WEBDRIVER"]
+    def get_webdriver(settings: Settings) -> WebDriver:
+        selenium_webdriver = settings.selenium_webdriver
 
         if selenium_webdriver == "hub":
             return webdriver.Remote(
-                command_executor=os.environ["SELENIUM_HUB"],
+                command_executor=settings.selenium_hub,
                 desired_capabilities=DesiredCapabilities.FIREFOX,
             )
         elif selenium_webdriver == "local":
@@ -46,19 +167,33 @@ class Bookkeper:
             )
 
     def login(self) -> None:
-        user = os.environ["BOOKKEPPING_PLATFORM_USER"]
-        password = os.environ["BOOKKEPPING_PLATFORM_PASS"]
-        self.driver.find_element_by_name("UserName").send_keys(user)
-        self.driver.find_element_by_name("UserPassword").send_keys(password)
-        self.driver.find_element_by_id(
-            "kt_login_singin_form_submit_button"
-        ).click()
+        with self.step("login"):
+            user = self.settings.bookkepping_platform_user
+            password = self.settings.bookkepping_platform_pass
+            self.find((By.NAME, "UserName")).send_keys(user)
+            self.find((By.NAME, "UserPassword")).send_keys(password)
+            self.find(
+                (By.ID, "kt_login_singin_form_submit_button"),
+                EC.element_to_be_clickable,
+            ).click()
+            self.wait.until(
+                EC.invisibility_of_element_located((By.NAME, "UserName"))
+            )
         self._is_logged = True
 
     def open_invoice_page(self) -> None:
-        self.driver.get(
-            urllib.parse.urljoin(self.base_url, "/salesinvoice/show")
+        invoice_page_url = urllib.parse.urljoin(
+            self.base_url, self.INVOICE_PAGE
         )
+        with self.step("page_load"):
+            self.driver.get(invoice_page_url)
+
+        # long lived sessions get logged out by the platform
+        if self.login_required():
+            logging.info("Bookkeeping session expired, logging in again")
+            self.login()
+            with self.step("page_load"):
+                self.driver.get(invoice_page_url)
 
     def fill_client_data(
         self,
@@ -67,25 +202,27 @@ class Bookkeper:
         invoice_date: str,
         due_date: str,
     ) -> None:
-        client_dropdown = Select(self.driver.find_element_by_id("client"))
-        client_dropdown.select_by_visible_text(client_name)
+        with self.step("client_fill"):
+            client_dropdown = Select(
+                self.find((By.ID, "client"), EC.element_to_be_clickable)
+            )
+            client_dropdown.select_by_visible_text(client_name)
 
-        self.driver.find_element_by_id("INVOICE_NOTE").send_keys(
-            invoice_details
-        )
+            self.find((By.ID, "INVOICE_NOTE")).send_keys(invoice_details)
 
-        invoice_date_elem = self.driver.find_element_by_id("INVOICE_DATE")
-        self.driver.execute_script(
-            "arguments[0].removeAttribute('readonly','readonly')",
-            invoice_date_elem,
-        )
-        invoice_date_elem.send_keys(invoice_date)
+            invoice_date_elem = self.find((By.ID, "INVOICE_DATE"))
+            self.driver.execute_script(
+                "arguments[0].removeAttribute('readonly','readonly')",
+                invoice_date_elem,
+            )
+            invoice_date_elem.send_keys(invoice_date)
 
-        due_on_elem = self.driver.find_element_by_id("INVOICE_DUE_ON")
-        self.driver.execute_script(
-            "arguments[0].removeAttribute('readonly','readonly')", due_on_elem
-        )
-        due_on_elem.send_keys(due_date)
+            due_on_elem = self.find((By.ID, "INVOICE_DUE_ON"))
+            self.driver.execute_script(
+                "arguments[0].removeAttribute('readonly','readonly')",
+                due_on_elem,
+            )
+            due_on_elem.send_keys(due_date)
 
     def fill_service_data(
         self,
@@ -96,70 +233,220 @@ class Bookkeper:
         rate_value: str,
         vat_percent: str,
     ) -> None:
-        service_type_dropdown = Select(
-            self.driver.find_element_by_id("Service")
-        )
-        service_type_dropdown.select_by_visible_text(service_type)
+        with self.step("service_fill"):
+            service_type_dropdown = Select(
+                self.find((By.ID, "Service"), EC.element_to_be_clickable)
+            )
+            service_type_dropdown.select_by_visible_text(service_type)
 
-        rate_type_dropdown = Select(self.driver.find_element_by_id("Type"))
-        rate_type_dropdown.select_by_visible_text(rate_type)
+            rate_type_dropdown = Select(
+                self.find((By.ID, "Type"), EC.element_to_be_clickable)
+            )
+            rate_type_dropdown.select_by_visible_text(rate_type)
 
-        rate_type_dropdown = Select(self.driver.find_element_by_id("Vat"))
-        rate_type_dropdown.select_by_visible_text(f"{vat_percent}%")
+            vat_dropdown = Select(
+                self.find((By.ID, "Vat"), EC.element_to_be_clickable)
+            )
+            vat_dropdown.select_by_visible_text(f"{vat_percent}%")
 
-        self.driver.find_element_by_id("Workdescription").send_keys(
-            work_description
-        )
-        self.driver.find_element_by_id("Quantity").send_keys(quantity)
-        self.driver.find_element_by_id("Rate").send_keys(rate_value)
+            self.find((By.ID, "Workdescription")).send_keys(work_description)
+            self.find((By.ID, "Quantity")).send_keys(quantity)
+            self.find((By.ID, "Rate")).send_keys(rate_value)
 
     def fill_internal_note(self, text: str) -> None:
-        self.driver.find_element_by_id("CUSTOMER_NOTE").send_keys(text)
+        with self.step("internal_note_fill"):
+            self.find((By.ID, "CUSTOMER_NOTE")).send_keys(text)
 
     def confirm_submit_popup(self) -> None:
-        self.driver.execute_script(
-            "arguments[0].click();", self.driver.find_element_by_id("1")
+        with self.step("popup_confirm"):
+            self.driver.execute_script(
+                "arguments[0].click();", self.find((By.ID, "1"))
+            )
+            self.driver.execute_script(
+                "arguments[0].click();",
+                self.find((By.CLASS_NAME, "swal2-confirm")),
+            )
+            self.wait.until(
+                EC.invisibility_of_element_located(
+                    (By.CLASS_NAME, "swal2-popup")
+                )
+            )
+
+    def submit_invoice(self) -> None:
+        # clicking through javascript doesn't need the button in view, no
+        # zooming out or scrolling to the bottom of the form
+        with self.step("submit"):
+            save_button = self.find(
+                (By.ID, "btnSaveInvoice"), EC.element_to_be_clickable
+            )
+            with self.after_save():
+                self.driver.execute_script(
+                    "arguments[0].click();", save_button
+                )
+        with self.after_save():
+            self.confirm_submit_popup()
+
+    @contextmanager
+    def after_save(self) -> Iterator[None]:
+        """Once save is clicked, a failure can't tell if the invoice was"""
+        try:
+            yield
+        except WebDriverException as e:
+            raise SubmissionStateUnknown(
+                f"Failed after clicking save: {e!r}"
+            ) from e
+
+    def invoice_form_values(self, invoice: Invoice) -> Dict[str, str]:
+        """What the form is filled with, by element id
+
+        Dropdowns come first, changing them may reset other fields.
+        """
+        date_format = self.settings.bookkepping_date_format
+        return {
+            "client": invoice.client_name,
+            "Service": "Timesheet",
+            "Type": "Hours",
+            "Vat": f"{invoice.vat_percent}%",
+            "INVOICE_NOTE": invoice.details,
+            "INVOICE_DATE": invoice.invoice_date.strftime(date_format),
+            "INVOICE_DUE_ON": invoice.payment_due_date.strftime(date_format),
+            "Workdescription": "Week work",
+            "Quantity": invoice.quantity,
+            "Rate": str(invoice.hour_rate),
+            "CUSTOMER_NOTE": invoice.internal_note,
+        }
+
+    def fill_invoice(self, invoice: Invoice) -> None:
+        values = self.invoice_form_values(invoice)
+        if self.fast_fill:
+            self.fill_form(values)
+            return
+
+        self.fill_client_data(
+            client_name=values["client"],
+            invoice_details=values["INVOICE_NOTE"],
+            invoice_date=values["INVOICE_DATE"],
+            due_date=values["INVOICE_DUE_ON"],
         )
-        self.driver.execute_script(
-            "arguments[0].click();",
-            self.driver.find_element_by_class_name("swal2-confirm"),
+        self.fill_service_data(
+            service_type=values["Service"],
+            work_description=values["Workdescription"],
+            rate_type=values["Type"],
+            quantity=values["Quantity"],
+            rate_value=values["Rate"],
+            vat_percent=invoice.vat_percent,
         )
 
-    def submit_invoice(self) -> None:
-        self.driver.execute("SET_CONTEXT", {"context": "chrome"})
-        win = self.driver.find_element_by_tag_name("body")
-        for _ in range(4):
-            win.send_keys(Keys.CONTROL, "-")
+        self.fill_internal_note(values["CUSTOMER_NOTE"])
+
+    def form_options(self, reload: bool = False) -> Dict[str, Dict[str, str]]:
+        if self._form_options is None or reload:
+            with self.step("form_options"):
+                self._form_options = self.driver.execute_script(
+                    FORM_OPTIONS_SCRIPT, list(FORM_DROPDOWNS)
+                )
+        assert self._form_options is not None
+        return self._form_options
+
+    def option_value(self, dropdown: str, text: str) -> str:
+        """Value of the option of a dropdown, by its visible text
 
-        self.driver.execute_script(
-            "window.scrollTo(0, document.body.scrollHeight);"
+        Options are read once per session, and again when one is missing,
+        a client may have been added since.
+        """
+        for reload in (False, True):
+            options = self.form_options(reload).get(dropdown, {})
+            if text in options:
+                return options[text]
+        raise NoSuchElementException(
+            f"Cannot locate option with visible text: {text}"
         )
-        self.driver.execute("SET_CONTEXT", {"context": "content"})
 
-        self.driver.execute_script(
-            "arguments[0].click();",
-            self.driver.find_element_by_id("btnSaveInvoice"),
+    def fill_form(self, values: Dict[str, str]) -> None:
+        """Fill the whole form in one script, then read it back once
+
+        Two round trips to the browser per invoice instead of one for
+        every element found, typed into or selected.
+        """
+        values = {
+            element_id: (
+                self.option_value(element_id, value)
+                if element_id in FORM_DROPDOWNS
+                else value
+            )
+            for element_id, value in values.items()
+        }
+        with self.step("form_fill"):
+            missing: List[str] = self.driver.execute_script(
+                FILL_FORM_SCRIPT, values
+            )
+        if missing:
+            raise NoSuchElementException(
+                f"Invoice form fields not found: {', '.join(missing)}"
+            )
+
+        with self.step("form_check"):
+            filled: Dict[str, Optional[str]] = self.driver.execute_script(
+                READ_FORM_SCRIPT, list(values)
+            )
+        mismatched = [
+            element_id
+            for element_id, value in values.items()
+            if filled.get(element_id) != value
+        ]
+        if mismatched:
+            raise InvalidElementStateException(
+                f"Invoice form fields not filled: {', '.join(mismatched)}"
+            )
+
+    def reset_invoice_form(self) -> bool:
+        """Clear the invoice form if saving left it open
+
+        Returns False when the form is gone and the page must be loaded.
+        """
+        with self.step("form_reset"):
+            if not self.driver.current_url.endswith(self.INVOICE_PAGE):
+                return False
+            return bool(
+                self.driver.execute_script(
+                    "const button = document.getElementById('btnSaveInvoice');"
+                    "if (!button || !button.form) { return false; }"
+                    "button.form.reset();"
+                    "return true;"
+                )
+            )
+
+    def log_registration(self, invoice: Invoice) -> None:
+        logging.info(
+            "Registered invoice %s, %s",
+            invoice.invoice_number,
+            ", ".join(f"{name}={t:.3f}s" for name, t in self.timings.items()),
         )
-        self.confirm_submit_popup()
 
     def register_invoice(self, invoice: Invoice) -> None:
         if not self._is_logged:
             self.login()
         self.open_invoice_page()
-        self.fill_client_data(
-            client_name=invoice.client_name,
-            invoice_details=f"Sheet: {invoice.timesheet_id}\nInvoice number: {invoice.invoice_number}",
-            invoice_date=invoice.invoice_date,
-            due_date=invoice.payment_due_date,
-        )
-        self.fill_service_data(
-            service_type="Timesheet",
-            work_description="Week work",
-            rate_type="Hours",
-            quantity=invoice.hours_worked,
-            rate_value=invoice.hour_rate,
-            vat_percent=invoice.vat_rate,
-        )
-
-        self.fill_internal_note(invoice.internal_note)
+        self.fill_invoice(invoice)
         self.submit_invoice()
+        self.log_registration(invoice)
+
+    def register_invoices(
+        self, invoices: Iterable[Invoice]
+    ) -> Generator[Invoice, None, None]:
+        """Register invoices one after the other on the same form page
+
+        Every invoice is yielded once registered. The page is only loaded
+        again when saving navigates away from the form.
+        """
+        if not self._is_logged:
+            self.login()
+        form_open = False
+        for invoice in invoices:
+            if not form_open:
+                self.open_invoice_page()
+            self.fill_invoice(invoice)
+            self.submit_invoice()
+            self.log_registration(invoice)
+            yield invoice
+            form_open = self.reset_invoice_form()
@@ -0,0 +1,470 @@
+import csv
+import io
+import itertools
+import logging
+import urllib.parse
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ltd_invoice.pdf_parse import Invoice
+from ltd_invoice.settings import Settings, get_settings
+from ltd_invoice.submissions import SubmissionStateUnknown
+from ltd_invoice.timing import StepTimings
+
+
+class BookkeepingHttpError(Exception):
+    pass
+
+
+@dataclass
+class HtmlForm:
+    action: str
+    # name -> value, what the browser would post as is
+    values: Dict[str, str] = field(default_factory=dict)
+    # element id -> name
+    names: Dict[str, str] = field(default_factory=dict)
+    # select name -> option text -> option value
+    options: Dict[str, Dict[str, str]] = field(default_factory=dict)
+    # checkbox or radio id -> value, posted once it's checked
+    checkable: Dict[str, str] = field(default_factory=dict)
+
+    def name_of(self, element_id: str) -> str:
+        try:
+            return self.names[element_id]
+        except KeyError:
+            raise BookkeepingHttpError(f"Form has no {element_id} field")
+
+    def option_value(self, element_id: str, text: str) -> str:
+        try:
+            return self.options[self.name_of(element_id)][text]
+        except KeyError:
+            raise BookkeepingHttpError(
+                f"Form has no {text!r} option for {element_id}"
+            )
+
+    def checked_value(self, element_id: str) -> str:
+        try:
+            return self.checkable[element_id]
+        except KeyError:
+            raise BookkeepingHttpError(f"Form has no {element_id} choice")
+
+
+class FormParser(HTMLParser):
+    """Collect the fields of every form in a page, as a browser posts them"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.forms: List[HtmlForm] = []
+        self._select: Optional[str] = None
+        self._option: Optional[Tuple[str, bool, List[str]]] = None
+        self._textarea: Optional[Tuple[str, List[str]]] = None
+
+    def handle_starttag(
+        self, tag: str, attrs: List[Tuple[str, Optional[str]]]
+    ) -> None:
+        attributes = {name: value or "" for name, value in attrs}
+        if tag == "form":
+            self.forms.append(HtmlForm(action=attributes.get("action", "")))
+            return
+        if not self.forms or tag not in (
+            "input",
+            "select",
+            "textarea",
+            "option",
+        ):
+            return
+
+        form = self.forms[-1]
+        if tag == "option":
+            self._option = (
+                attributes.get("value", ""),
+                "selected" in attributes,
+                [],
+            )
+            return
+
+        name = attributes.get("name")
+        if not name or attributes.get("type") in ("submit", "button"):
+            return
+        if "id" in attributes:
+            form.names[attributes["id"]] = name
+        if tag == "select":
+            self._select = name
+            form.options[name] = {}
+        elif tag == "textarea":
+            self._textarea = (name, [])
+        elif attributes.get("type") in ("checkbox", "radio"):
+            value = attributes.get("value", "on")
+            if "id" in attributes:
+                form.checkable[attributes["id"]] = value
+            # unchecked ones aren't posted, of a group the checked one is
+            if "checked" in attributes:
+                form.values[name] = value
+        else:
+            form.values[name] = attributes.get("value", "")
+
+    def handle_data(self, data: str) -> None:
+        if self._option is not None:
+            self._option[2].append(data)
+        elif self._textarea is not None:
+            self._textarea[1].append(data)
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == "option" and self._option and self._select:
+            form = self.forms[-1]
+            value, selected, text = self._option
+            form.options[self._select]["".join(text).strip()] = value
+            # like the browser, post the selected option or the first one
+            if selected or self._select not in form.values:
+                form.values[self._select] = value
+            self._option = None
+        elif tag == "select":
+            self._select = None
+        elif tag == "textarea" and self._textarea:
+            name, text = self._textarea
+            # browsers drop the newline right after the start tag
+            self.forms[-1].values[name] = "".join(text).removeprefix("\n")
+            self._textarea = None
+
+
+def parse_forms(html: str) -> List[HtmlForm]:
+    parser = FormParser()
+    parser.feed(html)
+    parser.close()
+    return parser.forms
+
+
+class HttpBookkeper(StepTimings):
+    """Register invoices by posting the invoice form, no browser involved
+
+    Login and form discovery failures hand the invoice over to the
+    fallback, the Selenium Bookkeper, when there's one.
+    """
+
+    INVOICE_PAGE = "/salesinvoice/show"
+
+    def __init__(
+        self,
+        session: Optional[requests.Session] = None,
+        fallback: Optional[Callable[[], Any]] = None,
+        settings: Optional[Settings] = None,
+    ) -> None:
+        logging.info("Creating HttpBookkeper")
+        self.settings = settings or get_settings()
+        self.base_url = self.settings.bookkepping_platform_url
+        self.login_url = urllib.parse.urljoin(
+            self.base_url, self.settings.bookkepping_login_path
+        )
+        self.timeout = self.settings.bookkepping_http_timeout
+        self.import_path = self.settings.bookkepping_import_path
+        self.import_batch_size = self.settings.bookkepping_import_batch_size
+        self.session = session or self.build_session()
+        self.fallback = fallback
+        self._fallback_bookkeper: Any = None
+        self._is_logged = False
+        self.timings = {}
+        logging.info("HttpBookkeper created!")
+
+    @staticmethod
+    def build_session() -> requests.Session:
+        session = requests.Session()
+        # keep-alive connections to the platform are reused across invoices
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def is_alive(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        self.session.close()
+        if self._fallback_bookkeper is not None:
+            self._fallback_bookkeper.close()
+
+    @staticmethod
+    def find_form(html: str, field_name: str) -> Optional[HtmlForm]:
+        for form in parse_forms(html):
+            if field_name in form.values:
+                return form
+        return None
+
+    def login(self, login_page: Optional[str] = None) -> None:
+        with self.step("login"):
+            if login_page is None:
+                login_page = self.get(self.login_url).text
+            form = self.find_form(login_page, "UserName")
+            if form is None:
+                raise BookkeepingHttpError("Login form not found")
+
+            response = self.post(
+                urllib.parse.urljoin(self.login_url, form.action),
+                data={
+                    **form.values,
+                    "UserName": self.settings.bookkepping_platform_user,
+                    "UserPassword": self.settings.bookkepping_platform_pass,
+                },
+            )
+            if self.find_form(response.text, "UserName") is not None:
+                raise BookkeepingHttpError("Login failed")
+        self._is_logged = True
+
+    def open_invoice_form(self) -> Tuple[str, HtmlForm]:
+        invoice_page_url = urllib.parse.urljoin(
+            self.base_url, self.INVOICE_PAGE
+        )
+        with self.step("page_load"):
+            page = self.get(invoice_page_url).text
+
+        # long lived sessions get logged out by the platform
+        if self.find_form(page, "UserName") is not None:
+            logging.info("Bookkeeping session expired, logging in again")
+            self.login(login_page=page)
+            with self.step("page_load"):
+                page = self.get(invoice_page_url).text
+
+        form = self.find_invoice_form(page)
+        if form is None:
+            raise BookkeepingHttpError("Invoice form not found")
+        return invoice_page_url, form
+
+    @staticmethod
+    def find_invoice_form(html: str) -> Optional[HtmlForm]:
+        for form in parse_forms(html):
+            if "client" in form.names:
+                return form
+        return None
+
+    def invoice_form(self) -> HtmlForm:
+        """Log in when needed and open the invoice form
+
+        The form action is made absolute so the form can be posted again
+        without the page it came from.
+        """
+        if not self._is_logged:
+            self.login()
+        page_url, form = self.open_invoice_form()
+        form.action = urllib.parse.urljoin(page_url, form.action)
+        return form
+
+    def submit_invoice_form(
+        self, form: HtmlForm, data: Dict[str, str]
+    ) -> requests.Response:
+        with self.step("submit"), self.posting(form.action):
+            return self.post(form.action, data=data)
+
+    @contextmanager
+    def posting(self, url: str) -> Iterator[None]:
+        """Failures of a post that may have reached the platform
+
+        They raise SubmissionStateUnknown, nothing tells whether the
+        invoices were saved.
+        """
+        try:
+            yield
+        except requests.ConnectTimeout:
+            # never connected, nothing was sent
+            raise
+        except requests.HTTPError as e:
+            # a client error is the platform rejecting the form
+            if e.response is not None and e.response.status_code < 500:
+                raise
+            raise SubmissionStateUnknown(f"Posting {url} failed: {e!r}") from e
+        except requests.RequestException as e:
+            raise SubmissionStateUnknown(f"Posting {url} failed: {e!r}") from e
+
+    def is_saved(self, response: requests.Response) -> bool:
+        """Whether the platform confirmed the invoice was saved
+
+        A saved form is redirected away from, a form with errors is sent
+        back as is. With BOOKKEPPING_SAVED_MARKER, the page has to say so.
+        """
+        marker = self.settings.bookkepping_saved_marker
+        if marker is not None:
+            return marker in response.text
+        return bool(response.history)
+
+    def get(self, url: str) -> requests.Response:
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    def post(self, url: str, data: Dict[str, str]) -> requests.Response:
+        response = self.session.post(url, data=data, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    def invoice_form_data(
+        self, form: HtmlForm, invoice: Invoice
+    ) -> Dict[str, str]:
+        return {**form.values, **self.invoice_fields(form, invoice)}
+
+    def invoice_fields(
+        self, form: HtmlForm, invoice: Invoice
+    ) -> Dict[str, str]:
+        """The form fields filled in for the invoice, by field name"""
+        date_format = self.settings.bookkepping_date_format
+        return {
+            form.name_of("client"): form.option_value(
+                "client", invoice.client_name
+            ),
+            form.name_of("INVOICE_NOTE"): invoice.details,
+            form.name_of("INVOICE_DATE"): invoice.invoice_date.strftime(
+                date_format
+            ),
+            form.name_of("INVOICE_DUE_ON"): invoice.payment_due_date.strftime(
+                date_format
+            ),
+            form.name_of("Service"): form.option_value("Service", "Timesheet"),
+            form.name_of("Type"): form.option_value("Type", "Hours"),
+            form.name_of("Vat"): form.option_value(
+                "Vat", f"{invoice.vat_percent}%"
+            ),
+            form.name_of("Workdescription"): "Week work",
+            form.name_of("Quantity"): invoice.quantity,
+            form.name_of("Rate"): str(invoice.hour_rate),
+            form.name_of("CUSTOMER_NOTE"): invoice.internal_note,
+            # the send option Selenium picks in the save popup
+            form.name_of("1"): form.checked_value("1"),
+        }
+
+    def fallback_bookkeper(self) -> Any:
+        if self._fallback_bookkeper is None:
+            assert self.fallback is not None
+            self._fallback_bookkeper = self.fallback()
+        return self._fallback_bookkeper
+
+    def import_invoices(self, form: HtmlForm, invoices: List[Invoice]) -> None:
+        """Upload the invoices as one CSV, a row of form fields each"""
+        rows = [self.invoice_fields(form, invoice) for invoice in invoices]
+        content = io.StringIO()
+        writer = csv.DictWriter(content, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+        url = urllib.parse.urljoin(self.base_url, self.import_path or "")
+        with self.step("import"), self.posting(url):
+            response = self.session.post(
+                url,
+                data=form.values,
+                files={
+                    "file": ("invoices.csv", content.getvalue(), "text/csv")
+                },
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+        if self.find_form(response.text, "UserName") is not None:
+            self._is_logged = False
+            raise BookkeepingHttpError("Logged out while importing invoices")
+        if not self.is_saved(response):
+            raise SubmissionStateUnknown(
+                f"Import of {len(invoices)} invoices not confirmed: "
+                f"{response.url} answered without confirmation"
+            )
+        logging.info("Imported %s invoices", len(invoices))
+
+    def register_invoices(
+        self, invoices: Iterable[Invoice]
+    ) -> Generator[Invoice, None, None]:
+        """Register invoices reusing one invoice form, yield them once saved
+
+        With BOOKKEPPING_IMPORT_PATH set, invoices are uploaded in batches
+        of BOOKKEPPING_IMPORT_BATCH_SIZE to the platform's import instead.
+        """
+        if self.import_path:
+            pending = iter(invoices)
+            while batch := list(
+                itertools.islice(pending, self.import_batch_size)
+            ):
+                try:
+                    form = self.invoice_form()
+                except (BookkeepingHttpError, requests.RequestException):
+                    if self.fallback is None:
+                        raise
+                    yield from self.register_invoices_one_by_one(batch)
+                    continue
+                self.import_invoices(form, batch)
+                yield from batch
+            return
+
+        yield from self.register_invoices_one_by_one(invoices)
+
+    def register_invoices_one_by_one(
+        self, invoices: Iterable[Invoice]
+    ) -> Generator[Invoice, None, None]:
+        form: Optional[HtmlForm] = None
+        for invoice in invoices:
+            try:
+                if form is None:
+                    form = self.invoice_form()
+                data = self.invoice_form_data(form, invoice)
+            except (BookkeepingHttpError, requests.RequestException) as e:
+                # nothing was posted, the invoice can safely go through the UI
+                if self.fallback is None:
+                    raise
+                logging.warning(
+                    "HTTP backend failed: %s, "
+                    "registering invoice %s with Selenium",
+                    e,
+                    invoice.invoice_number,
+                )
+                self.fallback_bookkeper().register_invoice(invoice)
+                yield invoice
+                continue
+
+            response = self.submit_invoice_form(form, data)
+            if self.find_form(response.text, "UserName") is not None:
+                # the platform sent the login page back, nothing was saved
+                logging.info("Logged out while saving, logging in again")
+                self._is_logged = False
+                form = self.invoice_form()
+                response = self.submit_invoice_form(
+                    form, self.invoice_form_data(form, invoice)
+                )
+                if self.find_form(response.text, "UserName") is not None:
+                    self._is_logged = False
+                    raise BookkeepingHttpError(
+                        "Logged out while saving invoice "
+                        f"{invoice.invoice_number}"
+                    )
+            if not self.is_saved(response):
+                # posted, going through the UI could register it twice
+                raise SubmissionStateUnknown(
+                    f"Invoice {invoice.invoice_number} not saved: "
+                    f"{response.url} answered without confirmation"
+                )
+            logging.info(
+                "Registered invoice %s, %s",
+                invoice.invoice_number,
+                ", ".join(
+                    f"{name}={t:.3f}s" for name, t in self.timings.items()
+                ),
+            )
+            yield invoice
+
+            # the saved page may carry a new form, and a new token with it
+            next_form = self.find_invoice_form(response.text)
+            if next_form is not None:
+                next_form.action = urllib.parse.urljoin(
+                    response.url, next_form.action
+                )
+                form = next_form
+
+    def register_invoice(self, invoice: Invoice) -> None:
+        for _ in self.register_invoices([invoice]):
+            pass
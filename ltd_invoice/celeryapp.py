@@ -3,7 +3,14 @@ import os
 from celery import Celery
 from celery.schedules import crontab
 
-app = Celery("tasks", broker=os.environ["CELERY_BROKER"])
+app = Celery(
+    "tasks",
+    broker=os.environ["CELERY_BROKER"],
+    # chords need somewhere to collect the results of their header
+    backend=os.environ.get(
+        "CELERY_RESULT_BACKEND", os.environ["CELERY_BROKER"]
+    ),
+)
 
 app.autodiscover_tasks(
     [
@@ -11,6 +18,18 @@ app.autodiscover_tasks(
     ]
 )
 
+# Each stage has its own queue, workers pick how many of each they run:
+# pdf parsing is CPU bound, submission is limited by the Selenium grid and
+# the tracker files are written by a single worker, unless the tracker
+# is shared through Redis, TRACKER_BACKEND=redis.
+app.conf.task_routes = {
+    "ltd_invoice.tasks.fetch_email": {"queue": "gmail"},
+    "ltd_invoice.tasks.parse_invoice": {"queue": "parse"},
+    "ltd_invoice.tasks.submit_invoice": {"queue": "bookkeeping"},
+    "ltd_invoice.tasks.record_invoice": {"queue": "tracking"},
+    "ltd_invoice.tasks.finish_processing": {"queue": "tracking"},
+}
+
 app.conf.beat_schedule = {
     "process_invoices": {
         "task": "ltd_invoice.tasks.process_invoices",
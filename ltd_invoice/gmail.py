@@ -1,20 +1,91 @@
 import base64
+import itertools
 import logging
 import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass, field
-from datetime import datetime
+from datetime import datetime, timedelta
 from functools import lru_cache
-from typing import Any, Dict, Generator, Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 import dateutil.parser
 import dateutil.tz
-from google.auth.exceptions import RefreshError
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import Resource, build
 
+from ltd_invoice import metrics
+from ltd_invoice.invoice_cache import InvoiceCache
+from ltd_invoice.settings import (
+    GMAIL_MAX_BATCH_SIZE,
+    GMAIL_MAX_PAGE_SIZE,
+    Settings,
+    get_settings,
+)
+from ltd_invoice.slots import slotted
+from ltd_invoice.timing import timed
 
+# The Google clients are imported by the calls using them, workers that
+# only need EmailMessage don't load them
+if TYPE_CHECKING:
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import Resource
+    from googleapiclient.http import HttpRequest
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore[assignment]
+
+T = TypeVar("T")
+
+TOKEN_FILE = "token.json"
+
+# Partial response for messages().get, everything but the part bodies.
+# format=metadata would be lighter but it drops the parts, and with them
+# the attachment id.
+MESSAGE_METADATA_FIELDS = (
+    "id,threadId,historyId,snippet,"
+    "payload(body,headers,parts(partId,mimeType,filename,body/attachmentId))"
+)
+# strptime doesn't know BST, dateutil resolves it through these
+TZINFOS = {"BST": dateutil.tz.gettz("Europe/London")}
+
+
+@contextmanager
+def token_file_lock() -> Iterator[None]:
+    if fcntl is None:
+        yield
+        return
+    with open(f"{TOKEN_FILE}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def chunked(
+    iterable: Iterable[T], size: int
+) -> Generator[List[T], None, None]:
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+@slotted
 @dataclass(frozen=True)
 class EmailMessage:
     id: str
@@ -25,38 +96,70 @@ class EmailMessage:
     sender: str
     receiver: str
     date: datetime
+    history_id: Optional[str] = None
 
     @staticmethod
-    def parse_date(value):
+    def parse_date(
+        value: str, settings: Optional[Settings] = None
+    ) -> datetime:
         if "BST" in value:
-            BST = dateutil.tz.gettz("Europe/London")
-            return dateutil.parser.parse(value, tzinfos={"BST": BST})
+            parsed: datetime = dateutil.parser.parse(value, tzinfos=TZINFOS)
+            return parsed
         else:
-            return datetime.strptime(value, os.environ["EMAIL_DATE_FORMAT"])
+            return datetime.strptime(
+                value, (settings or get_settings()).email_date_format
+            )
 
     def __post_init__(self) -> None:
-        attributes_to_format = (
-            (
-                "date",
-                self.parse_date(
-                    self.date,
-                ),
-            ),
-        )
-
-        for attr, value in attributes_to_format:
-            super().__setattr__(attr, value)
+        # GmailService parses the date header already
+        if isinstance(self.date, str):
+            object.__setattr__(self, "date", self.parse_date(self.date))
 
 
 class GmailService:
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        service: Optional["Resource"] = None,
+        batch_size: Optional[int] = None,
+        page_size: Optional[int] = None,
+        stream_attachments: Optional[bool] = None,
+        attachment_cache: Optional[InvoiceCache] = None,
+        settings: Optional[Settings] = None,
+    ) -> None:
         logging.info("Creating GmailService")
-        self.service = self.build()
-        self.from_email_filter = os.environ["FROM_EMAIL_FILTER"]
+        self.settings = settings or get_settings()
+        self.service = service or self.build()
+        self.user_id = self.settings.gmail_user_id
+        self.label_id = self.settings.gmail_label_4_invoices
+        self.from_email_filter = self.settings.from_email_filter
+        self.snippet_filter = self.settings.message_snippet_filter
+
+        if batch_size is None:
+            batch_size = self.settings.gmail_batch_size
+        if not 1 <= batch_size <= GMAIL_MAX_BATCH_SIZE:
+            raise ValueError(
+                f"Invalid batch size: {batch_size}, "
+                f"must be between 1 and {GMAIL_MAX_BATCH_SIZE}"
+            )
+        self.batch_size = batch_size
+
+        if page_size is None:
+            page_size = self.settings.gmail_page_size
+        if not 1 <= page_size <= GMAIL_MAX_PAGE_SIZE:
+            raise ValueError(
+                f"Invalid page size: {page_size}, "
+                f"must be between 1 and {GMAIL_MAX_PAGE_SIZE}"
+            )
+        self.page_size = page_size
+
+        if stream_attachments is None:
+            stream_attachments = self.settings.gmail_stream_attachments
+        self.stream_attachments = stream_attachments
+        self.attachment_cache = attachment_cache
         logging.info("GmailService created!")
 
     @staticmethod
-    def build_query(query_data) -> str:
+    def build_query(query_data: Dict[str, Optional[str]]) -> str:
         return " ".join(
             f"{field}:{value}"
             for field, value in query_data.items()
@@ -64,96 +167,422 @@ class GmailService:
         )
 
     def get_raw_messages(
-        self, last_email_processed: Union[datetime, None]
+        self,
+        last_email_processed: Optional[datetime],
+        fields: Optional[str] = None,
+        start_history_id: Optional[str] = None,
     ) -> Generator[Dict[str, Any], None, None]:
-
-        try:
-            after_date = last_email_processed.date().isoformat()
-        except AttributeError:
-            after_date = None
+        after_date = (
+            None
+            if last_email_processed is None
+            else last_email_processed.date().isoformat()
+        )
 
         query_data = {
             "after": after_date,
-            "from": os.environ["FROM_EMAIL_FILTER"],
+            "from": self.from_email_filter,
         }
 
-        message_response = (
-            self.service.users()
-            .messages()
-            .list(
-                userId=os.environ["GMAIL_USER_ID"],
-                labelIds=[os.environ["GMAIL_LABEL_4_INVOICES"]],
-                q=self.build_query(query_data),
+        query = self.build_query(query_data)
+        if start_history_id is None:
+            listed_messages = self.list_messages(query)
+        else:
+            listed_messages = self.list_changed_messages(
+                start_history_id, query
             )
-            .execute()
-        )
 
-        for msg in message_response.get("messages", []):
-            raw_message = (
+        message_ids = (msg["id"] for msg in listed_messages)
+        for chunk in chunked(message_ids, self.batch_size):
+            with metrics.stage("gmail_metadata"):
+                raw_messages = self.execute_requests(
+                    [
+                        self.service.users()
+                        .messages()
+                        .get(
+                            id=message_id,
+                            userId=self.user_id,
+                            fields=fields,
+                        )
+                        for message_id in chunk
+                    ],
+                    # history lists messages deleted since they were added
+                    missing_ok=start_history_id is not None,
+                )
+            for raw_message in raw_messages:
+                if self.snippet_filter not in raw_message["snippet"]:
+                    continue
+
+                # history is not filtered by sender like the search query
+                if (
+                    start_history_id is not None
+                    and self.from_email_filter
+                    not in self.get_attribute_from_header(
+                        attribute="from", message=raw_message
+                    )
+                ):
+                    continue
+
+                yield raw_message
+
+    def get_history_id(self) -> str:
+        """Where the mailbox history stands, before anything is listed
+
+        Whatever changes from then on is listed again by the next run.
+        """
+        with metrics.stage("gmail_list"):
+            profile: Dict[str, Any] = (
+                self.service.users().getProfile(userId=self.user_id).execute()
+            )
+        return str(profile["historyId"])
+
+    def list_messages(
+        self, query: str
+    ) -> Generator[Dict[str, Any], None, None]:
+        """Stream the listing page by page, following nextPageToken
+
+        The next page is fetched in the background while the current one
+        is being consumed.
+        """
+        http = self.new_http()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_page: Optional["Future[Dict[str, Any]]"] = executor.submit(
+                self.list_page, query, None, http
+            )
+            while next_page is not None:
+                page = next_page.result()
+                page_token = page.get("nextPageToken")
+                next_page = (
+                    executor.submit(self.list_page, query, page_token, http)
+                    if page_token
+                    else None
+                )
+                yield from page.get("messages", [])
+
+    def list_changed_messages(
+        self, start_history_id: str, query: str
+    ) -> Generator[Dict[str, Any], None, None]:
+        """Messages added to the label since start_history_id
+
+        Gmail keeps about a week of history, when start_history_id has
+        expired the listing falls back to the search query.
+        """
+        from googleapiclient.errors import HttpError
+
+        try:
+            page = self.history_page(start_history_id, None)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            logging.warning(
+                "History id %s expired, falling back to query %s",
+                start_history_id,
+                query,
+            )
+            yield from self.list_messages(query)
+            return
+
+        seen = set()
+        while True:
+            for history in page.get("history", []):
+                for change in itertools.chain(
+                    history.get("messagesAdded", []),
+                    history.get("labelsAdded", []),
+                ):
+                    message = change["message"]
+                    if message["id"] not in seen:
+                        seen.add(message["id"])
+                        yield message
+
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                break
+            page = self.history_page(start_history_id, page_token)
+
+    def history_page(
+        self, start_history_id: str, page_token: Optional[str]
+    ) -> Dict[str, Any]:
+        with metrics.stage("gmail_list"):
+            response: Dict[str, Any] = (
                 self.service.users()
-                .messages()
-                .get(
-                    id=msg["id"],
-                    userId=os.environ["GMAIL_USER_ID"],
+                .history()
+                .list(
+                    userId=self.user_id,
+                    startHistoryId=start_history_id,
+                    labelId=self.label_id,
+                    historyTypes=["messageAdded", "labelAdded"],
+                    maxResults=self.page_size,
+                    pageToken=page_token,
                 )
                 .execute()
             )
+        return response
 
-            if (
-                os.environ["MESSAGE_SNIPPET_FILTER"]
-                not in raw_message["snippet"]
-            ):
-                continue
+    def list_page(
+        self,
+        query: str,
+        page_token: Optional[str],
+        http: Union["AuthorizedHttp", "httplib2.Http", None] = None,
+    ) -> Dict[str, Any]:
+        with metrics.stage("gmail_list"):
+            response: Dict[str, Any] = (
+                self.service.users()
+                .messages()
+                .list(
+                    userId=self.user_id,
+                    labelIds=[self.label_id],
+                    q=query,
+                    maxResults=self.page_size,
+                    pageToken=page_token,
+                )
+                .execute(http=http)
+            )
+        return response
 
-            yield raw_message
+    def new_http(self) -> Union["AuthorizedHttp", "httplib2.Http", None]:
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
 
-    def get_attachment(self, attachment_id: str, message_id: str) -> bytes:
-        raw_attachment = (
+        # httplib2 is not thread safe, every thread needs its own connection
+        http = getattr(self.service, "_http", None)
+        if isinstance(http, AuthorizedHttp):
+            return AuthorizedHttp(http.credentials, http=httplib2.Http())
+        if isinstance(http, httplib2.Http):
+            return httplib2.Http()
+        return None
+
+    def execute_requests(
+        self, requests: Sequence["HttpRequest"], missing_ok: bool = False
+    ) -> List[Dict[str, Any]]:
+        """Execute requests in a single batch, responses keep their order
+
+        With missing_ok, requests for what no longer exists have no
+        response instead of failing the batch.
+        """
+        from googleapiclient.errors import HttpError
+
+        def is_missing(exception: Exception) -> bool:
+            return (
+                missing_ok
+                and isinstance(exception, HttpError)
+                and exception.resp.status == 404
+            )
+
+        if len(requests) == 1:
+            try:
+                return [requests[0].execute()]
+            except HttpError as e:
+                if not is_missing(e):
+                    raise
+                logging.info("Skipping missing %s", e)
+                return []
+
+        responses: Dict[str, Dict[str, Any]] = {}
+        errors: List[Exception] = []
+
+        def callback(
+            request_id: str,
+            response: Dict[str, Any],
+            exception: Optional[Exception],
+        ) -> None:
+            if exception is None:
+                responses[request_id] = response
+            elif is_missing(exception):
+                logging.info("Skipping missing %s", exception)
+            else:
+                errors.append(exception)
+
+        batch = self.service.new_batch_http_request(callback=callback)
+        for index, request in enumerate(requests):
+            batch.add(request, request_id=str(index))
+        batch.execute()
+
+        if errors:
+            raise errors[0]
+        return [
+            responses[str(index)]
+            for index in range(len(requests))
+            if str(index) in responses
+        ]
+
+    def attachment_request(
+        self, attachment_id: str, message_id: str
+    ) -> "HttpRequest":
+        return (
             self.service.users()
             .messages()
             .attachments()
             .get(
-                userId=os.environ["GMAIL_USER_ID"],
+                userId=self.user_id,
                 messageId=message_id,
                 id=attachment_id,
             )
-            .execute()
         )
-        return base64.urlsafe_b64decode(raw_attachment["data"])
 
-    def get_emails(
-        self, last_email_processed_date
-    ) -> Generator[EmailMessage, None, None]:
-        logging.info("Retrieving emails since %s", last_email_processed_date)
-        yield from sorted(
-            (
-                EmailMessage(
-                    body=raw_message["payload"]["body"],
-                    id=raw_message["id"],
-                    thread_id=raw_message["threadId"],
-                    attachment=self.get_attachment(
-                        attachment_id=self.get_attachment_id(raw_message),
-                        message_id=raw_message["id"],
-                    ),
-                    subject=self.get_attribute_from_header(
-                        attribute="subject", message=raw_message
-                    ),
-                    sender=self.get_attribute_from_header(
-                        attribute="from", message=raw_message
-                    ),
-                    receiver=self.get_attribute_from_header(
-                        attribute="to", message=raw_message
-                    ),
-                    date=self.get_attribute_from_header(
-                        attribute="date", message=raw_message
+    def get_attachment(self, attachment_id: str, message_id: str) -> bytes:
+        return self.get_attachments([(attachment_id, message_id)])[0]
+
+    def get_attachments(
+        self, attachment_ids: Sequence[Tuple[str, str]]
+    ) -> List[bytes]:
+        """Download (attachment_id, message_id) pairs in a single batch"""
+        with metrics.stage("attachment_download"):
+            raw_attachments = self.execute_requests(
+                [
+                    self.attachment_request(attachment_id, message_id)
+                    for attachment_id, message_id in attachment_ids
+                ]
+            )
+        return [
+            base64.urlsafe_b64decode(raw_attachment["data"])
+            for raw_attachment in raw_attachments
+        ]
+
+    def load_attachments(
+        self, raw_messages: Sequence[Dict[str, Any]]
+    ) -> List[bytes]:
+        """Pdf of every message, the cached ones are not downloaded"""
+        attachments: Dict[str, bytes] = {}
+        if self.attachment_cache is not None:
+            for raw_message in raw_messages:
+                cached = self.attachment_cache.get_by_message_id(
+                    raw_message["id"]
+                )
+                if cached is not None:
+                    attachments[raw_message["id"]], _ = cached
+
+        to_download = [
+            raw_message
+            for raw_message in raw_messages
+            if raw_message["id"] not in attachments
+        ]
+        if to_download:
+            attachments.update(
+                zip(
+                    (raw_message["id"] for raw_message in to_download),
+                    self.get_attachments(
+                        [
+                            (
+                                self.get_attachment_id(raw_message),
+                                raw_message["id"],
+                            )
+                            for raw_message in to_download
+                        ]
                     ),
                 )
-                for raw_message in self.get_raw_messages(
-                    last_email_processed_date
+            )
+        return [attachments[raw_message["id"]] for raw_message in raw_messages]
+
+    def get_emails(
+        self,
+        last_email_processed_date: Optional[datetime],
+        last_history_id: Optional[str] = None,
+    ) -> Generator[EmailMessage, None, None]:
+        logging.info(
+            "Retrieving emails since %s, history id %s",
+            last_email_processed_date,
+            last_history_id,
+        )
+        if self.stream_attachments:
+            yield from self.stream_emails(
+                last_email_processed_date, last_history_id
+            )
+            return
+
+        email_messages = sorted(
+            self.build_email_messages(
+                self.get_raw_messages(
+                    last_email_processed_date,
+                    start_history_id=last_history_id,
                 )
             ),
             key=lambda x: x.date,
         )
+        metrics.emails_found(len(email_messages))
+        yield from email_messages
+
+    def stream_emails(
+        self,
+        last_email_processed_date: Optional[datetime],
+        last_history_id: Optional[str] = None,
+    ) -> Generator[EmailMessage, None, None]:
+        """Sort on message metadata, download each pdf only when consumed
+
+        Only one attachment is held in memory at a time.
+        """
+        messages_metadata = self.get_messages_metadata(
+            last_email_processed_date, last_history_id
+        )
+        logging.info("Found %s emails to stream", len(messages_metadata))
+        metrics.emails_found(len(messages_metadata))
+
+        for raw_message in messages_metadata:
+            yield self.fetch_email(raw_message)
+
+    def get_messages_metadata(
+        self,
+        last_email_processed_date: Optional[datetime],
+        last_history_id: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Messages without their attachment, in date order"""
+        return sorted(
+            self.get_raw_messages(
+                last_email_processed_date,
+                fields=MESSAGE_METADATA_FIELDS,
+                start_history_id=last_history_id,
+            ),
+            key=lambda raw_message: EmailMessage.parse_date(
+                self.get_attribute_from_header(
+                    attribute="date", message=raw_message
+                ),
+                self.settings,
+            ),
+        )
+
+    def fetch_email(self, raw_message: Dict[str, Any]) -> EmailMessage:
+        """Complete the metadata of a message with its attachment"""
+        return self.build_email_message(
+            raw_message, self.load_attachments([raw_message])[0], self.settings
+        )
+
+    def build_email_messages(
+        self, raw_messages: Iterable[Dict[str, Any]]
+    ) -> Generator[EmailMessage, None, None]:
+        for chunk in chunked(raw_messages, self.batch_size):
+            attachments = self.load_attachments(chunk)
+            for raw_message, attachment in zip(chunk, attachments):
+                yield self.build_email_message(
+                    raw_message, attachment, self.settings
+                )
+
+    @classmethod
+    def build_email_message(
+        cls,
+        raw_message: Dict[str, Any],
+        attachment: bytes,
+        settings: Optional[Settings] = None,
+    ) -> EmailMessage:
+        return EmailMessage(
+            body=raw_message["payload"]["body"],
+            id=raw_message["id"],
+            thread_id=raw_message["threadId"],
+            attachment=attachment,
+            subject=cls.get_attribute_from_header(
+                attribute="subject", message=raw_message
+            ),
+            sender=cls.get_attribute_from_header(
+                attribute="from", message=raw_message
+            ),
+            receiver=cls.get_attribute_from_header(
+                attribute="to", message=raw_message
+            ),
+            date=EmailMessage.parse_date(
+                cls.get_attribute_from_header(
+                    attribute="date", message=raw_message
+                ),
+                settings,
+            ),
+            history_id=raw_message.get("historyId"),
+        )
 
     @staticmethod
     def get_attribute_from_header(
@@ -174,48 +603,91 @@ class GmailService:
 
     @classmethod
     @lru_cache(maxsize=1)
-    def build(cls) -> Resource:
+    def build(cls) -> "Resource":
+        from googleapiclient.discovery import build
+
         # Call the Gmail API
-        return build("gmail", "v1", credentials=cls.get_credentials())
+        with timed("Gmail credentials"):
+            credentials = cls.get_credentials()
+        with timed("Gmail discovery"):
+            # googleapiclient reads the discovery document it ships with,
+            # a cold build is mostly importing it, once per process
+            return build(
+                "gmail", "v1", credentials=credentials, cache_discovery=False
+            )
 
     @classmethod
-    def get_credentials(cls):
+    def get_credentials(cls, settings: Optional[Settings] = None):
         # If modifying these scopes, delete the file token.json.
-        scopes = [os.environ["GOOGLE_API_SCOPE"]]
-
-        creds = None
-        # The file token.json stores the user's access and refresh tokens, and is
-        # created automatically when the authorization flow completes for the first
-        # time.
-        if os.path.exists("token.json"):
-            creds = Credentials.from_authorized_user_file("token.json", scopes)
-
-        # If there are no (valid) credentials available, let the user log in.
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
+        from google.oauth2.credentials import Credentials
+
+        settings = settings or get_settings()
+        scopes = [settings.google_api_scope]
+
+        # Every worker process shares token.json, the lock lets the first
+        # one refresh the token while the others wait and read it after
+        with token_file_lock():
+            creds = None
+            # The file token.json stores the user's access and refresh tokens, and is
+            # created automatically when the authorization flow completes for the first
+            # time.
+            if os.path.exists(TOKEN_FILE):
+                creds = Credentials.from_authorized_user_file(
+                    TOKEN_FILE, scopes
+                )
+
+            if (
+                creds
+                and creds.refresh_token
+                and cls.expires_soon(creds, settings)
+            ):
                 creds = cls.refresh_creds(creds, scopes)
-            else:
+            # If there are no (valid) credentials available, let the user log in.
+            elif not creds or not creds.valid:
                 creds = cls.generate_creds(scopes)
 
         return creds
 
+    @staticmethod
+    def expires_soon(creds, settings: Settings) -> bool:
+        """Refresh ahead of expiry, a token must outlive the task using it"""
+        margin = timedelta(seconds=settings.gmail_token_refresh_margin)
+        # expiry is naive UTC, like google.auth's own checks, which take a
+        # token without one for a token that doesn't expire
+        return creds.expiry is not None and (
+            creds.expiry - margin <= datetime.utcnow()
+        )
+
     @classmethod
     def refresh_creds(cls, creds, scopes):
+        from google.auth.exceptions import RefreshError
+        from google.auth.transport.requests import Request
+
         try:
             creds.refresh(Request())
         except RefreshError:
-            os.unlink("token.json")
-            creds = cls.generate_creds(scopes)
+            os.unlink(TOKEN_FILE)
+            return cls.generate_creds(scopes)
+        cls.save_creds(creds)
         return creds
 
     @classmethod
     def generate_creds(cls, scopes):
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
         flow = InstalledAppFlow.from_client_secrets_file(
             "credentials.json", scopes
         )
         creds = flow.run_local_server(port=0)
 
         # Save the credentials for the next run
-        with open("token.json", "w") as token:
-            token.write(creds.to_json())
+        cls.save_creds(creds)
         return creds
+
+    @staticmethod
+    def save_creds(creds) -> None:
+        # readers never see a half written token
+        tmp_path = f"{TOKEN_FILE}.tmp"
+        with open(tmp_path, "w") as token:
+            token.write(creds.to_json())
+        os.replace(tmp_path, TOKEN_FILE)
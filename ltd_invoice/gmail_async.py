@@ -0,0 +1,310 @@
+import asyncio
+import base64
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import (
+    Any,
+    AsyncGenerator,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import aiohttp
+
+from ltd_invoice import metrics
+from ltd_invoice.gmail import (
+    MESSAGE_METADATA_FIELDS,
+    EmailMessage,
+    GmailService,
+)
+from ltd_invoice.invoice_cache import InvoiceCache
+from ltd_invoice.settings import GMAIL_MAX_PAGE_SIZE, Settings, get_settings
+
+GMAIL_API_URL = "https://gmail.googleapis.com/gmail/v1/"
+
+Params = Sequence[Tuple[str, Any]]
+
+
+class GmailApiError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(status, message)
+        self.status = status
+        self.message = message
+
+    def __str__(self) -> str:
+        return f"Gmail API error {self.status}: {self.message}"
+
+
+@dataclass
+class GmailApi:
+    """The REST endpoints of one run, sharing a session and a semaphore"""
+
+    session: aiohttp.ClientSession
+    semaphore: asyncio.Semaphore
+    base_url: str
+
+    async def get(self, path: str, params: Params) -> Dict[str, Any]:
+        async with self.semaphore:
+            async with self.session.get(
+                f"{self.base_url}{path}",
+                params=[(name, value) for name, value in params if value],
+            ) as response:
+                if response.status >= 400:
+                    raise GmailApiError(response.status, await response.text())
+                result: Dict[str, Any] = await response.json()
+                return result
+
+
+class AsyncGmailService:
+    """Gmail over its REST API with asyncio, for large backlogs
+
+    Message metadata and pdf attachments are downloaded concurrently, at
+    most concurrency requests in flight, while listing pages are still
+    being followed. get_emails behaves like GmailService.get_emails.
+    """
+
+    def __init__(
+        self,
+        token: Optional[str] = None,
+        base_url: Optional[str] = None,
+        concurrency: Optional[int] = None,
+        page_size: Optional[int] = None,
+        attachment_cache: Optional[InvoiceCache] = None,
+        settings: Optional[Settings] = None,
+    ) -> None:
+        logging.info("Creating AsyncGmailService")
+        self.settings = settings or get_settings()
+        self.token = token
+        self.base_url = (
+            base_url or self.settings.gmail_api_url or GMAIL_API_URL
+        )
+        self.user_id = self.settings.gmail_user_id
+        self.label_id = self.settings.gmail_label_4_invoices
+        self.from_email_filter = self.settings.from_email_filter
+        self.snippet_filter = self.settings.message_snippet_filter
+
+        if concurrency is None:
+            concurrency = self.settings.gmail_concurrency
+        if concurrency < 1:
+            raise ValueError(
+                f"Invalid concurrency: {concurrency}, must be at least 1"
+            )
+        self.concurrency = concurrency
+
+        if page_size is None:
+            page_size = self.settings.gmail_page_size
+        if not 1 <= page_size <= GMAIL_MAX_PAGE_SIZE:
+            raise ValueError(
+                f"Invalid page size: {page_size}, "
+                f"must be between 1 and {GMAIL_MAX_PAGE_SIZE}"
+            )
+        self.page_size = page_size
+        self.attachment_cache = attachment_cache
+        logging.info("AsyncGmailService created!")
+
+    def access_token(self) -> str:
+        if self.token is not None:
+            return self.token
+        token: str = GmailService.get_credentials(self.settings).token
+        return token
+
+    def get_history_id(self) -> str:
+        """Like GmailService.get_history_id"""
+        return asyncio.run(self.fetch_history_id())
+
+    async def fetch_history_id(self) -> str:
+        async with aiohttp.ClientSession(
+            headers={"Authorization": f"Bearer {self.access_token()}"},
+        ) as session:
+            api = GmailApi(
+                session=session,
+                semaphore=asyncio.Semaphore(1),
+                base_url=self.base_url,
+            )
+            with metrics.stage("gmail_list"):
+                profile = await api.get(f"users/{self.user_id}/profile", [])
+        return str(profile["historyId"])
+
+    def get_emails(
+        self,
+        last_email_processed_date: Optional[datetime],
+        last_history_id: Optional[str] = None,
+    ) -> Generator[EmailMessage, None, None]:
+        logging.info(
+            "Retrieving emails since %s, history id %s",
+            last_email_processed_date,
+            last_history_id,
+        )
+        email_messages = asyncio.run(
+            self.fetch_emails(last_email_processed_date, last_history_id)
+        )
+        metrics.emails_found(len(email_messages))
+        yield from sorted(email_messages, key=lambda x: x.date)
+
+    async def fetch_emails(
+        self,
+        last_email_processed_date: Optional[datetime],
+        last_history_id: Optional[str] = None,
+    ) -> List[EmailMessage]:
+        after_date = (
+            None
+            if last_email_processed_date is None
+            else last_email_processed_date.date().isoformat()
+        )
+        query = GmailService.build_query(
+            {"after": after_date, "from": self.from_email_filter}
+        )
+
+        async with aiohttp.ClientSession(
+            headers={"Authorization": f"Bearer {self.access_token()}"},
+        ) as session:
+            api = GmailApi(
+                session=session,
+                semaphore=asyncio.Semaphore(self.concurrency),
+                base_url=self.base_url,
+            )
+            if last_history_id is None:
+                listed_messages = self.list_messages(api, query)
+            else:
+                listed_messages = self.list_changed_messages(
+                    api, last_history_id, query
+                )
+            # downloads start as soon as a listing page comes in
+            downloads = [
+                asyncio.create_task(
+                    self.fetch_email(
+                        api,
+                        message["id"],
+                        from_history=last_history_id is not None,
+                    )
+                )
+                async for message in listed_messages
+            ]
+            email_messages = await asyncio.gather(*downloads)
+
+        return [
+            email_message
+            for email_message in email_messages
+            if email_message is not None
+        ]
+
+    async def list_messages(
+        self, api: GmailApi, query: str
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        page_token = None
+        while True:
+            with metrics.stage("gmail_list"):
+                page = await api.get(
+                    f"users/{self.user_id}/messages",
+                    [
+                        ("labelIds", self.label_id),
+                        ("q", query),
+                        ("maxResults", self.page_size),
+                        ("pageToken", page_token),
+                    ],
+                )
+            for message in page.get("messages", []):
+                yield message
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                return
+
+    async def list_changed_messages(
+        self, api: GmailApi, start_history_id: str, query: str
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """Like GmailService.list_changed_messages"""
+        seen = set()
+        page_token = None
+        while True:
+            try:
+                page = await api.get(
+                    f"users/{self.user_id}/history",
+                    [
+                        ("startHistoryId", start_history_id),
+                        ("labelId", self.label_id),
+                        ("historyTypes", "messageAdded"),
+                        ("historyTypes", "labelAdded"),
+                        ("maxResults", self.page_size),
+                        ("pageToken", page_token),
+                    ],
+                )
+            except GmailApiError as e:
+                if e.status != 404 or page_token is not None:
+                    raise
+                logging.warning(
+                    "History id %s expired, falling back to query %s",
+                    start_history_id,
+                    query,
+                )
+                async for message in self.list_messages(api, query):
+                    yield message
+                return
+
+            for history in page.get("history", []):
+                for change in history.get("messagesAdded", []) + history.get(
+                    "labelsAdded", []
+                ):
+                    message = change["message"]
+                    if message["id"] not in seen:
+                        seen.add(message["id"])
+                        yield message
+
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                return
+
+    async def fetch_email(
+        self, api: GmailApi, message_id: str, from_history: bool
+    ) -> Optional[EmailMessage]:
+        with metrics.stage("gmail_metadata"):
+            try:
+                raw_message = await api.get(
+                    f"users/{self.user_id}/messages/{message_id}",
+                    [("fields", MESSAGE_METADATA_FIELDS)],
+                )
+            except GmailApiError as e:
+                # history lists messages deleted since they were added
+                if e.status != 404 or not from_history:
+                    raise
+                logging.info("Skipping missing message %s", message_id)
+                return None
+        if self.snippet_filter not in raw_message["snippet"]:
+            return None
+        # history is not filtered by sender like the search query
+        if (
+            from_history
+            and self.from_email_filter
+            not in GmailService.get_attribute_from_header(
+                attribute="from", message=raw_message
+            )
+        ):
+            return None
+
+        return GmailService.build_email_message(
+            raw_message,
+            await self.load_attachment(api, raw_message),
+            self.settings,
+        )
+
+    async def load_attachment(
+        self, api: GmailApi, raw_message: Dict[str, Any]
+    ) -> bytes:
+        if self.attachment_cache is not None:
+            cached = self.attachment_cache.get_by_message_id(raw_message["id"])
+            if cached is not None:
+                attachment, _ = cached
+                return attachment
+
+        # waiting for the semaphore is part of it, like queueing is
+        with metrics.stage("attachment_download"):
+            raw_attachment = await api.get(
+                f"users/{self.user_id}/messages/{raw_message['id']}"
+                f"/attachments/{GmailService.get_attachment_id(raw_message)}",
+                [],
+            )
+        return base64.urlsafe_b64decode(raw_attachment["data"])
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from ltd_invoice.settings import Settings, get_settings
+
+
+class InvoiceCache:
+    """Parsed invoice fields on disk, keyed by the SHA-256 of the pdf
+
+    Every entry keeps the extracted fields and the pdf itself, so an
+    invoice already seen can be rebuilt from its Gmail message id without
+    downloading the attachment again. Entries are evicted least recently
+    used first once the directory grows over max_bytes, along with the
+    message ids linked to them.
+
+    Sizes are indexed in memory, the directory is only scanned every
+    SCAN_INTERVAL puts, to pick up the entries of the other workers.
+    """
+
+    MESSAGES_DIR = "messages"
+    SCAN_INTERVAL = 100
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(directory, self.MESSAGES_DIR), exist_ok=True)
+        # entry sizes, least recently used first
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+        self._puts_until_scan = 0
+
+    @staticmethod
+    def key(attachment: bytes) -> str:
+        return hashlib.sha256(attachment).hexdigest()
+
+    def fields_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def pdf_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.pdf")
+
+    def message_path(self, message_id: str) -> str:
+        return os.path.join(self.directory, self.MESSAGES_DIR, message_id)
+
+    def links_path(self, key: str) -> str:
+        """The message ids linked to an entry, one per line"""
+        return os.path.join(self.directory, f"{key}.messages")
+
+    def get(self, key: str) -> Optional[Dict[str, str]]:
+        try:
+            with open(self.fields_path(key), "r") as f:
+                fields: Dict[str, str] = json.loads(f.read())
+            # mtime is the last use, what eviction goes by
+            os.utime(self.fields_path(key))
+        except (FileNotFoundError, ValueError):
+            return None
+        if key in self._sizes:
+            self._sizes.move_to_end(key)
+        return fields
+
+    def get_pdf(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self.pdf_path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get_by_message_id(
+        self, message_id: str
+    ) -> Optional[Tuple[bytes, Dict[str, str]]]:
+        try:
+            with open(self.message_path(message_id), "r") as f:
+                key = f.read()
+        except FileNotFoundError:
+            return None
+
+        fields = self.get(key)
+        attachment = self.get_pdf(key)
+        if fields is None or attachment is None:
+            # evicted
+            return None
+        return attachment, fields
+
+    def put(self, key: str, attachment: bytes, fields: Dict[str, str]) -> None:
+        content = json.dumps(fields).encode()
+        # the pdf goes first, an entry is only visible once its fields are
+        self.write(self.pdf_path(key), attachment)
+        self.write(self.fields_path(key), content)
+        if self._puts_until_scan == 0:
+            self.scan()
+        else:
+            self._puts_until_scan -= 1
+            size = len(attachment) + len(content)
+            self._size += size - self._sizes.pop(key, 0)
+            self._sizes[key] = size
+        self.evict()
+
+    def link_message(self, message_id: str, key: str) -> None:
+        self.write(self.message_path(message_id), key.encode())
+        with open(self.links_path(key), "a") as f:
+            f.write(f"{message_id}\n")
+
+    def write(self, path: str, content: bytes) -> None:
+        # concurrent writers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def scan(self) -> None:
+        """Index the entries of the directory, by last use"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            key = entry.name[: -len(".json")]
+            try:
+                size = (
+                    entry.stat().st_size + os.stat(self.pdf_path(key)).st_size
+                )
+                entries.append((entry.stat().st_mtime, size, key))
+            except FileNotFoundError:
+                continue
+
+        self._sizes = OrderedDict(
+            (key, size) for _, size, key in sorted(entries)
+        )
+        self._size = sum(self._sizes.values())
+        self._puts_until_scan = self.SCAN_INTERVAL
+
+    def evict(self) -> None:
+        while self._size > self.max_bytes and self._sizes:
+            key, size = self._sizes.popitem(last=False)
+            self._size -= size
+            logging.info("Evicting invoice %s from the cache", key)
+            self.remove(key)
+
+    def remove(self, key: str) -> None:
+        try:
+            with open(self.links_path(key), "r") as f:
+                message_ids = f.read().split()
+        except FileNotFoundError:
+            message_ids = []
+        paths = [self.message_path(message_id) for message_id in message_ids]
+        # the entry is gone once its fields are, before its pdf is
+        paths += [
+            self.fields_path(key),
+            self.pdf_path(key),
+            self.links_path(key),
+        ]
+        for path in paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def get_invoice_cache(
+    settings: Optional[Settings] = None,
+) -> Optional[InvoiceCache]:
+    settings = settings or get_settings()
+    if settings.invoice_cache_dir is None:
+        return None
+    return InvoiceCache(
+        directory=settings.invoice_cache_dir,
+        max_bytes=settings.invoice_cache_max_bytes,
+    )
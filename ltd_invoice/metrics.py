@@ -0,0 +1,146 @@
+"""Prometheus metrics of the pipeline
+
+Exported as a text file for node_exporter's textfile collector when
+METRICS_TEXTFILE is set, served over HTTP when METRICS_PORT is set.
+Celery workers share their metrics through PROMETHEUS_MULTIPROC_DIR,
+the directory prometheus_client keeps every process' samples in.
+"""
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    multiprocess,
+    start_http_server,
+    write_to_textfile,
+)
+
+STAGES = (
+    "gmail_list",
+    "gmail_metadata",
+    "attachment_download",
+    "pdf_parse",
+    "submission",
+    "processed_store_write",
+    "watermark_write",
+    "invoice_save",
+)
+
+STAGE_SECONDS = Histogram(
+    "ltd_invoice_stage_seconds",
+    "Duration of a pipeline stage, per invoice or per listing page",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+STAGE_FAILURES = Counter(
+    "ltd_invoice_stage_failures",
+    "Pipeline stages that raised",
+    ["stage"],
+)
+BOOKKEEPING_STEP_SECONDS = Histogram(
+    "ltd_invoice_bookkeeping_step_seconds",
+    "Duration of a step of the bookkeeping platform, per invoice",
+    ["backend", "step"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+RUN_SECONDS = Histogram(
+    "ltd_invoice_run_seconds",
+    "Duration of a run, from listing the emails to moving the watermark",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+)
+RUN_EMAILS = Histogram(
+    "ltd_invoice_run_emails",
+    "Emails found by a run",
+    buckets=(0, 1, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+# raised by the process listing the emails, lowered by the ones handling
+# them, the live processes add up to what's left
+BACKLOG = Gauge(
+    "ltd_invoice_backlog_emails",
+    "Emails found by runs and not done with yet",
+    multiprocess_mode="livesum",
+)
+INVOICES = Counter(
+    "ltd_invoice_invoices",
+    "Emails that went through the pipeline, by outcome",
+    ["outcome"],
+)
+TASK_RETRIES = Counter(
+    "ltd_invoice_task_retries",
+    "Celery pipeline stages retried",
+    ["task"],
+)
+
+# every stage is exported from the start, at zero
+for stage_name in STAGES:
+    STAGE_SECONDS.labels(stage_name)
+    STAGE_FAILURES.labels(stage_name)
+
+
+def emails_found(count: int) -> None:
+    """Emails listed by a run, each one leaves the backlog once done"""
+    RUN_EMAILS.observe(count)
+    BACKLOG.inc(count)
+
+
+def email_done(outcome: str) -> None:
+    INVOICES.labels(outcome).inc()
+    BACKLOG.dec()
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time a stage, count it as a failure when it raises"""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_FAILURES.labels(name).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+
+@contextmanager
+def run() -> Iterator[None]:
+    """Time a run, then write the metrics out, whether it failed or not"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        RUN_SECONDS.observe(time.perf_counter() - start)
+        write_metrics()
+
+
+def get_registry() -> CollectorRegistry:
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)  # type: ignore[no-untyped-call]
+    return registry
+
+
+def write_metrics() -> None:
+    path = os.environ.get("METRICS_TEXTFILE")
+    if path:
+        write_to_textfile(path, get_registry())
+
+
+def start_metrics_server() -> None:
+    port = os.environ.get("METRICS_PORT")
+    if port:
+        logging.info("Serving metrics on port %s", port)
+        start_http_server(int(port), registry=get_registry())
+
+
+def mark_process_dead(pid: int) -> None:
+    """Drop the live gauges of a worker process that exited"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(pid)  # type: ignore[no-untyped-call]
@@ -1,11 +1,39 @@
+import logging
 import os
 import re
 from dataclasses import dataclass, field
-from datetime import datetime
-from functools import cached_property
+from datetime import date, datetime
+from decimal import Decimal
+from functools import lru_cache
 from io import BytesIO
+from typing import TYPE_CHECKING, Any, Dict, List, Mapping, Optional, Pattern
 
-from pdfminer.high_level import extract_text
+from ltd_invoice import metrics
+from ltd_invoice.invoice_cache import InvoiceCache
+from ltd_invoice.settings import Settings, get_settings
+from ltd_invoice.slots import slotted
+
+if TYPE_CHECKING:
+    from pdfminer.layout import LAParams
+
+# Every field is on the first page of the self bill
+FAST_EXTRACTION_MAX_PAGES = 1
+
+
+@lru_cache(maxsize=1)
+def fast_extraction_laparams() -> "LAParams":
+    from pdfminer.layout import LAParams
+
+    # boxes_flow=None skips the hierarchical grouping of text boxes, they're
+    # ordered by position instead, which is all a single column layout needs
+    return LAParams(boxes_flow=None)
+
+
+def extract_text(pdf_file: BytesIO, **kwargs: Any) -> str:
+    """pdfminer's extract_text, pdfminer loads with the first pdf parsed"""
+    from pdfminer import high_level
+
+    return high_level.extract_text(pdf_file, **kwargs)
 
 
 class InvoicePattern:
@@ -23,22 +51,33 @@ class InvoicePattern:
     VAT_VALUE = r"VAT.(\d{0,3}[,]?\d{0,6}.\d{2})"
 
 
+def parse_amount(value: str) -> Decimal:
+    # thousands are comma separated, 1,125.00
+    return Decimal(value.replace(",", ""))
+
+
+@slotted
 @dataclass(frozen=True)
 class Invoice:
+    """A self bill, amounts as Decimal and dates as date
+
+    raw_pdf is the attachment of the email, shared rather than copied.
+    """
+
     raw_pdf: bytes = field(
         repr=False,
     )
     client_name: str
-    gross_value: str
-    hour_rate: str
-    hours_worked: str
-    invoice_date: str
+    gross_value: Decimal
+    hour_rate: Decimal
+    hours_worked: Decimal
+    invoice_date: date
     invoice_number: str
-    net_value: str
-    payment_due_date: str
+    net_value: Decimal
+    payment_due_date: date
     timesheet_id: str
-    vat_rate: str
-    vat_value: str
+    vat_rate: Decimal
+    vat_value: Decimal
     REGEX_MAPPING = dict(
         client_name=InvoicePattern.CLIENT_NAME,
         gross_value=InvoicePattern.GROSS_VALUE,
@@ -53,60 +92,176 @@ class Invoice:
         vat_value=InvoicePattern.VAT_VALUE,
     )
 
-    def __post_init__(self) -> None:
-        attributes_to_format = (
-            ("hours_worked", str(float(self.hours_worked.replace(":", ".")))),
-            ("vat_rate", str(int(float(self.vat_rate)))),
-            (
-                "invoice_date",
-                datetime.strptime(
-                    self.invoice_date, os.environ["PDF_INVOICE_DATE_FORMAT"]
-                ).strftime(os.environ["BOOKKEPPING_DATE_FORMAT"]),
-            ),
-            (
-                "payment_due_date",
-                datetime.strptime(
-                    self.payment_due_date,
-                    os.environ["PDF_INVOICE_DATE_FORMAT"],
-                ).strftime(os.environ["BOOKKEPPING_DATE_FORMAT"]),
-            ),
+    @classmethod
+    def from_fields(
+        cls,
+        raw_pdf: bytes,
+        fields: Mapping[str, str],
+        settings: Optional[Settings] = None,
+    ) -> "Invoice":
+        """The invoice of the fields as found in the pdf"""
+        date_format = (settings or get_settings()).pdf_invoice_date_format
+        return cls(
+            raw_pdf=raw_pdf,
+            client_name=fields["client_name"],
+            gross_value=parse_amount(fields["gross_value"]),
+            hour_rate=parse_amount(fields["hour_rate"]),
+            # 37:30 has always been read as 37.30
+            hours_worked=Decimal(fields["hours_worked"].replace(":", ".")),
+            invoice_date=datetime.strptime(
+                fields["invoice_date"], date_format
+            ).date(),
+            invoice_number=fields["invoice_number"],
+            net_value=parse_amount(fields["net_value"]),
+            payment_due_date=datetime.strptime(
+                fields["payment_due_date"], date_format
+            ).date(),
+            timesheet_id=fields["timesheet_id"],
+            vat_rate=parse_amount(fields["vat_rate"]),
+            vat_value=parse_amount(fields["vat_value"]),
         )
 
-        for attr, value in attributes_to_format:
-            super().__setattr__(attr, value)
+    @property
+    def details(self) -> str:
+        return (
+            f"Sheet: {self.timesheet_id}\n"
+            f"Invoice number: {self.invoice_number}"
+        )
+
+    @property
+    def quantity(self) -> str:
+        """hours_worked as entered in the invoice form, 37.3"""
+        return str(float(self.hours_worked))
 
-    @cached_property
+    @property
+    def vat_percent(self) -> str:
+        return str(int(self.vat_rate))
+
+    @property
     def internal_note(self) -> str:
         return (
-            str(self)
-            .replace("Invoice(", "")
-            .replace(",", "\n")
-            .replace("'", "")
-            .replace(")", "")
-            .replace(" ", "")
-            .replace("_", " ")
-            .replace("=", " = ")
-            .title()
+            f"Client Name = {self.client_name}\n"
+            f"Gross Value = {self.gross_value:,}\n"
+            f"Hour Rate = {self.hour_rate:,}\n"
+            f"Hours Worked = {self.quantity}\n"
+            f"Invoice Date = {self.invoice_date.isoformat()}\n"
+            f"Invoice Number = {self.invoice_number}\n"
+            f"Net Value = {self.net_value:,}\n"
+            f"Payment Due Date = {self.payment_due_date.isoformat()}\n"
+            f"Timesheet Id = {self.timesheet_id}\n"
+            f"Vat Rate = {self.vat_percent}\n"
+            f"Vat Value = {self.vat_value:,}"
         )
 
-    def save(self) -> None:
+    def save(self, settings: Optional[Settings] = None) -> None:
         """Save to filesystem"""
-        with open(
+        with metrics.stage("invoice_save"), open(
             os.path.join(
-                os.environ["INVOICE_DIR"], f"invoice-{self.invoice_number}.pdf"
+                (settings or get_settings()).invoice_dir,
+                f"invoice-{self.invoice_number}.pdf",
             ),
             "wb+",
         ) as f:
             f.write(self.raw_pdf)
 
 
-def extract_invoice(attachment: bytes) -> Invoice:
-    pdf_text = extract_text(BytesIO(attachment))
+COMPILED_REGEX_MAPPING: Dict[str, Pattern[str]] = {
+    field_name: re.compile(regex_pattern, flags=re.DOTALL)
+    for field_name, regex_pattern in Invoice.REGEX_MAPPING.items()
+}
+
 
-    return Invoice(
-        raw_pdf=attachment,
-        **{
-            field_name: re.findall(regex_pattern, pdf_text, flags=re.DOTALL)[0]
-            for field_name, regex_pattern in Invoice.REGEX_MAPPING.items()
-        },
+class InvoiceParseError(ValueError):
+    def __init__(self, missing_fields: List[str]) -> None:
+        super().__init__(missing_fields)
+        self.missing_fields = missing_fields
+
+    def __str__(self) -> str:
+        missing_fields = ", ".join(self.missing_fields)
+        return f"Fields not found in the invoice: {missing_fields}"
+
+
+def match_invoice_fields(pdf_text: str) -> Dict[str, Optional[str]]:
+    """First match of every field, None for the ones not found
+
+    search stops at the first match instead of collecting all of them.
+    """
+    fields = {}
+    for field_name, pattern in COMPILED_REGEX_MAPPING.items():
+        match = pattern.search(pdf_text)
+        fields[field_name] = match.group(1) if match else None
+    return fields
+
+
+def missing_invoice_fields(fields: Dict[str, Optional[str]]) -> List[str]:
+    return [name for name, value in fields.items() if value is None]
+
+
+def extract_fields_fast(attachment: bytes) -> Optional[Dict[str, str]]:
+    """Extract the fields from the first page with a lighter layout analysis
+
+    Returns None when any field is missing from the text extracted.
+    """
+    pdf_text = extract_text(
+        BytesIO(attachment),
+        maxpages=FAST_EXTRACTION_MAX_PAGES,
+        laparams=fast_extraction_laparams(),
     )
+    fields = match_invoice_fields(pdf_text)
+    missing_fields = missing_invoice_fields(fields)
+    if missing_fields:
+        logging.info(
+            "Fast extraction missed %s, falling back to full extraction",
+            missing_fields,
+        )
+        return None
+    return fields  # type: ignore[return-value]
+
+
+def extract_fields(attachment: bytes, fast: bool) -> Dict[str, str]:
+    if fast and (fields := extract_fields_fast(attachment)) is not None:
+        return fields
+
+    all_fields = match_invoice_fields(extract_text(BytesIO(attachment)))
+    missing_fields = missing_invoice_fields(all_fields)
+    if missing_fields:
+        raise InvoiceParseError(missing_fields)
+    return all_fields  # type: ignore[return-value]
+
+
+def extract_invoice(
+    attachment: bytes,
+    fast: Optional[bool] = None,
+    cache: Optional[InvoiceCache] = None,
+    message_id: Optional[str] = None,
+) -> Invoice:
+    """Parse the invoice, the cache is checked before running pdfminer"""
+    return Invoice.from_fields(
+        attachment,
+        extract_invoice_fields(
+            attachment, fast=fast, cache=cache, message_id=message_id
+        ),
+    )
+
+
+def extract_invoice_fields(
+    attachment: bytes,
+    fast: Optional[bool] = None,
+    cache: Optional[InvoiceCache] = None,
+    message_id: Optional[str] = None,
+) -> Dict[str, str]:
+    """The fields of the invoice as found in the pdf, before formatting"""
+    if fast is None:
+        fast = get_settings().pdf_fast_extraction
+    with metrics.stage("pdf_parse"):
+        if cache is None:
+            return extract_fields(attachment, fast)
+
+        key = cache.key(attachment)
+        fields = cache.get(key)
+        if fields is None:
+            fields = extract_fields(attachment, fast)
+            cache.put(key, attachment, fields)
+        if message_id is not None:
+            cache.link_message(message_id, key)
+        return fields
@@ -0,0 +1,252 @@
+import logging
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import (
+    TYPE_CHECKING,
+    Deque,
+    Dict,
+    Generator,
+    Iterable,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from ltd_invoice import metrics
+from ltd_invoice.gmail import EmailMessage, GmailService
+from ltd_invoice.invoice_cache import InvoiceCache, get_invoice_cache
+from ltd_invoice.pdf_parse import (
+    Invoice,
+    extract_invoice,
+    extract_invoice_fields,
+)
+from ltd_invoice.session_pool import SessionPool, get_session_pool
+from ltd_invoice.settings import get_settings
+from ltd_invoice.tracker import Tracker, new_tracker
+
+if TYPE_CHECKING:
+    from ltd_invoice.gmail_async import AsyncGmailService
+
+
+def skip_processed(
+    email_messages: Iterable[EmailMessage], tracker: Tracker
+) -> Generator[EmailMessage, None, None]:
+    for email_message in email_messages:
+        if email_message.id in tracker.processed_emails:
+            logging.info(
+                "Skipping id=%s, email=%s",
+                email_message.id,
+                email_message.date,
+            )
+            metrics.email_done("skipped")
+            continue
+        if not tracker.claim(email_message.id):
+            logging.info("Skipping id=%s, claimed", email_message.id)
+            metrics.email_done("skipped")
+            continue
+        yield email_message
+
+
+def parse_invoices(
+    email_messages: Iterable[EmailMessage],
+    workers: int = 0,
+    cache: Optional[InvoiceCache] = None,
+    fast: bool = False,
+) -> Generator[Tuple[EmailMessage, Invoice], None, None]:
+    """Extract the invoice of every email, keeping the order of the emails
+
+    With workers, attachments are parsed in a process pool while the
+    invoices already yielded are being handled, up to two per worker
+    are parsed ahead. Workers only send the fields back, the invoice
+    keeps the attachment of the email instead of a copy of the pdf.
+    """
+    if workers < 1:
+        for email_message in email_messages:
+            yield email_message, extract_invoice(
+                email_message.attachment,
+                fast=fast,
+                cache=cache,
+                message_id=email_message.id,
+            )
+        return
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    pending: Deque[Tuple[EmailMessage, "Future[Dict[str, str]]"]] = deque()
+    try:
+        for email_message in email_messages:
+            pending.append(
+                (
+                    email_message,
+                    executor.submit(
+                        extract_invoice_fields,
+                        email_message.attachment,
+                        fast=fast,
+                        cache=cache,
+                        message_id=email_message.id,
+                    ),
+                )
+            )
+            if len(pending) >= 2 * workers:
+                email_message, future = pending.popleft()
+                yield email_message, Invoice.from_fields(
+                    email_message.attachment, future.result()
+                )
+
+        while pending:
+            email_message, future = pending.popleft()
+            yield email_message, Invoice.from_fields(
+                email_message.attachment, future.result()
+            )
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def submit_invoices(
+    parsed_invoices: Iterable[Tuple[EmailMessage, Invoice]],
+    pool: SessionPool,
+    workers: int = 1,
+    bulk: bool = False,
+    tracker: Optional[Tracker] = None,
+) -> Generator[Tuple[EmailMessage, Invoice], None, None]:
+    """Register invoices on up to workers browser sessions at once
+
+    Registered invoices are yielded in the order they came in. When one
+    fails, the error is raised after every invoice before it has been
+    yielded, so whatever the caller tracks has no gaps. The invoices
+    after it that were registered anyway are added to the processed
+    emails of the tracker, the next run must not register them again.
+
+    In bulk mode every invoice goes through a single session, which keeps
+    the invoice form open between invoices.
+    """
+    if bulk:
+        yield from submit_invoices_in_bulk(parsed_invoices, pool)
+        return
+
+    def register_invoice(invoice: Invoice) -> None:
+        with pool.session() as bookkeper, metrics.stage("submission"):
+            bookkeper.register_invoice(invoice)
+
+    if workers < 2:
+        for email_message, invoice in parsed_invoices:
+            register_invoice(invoice)
+            yield email_message, invoice
+        return
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending: Deque[Tuple[EmailMessage, Invoice, "Future[None]"]] = deque()
+    try:
+        for email_message, invoice in parsed_invoices:
+            pending.append(
+                (
+                    email_message,
+                    invoice,
+                    executor.submit(register_invoice, invoice),
+                )
+            )
+            if len(pending) >= workers:
+                email_message, invoice, future = pending.popleft()
+                future.result()
+                yield email_message, invoice
+
+        while pending:
+            email_message, invoice, future = pending.popleft()
+            future.result()
+            yield email_message, invoice
+    except BaseException:
+        # registrations already started can't be called off
+        executor.shutdown(wait=True, cancel_futures=True)
+        if tracker is not None:
+            for email_message, _, future in pending:
+                if not future.cancelled() and future.exception() is None:
+                    tracker.add_processed(email_message.id)
+        raise
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def submit_invoices_in_bulk(
+    parsed_invoices: Iterable[Tuple[EmailMessage, Invoice]],
+    pool: SessionPool,
+) -> Generator[Tuple[EmailMessage, Invoice], None, None]:
+    pending: Deque[EmailMessage] = deque()
+
+    def invoices() -> Generator[Invoice, None, None]:
+        for email_message, invoice in parsed_invoices:
+            pending.append(email_message)
+            yield invoice
+
+    with pool.session() as bookkeper:
+        for invoice in bookkeper.register_invoices(invoices()):
+            yield pending.popleft(), invoice
+
+
+def process_emails() -> None:
+    """Process every new email in this process, one stage after the other
+
+    Emails are recorded as they're processed, the watermark only moves
+    once the run went through every email it listed, even none.
+    """
+    with metrics.run():
+        # missing configuration fails here, before any email is fetched
+        settings = get_settings()
+        cache = get_invoice_cache(settings)
+        gmail: Union[GmailService, "AsyncGmailService"]
+        if settings.gmail_async:
+            # aiohttp is only installed with the async extra
+            from ltd_invoice import gmail_async
+
+            gmail = gmail_async.AsyncGmailService(
+                attachment_cache=cache, settings=settings
+            )
+        else:
+            gmail = GmailService(attachment_cache=cache, settings=settings)
+        tracker = new_tracker(settings)
+        history_id = gmail.get_history_id()
+
+        last_email: Optional[EmailMessage] = None
+        try:
+            for email_message, invoice in submit_invoices(
+                parse_invoices(
+                    skip_processed(
+                        gmail.get_emails(
+                            tracker.last_email_processed_date,
+                            tracker.last_history_id,
+                        ),
+                        tracker,
+                    ),
+                    workers=settings.pdf_parse_workers,
+                    cache=cache,
+                    fast=settings.pdf_fast_extraction,
+                ),
+                pool=get_session_pool(),
+                workers=settings.bookkepping_workers,
+                bulk=settings.bookkepping_bulk,
+                tracker=tracker,
+            ):
+                tracker.add_processed(email_message.id)
+                metrics.email_done("processed")
+                logging.info(
+                    "Processed email=%s, invoice=%s, timeshee=%s",
+                    email_message.date,
+                    invoice.invoice_date,
+                    invoice.timesheet_id,
+                )
+                invoice.save(settings)
+                # emails come in date order
+                last_email = email_message
+        except BaseException:
+            # another run may take the emails this one didn't process
+            tracker.release_claims()
+            raise
+
+        if tracker.claimed_elsewhere:
+            logging.info(
+                "Watermark kept, %s emails are processed by another run",
+                len(tracker.claimed_elsewhere),
+            )
+            return
+        # without new emails the history id still moves, before it expires
+        tracker.update_watermark(
+            None if last_email is None else last_email.date, history_id
+        )
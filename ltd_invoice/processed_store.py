@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from typing import Iterable, Iterator, Protocol, Set
+
+LEGACY_PROCESSED_EMAILS_FILE = ".processed_emails"
+
+
+class ProcessedEmails(Protocol):
+    def __contains__(self, email_id: object) -> bool:
+        ...
+
+    def __iter__(self) -> Iterator[str]:
+        ...
+
+    def __len__(self) -> int:
+        ...
+
+    def add(self, email_id: str) -> None:
+        ...
+
+
+class ProcessedEmailStore(ABC):
+    """Set of processed email ids backed by an append-only file
+
+    Membership is answered from memory, every add only appends the new id
+    to disk.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # opening the store creates its file
+        is_new = not os.path.exists(path)
+        self.open()
+        self._ids: Set[str] = set(self.load())
+        if is_new:
+            self.migrate(LEGACY_PROCESSED_EMAILS_FILE)
+
+    def __contains__(self, email_id: object) -> bool:
+        return email_id in self._ids
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._ids)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, email_id: str) -> None:
+        if email_id in self._ids:
+            return
+        self._ids.add(email_id)
+        self.persist([email_id])
+
+    def migrate(self, legacy_path: str) -> None:
+        """Import the ids of the JSON list used by older versions"""
+        try:
+            with open(legacy_path, "r") as f:
+                legacy_ids = set(json.loads(f.read()))
+        except FileNotFoundError:
+            legacy_ids = set()
+
+        new_ids = legacy_ids - self._ids
+        self._ids.update(new_ids)
+        # creates the store, even when there is nothing to migrate
+        self.persist(sorted(new_ids))
+        logging.info(
+            "Migrated %s processed emails from %s to %s",
+            len(new_ids),
+            legacy_path,
+            self.path,
+        )
+
+    def open(self) -> None:
+        """Get the file ready, before the ids are loaded"""
+
+    @abstractmethod
+    def load(self) -> Iterable[str]:
+        """Every id persisted so far"""
+
+    @abstractmethod
+    def persist(self, email_ids: Iterable[str]) -> None:
+        """Write the ids, on top of those already persisted"""
+
+
+class LogProcessedEmailStore(ProcessedEmailStore):
+    """One email id per line"""
+
+    def load(self) -> Iterable[str]:
+        try:
+            with open(self.path, "r") as f:
+                # a crash mid-write can leave a truncated last line behind,
+                # the id won't match anything and it's processed again
+                return [line.strip() for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def persist(self, email_ids: Iterable[str]) -> None:
+        with open(self.path, "a") as f:
+            f.writelines(f"{email_id}\n" for email_id in email_ids)
+
+
+class SQLiteProcessedEmailStore(ProcessedEmailStore):
+    def open(self) -> None:
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS processed_emails "
+            "(id TEXT PRIMARY KEY)"
+        )
+        self.connection.commit()
+
+    def load(self) -> Iterable[str]:
+        return [
+            row[0]
+            for row in self.connection.execute(
+                "SELECT id FROM processed_emails"
+            )
+        ]
+
+    def persist(self, email_ids: Iterable[str]) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO processed_emails (id) VALUES (?)",
+                ((email_id,) for email_id in email_ids),
+            )
+
+
+PROCESSED_EMAIL_STORES = {
+    "log": (LogProcessedEmailStore, ".processed_emails.log"),
+    "sqlite": (SQLiteProcessedEmailStore, ".processed_emails.sqlite3"),
+}
+
+
+def get_processed_email_store(backend: str) -> ProcessedEmailStore:
+    try:
+        store_class, path = PROCESSED_EMAIL_STORES[backend]
+    except KeyError:
+        raise ValueError(f"Invalid PROCESSED_EMAILS_STORE envvar: {backend}")
+    return store_class(path)
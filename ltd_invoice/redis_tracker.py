@@ -0,0 +1,187 @@
+import logging
+import os
+import socket
+from datetime import datetime
+from typing import Any, Iterator, List, Optional, Set, cast
+
+import redis
+
+from ltd_invoice import metrics
+from ltd_invoice.settings import ConfigurationError, Settings, get_settings
+from ltd_invoice.tracker import Tracker
+
+
+class RedisProcessedEmails:
+    """Processed email ids in a Redis set, every worker sees every add"""
+
+    def __init__(self, client: "redis.Redis", key: str) -> None:
+        self.client = client
+        self.key = key
+
+    def __contains__(self, email_id: object) -> bool:
+        return bool(self.client.sismember(self.key, str(email_id)))
+
+    def __iter__(self) -> Iterator[str]:
+        return (
+            email_id.decode() for email_id in self.client.sscan_iter(self.key)
+        )
+
+    def __len__(self) -> int:
+        return int(self.client.scard(self.key))
+
+    def add(self, email_id: str) -> None:
+        self.client.sadd(self.key, email_id)
+
+
+class RedisTracker(Tracker):
+    """Tracker state shared through Redis, for more than one worker
+
+    Emails are claimed before they're processed. A run that fails
+    releases the claims of the emails it didn't process, the claims of a
+    worker that died expire after TRACKER_CLAIM_TTL seconds, and a worker
+    may take its own claims again. The watermark only moves forward,
+    whichever worker finishes last.
+    """
+
+    KEY_PREFIX = "ltd_invoice:tracker:"
+
+    def __init__(
+        self,
+        settings: Optional[Settings] = None,
+        client: Optional["redis.Redis"] = None,
+        claim_ttl: Optional[int] = None,
+    ) -> None:
+        logging.info("Creating RedisTracker")
+        self.settings = settings or get_settings()
+        if client is None:
+            if self.settings.tracker_redis_url is None:
+                raise ConfigurationError(["TRACKER_REDIS_URL is not set"])
+            client = redis.Redis.from_url(self.settings.tracker_redis_url)
+        self.client = client
+        if claim_ttl is None:
+            claim_ttl = self.settings.tracker_claim_ttl
+        self.claim_ttl = claim_ttl
+        # who holds a claim, for whoever looks into Redis
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        # claimed by this tracker and not processed yet
+        self.claims: Set[str] = set()
+        self.claimed_elsewhere: Set[str] = set()
+        self.watermark_key = f"{self.KEY_PREFIX}watermark"
+        self.processed_key = f"{self.KEY_PREFIX}processed"
+        self.processed_emails = RedisProcessedEmails(
+            client, self.processed_key
+        )
+        if not self.client.exists(self.watermark_key) and os.path.exists(
+            self.TRACKER_FILE
+        ):
+            self.migrate(Tracker(self.settings))
+
+        # the client answers bytes, it doesn't decode responses
+        last_date, last_history_id = cast(
+            List[Optional[bytes]],
+            self.client.hmget(self.watermark_key, "date", "history_id"),
+        )
+        self.last_email_processed_date = (
+            datetime.fromisoformat(last_date.decode()) if last_date else None
+        )
+        self.last_history_id = (
+            last_history_id.decode() if last_history_id else None
+        )
+        logging.info("RedisTracker created!")
+
+    def claim_key(self, email_id: str) -> str:
+        return f"{self.KEY_PREFIX}claim:{email_id}"
+
+    def claim(self, email_id: str) -> bool:
+        key = self.claim_key(email_id)
+        # the transaction queues the expire only when the claim is renewed
+        claimed = self.client.set(
+            key, self.owner, nx=True, ex=self.claim_ttl
+        ) or bool(
+            self.client.transaction(
+                lambda pipe: self.renew_claim(pipe, key), key
+            )
+        )
+        if claimed:
+            self.claims.add(email_id)
+        else:
+            self.claimed_elsewhere.add(email_id)
+        return bool(claimed)
+
+    def renew_claim(self, pipe: Any, key: str) -> None:
+        """Take again a claim of this worker, left by a run that failed"""
+        if pipe.get(key) != self.owner.encode():
+            return
+        pipe.multi()
+        pipe.expire(key, self.claim_ttl)
+
+    def release_claims(self) -> None:
+        for email_id in self.claims:
+            key = self.claim_key(email_id)
+            self.client.transaction(
+                lambda pipe: self.release_claim(pipe, key), key
+            )
+        self.claims.clear()
+
+    def release_claim(self, pipe: Any, key: str) -> None:
+        # a claim that expired may have been taken by another worker
+        if pipe.get(key) != self.owner.encode():
+            return
+        pipe.multi()
+        pipe.delete(key)
+
+    def add_processed(self, email_id: str) -> None:
+        super().add_processed(email_id)
+        # processed emails are skipped, their claims can expire
+        self.claims.discard(email_id)
+
+    def update_watermark(
+        self, last_email_date: Optional[datetime], history_id: Optional[str]
+    ) -> None:
+        last_date = (
+            None
+            if last_email_date is None
+            else last_email_date.date().isoformat()
+        )
+        with metrics.stage("watermark_write"):
+            # the check and the write are one transaction, retried when
+            # another worker moves the watermark in between
+            self.client.transaction(
+                lambda pipe: self.move_watermark(pipe, last_date, history_id),
+                self.watermark_key,
+            )
+
+    def move_watermark(
+        self, pipe: Any, last_date: Optional[str], history_id: Optional[str]
+    ) -> None:
+        current_date, current_history_id = pipe.hmget(
+            self.watermark_key, "date", "history_id"
+        )
+        values = {}
+        # ISO dates sort like the dates they stand for
+        if last_date is not None and (
+            current_date is None or last_date > current_date.decode()
+        ):
+            values["date"] = last_date
+        if history_id is not None and (
+            current_history_id is None
+            or int(history_id) > int(current_history_id)
+        ):
+            values["history_id"] = history_id
+        pipe.multi()
+        if values:
+            pipe.hset(self.watermark_key, mapping=values)
+
+    def migrate(self, tracker: Tracker) -> None:
+        """Import the state of the file Tracker used before"""
+        processed_emails = list(tracker.processed_emails)
+        if processed_emails:
+            self.client.sadd(self.processed_key, *processed_emails)
+        if tracker.last_email_processed_date is not None:
+            self.update_watermark(
+                tracker.last_email_processed_date, tracker.last_history_id
+            )
+        logging.info(
+            "Migrated %s processed emails from the tracker files",
+            len(processed_emails),
+        )
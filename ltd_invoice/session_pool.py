@@ -0,0 +1,141 @@
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Callable, Iterable, Iterator, List, Optional, Protocol
+
+from selenium.common.exceptions import WebDriverException
+
+from ltd_invoice.pdf_parse import Invoice
+from ltd_invoice.settings import get_settings
+
+
+class BookkeperSession(Protocol):
+    def is_alive(self) -> bool:
+        ...
+
+    def close(self) -> None:
+        ...
+
+    def register_invoice(self, invoice: Invoice) -> None:
+        ...
+
+    def register_invoices(
+        self, invoices: Iterable[Invoice]
+    ) -> Iterator[Invoice]:
+        ...
+
+
+class SessionPool:
+    """Logged in Bookkeper sessions kept alive between tasks
+
+    Sessions are health checked when taken from the pool, dead ones are
+    replaced by new ones. At most size sessions exist at any time.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        factory: Optional[Callable[[], BookkeperSession]] = None,
+    ) -> None:
+        logging.info("Creating SessionPool of %s sessions", size)
+        self.size = size
+        self.factory = factory or selenium_bookkeper
+        self._idle: "queue.LifoQueue[BookkeperSession]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def session(self) -> Iterator[BookkeperSession]:
+        bookkeper = self.acquire()
+        try:
+            yield bookkeper
+        except WebDriverException:
+            self.discard(bookkeper)
+            raise
+        except BaseException:
+            self.release(bookkeper)
+            raise
+        else:
+            self.release(bookkeper)
+
+    def acquire(self) -> BookkeperSession:
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    bookkeper = self._idle.get_nowait()
+                except queue.Empty:
+                    return self.factory()
+
+                if bookkeper.is_alive():
+                    return bookkeper
+                logging.info("Discarding dead Selenium session")
+                bookkeper.close()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, bookkeper: BookkeperSession) -> None:
+        self._idle.put(bookkeper)
+        self._slots.release()
+
+    def discard(self, bookkeper: BookkeperSession) -> None:
+        bookkeper.close()
+        self._slots.release()
+
+    def close(self) -> None:
+        sessions: List[BookkeperSession] = []
+        while True:
+            try:
+                sessions.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        logging.info("Closing %s Selenium sessions", len(sessions))
+        for bookkeper in sessions:
+            bookkeper.close()
+
+
+@lru_cache(maxsize=1)
+def get_session_pool() -> SessionPool:
+    settings = get_settings()
+    size = settings.selenium_pool_size
+    # sessions over what the grid node allows queue up on the hub
+    max_size = settings.selenium_node_max_session or size
+    if size > max_size:
+        logging.warning(
+            "SELENIUM_POOL_SIZE=%s is over the node limit, using %s",
+            size,
+            max_size,
+        )
+        size = max_size
+    return SessionPool(size=size, factory=get_bookkeper_factory())
+
+
+def close_sessions() -> None:
+    """Close the sessions of the pool, if this process created one"""
+    if get_session_pool.cache_info().currsize:
+        get_session_pool().close()
+
+
+def get_bookkeper_factory() -> Callable[[], BookkeperSession]:
+    backend = get_settings().bookkepping_backend
+    if backend == "selenium":
+        return selenium_bookkeper
+    elif backend == "http":
+        return http_bookkeper
+    else:
+        raise ValueError(f"Invalid BOOKKEPPING_BACKEND envvar: {backend}")
+
+
+# Selenium and requests load with the first session, not with the pool
+def selenium_bookkeper() -> BookkeperSession:
+    from ltd_invoice.bookkepping import Bookkeper
+
+    return Bookkeper()
+
+
+def http_bookkeper() -> BookkeperSession:
+    from ltd_invoice.bookkepping_http import HttpBookkeper
+
+    return HttpBookkeper(fallback=selenium_bookkeper)
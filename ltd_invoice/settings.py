@@ -0,0 +1,277 @@
+import logging
+import os
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, List, Mapping, Optional, Tuple, Type, TypeVar
+
+from ltd_invoice.processed_store import PROCESSED_EMAIL_STORES
+
+BOOKKEPPING_BACKENDS = ("selenium", "http")
+SELENIUM_WEBDRIVERS = ("hub", "local")
+TRACKER_BACKENDS = ("file", "redis")
+# Gmail rejects batches with more than 100 calls
+GMAIL_MAX_BATCH_SIZE = 100
+# maxResults accepted by messages().list
+GMAIL_MAX_PAGE_SIZE = 500
+
+TRUE_VALUES = ("1", "true", "yes")
+FALSE_VALUES = ("", "0", "false", "no")
+
+# Optional knobs, named after their Settings field
+FLAG_KEYS = (
+    "BOOKKEPPING_BULK",
+    "GMAIL_ASYNC",
+    "GMAIL_STREAM_ATTACHMENTS",
+    "PDF_FAST_EXTRACTION",
+    "SELENIUM_FAST_FILL",
+)
+# key -> type, minimum, maximum
+NUMBER_KEYS: Dict[str, Tuple[type, float, Optional[float]]] = {
+    "BOOKKEPPING_HTTP_TIMEOUT": (float, 0, None),
+    "BOOKKEPPING_IMPORT_BATCH_SIZE": (int, 1, None),
+    "BOOKKEPPING_WORKERS": (int, 1, None),
+    "GMAIL_BATCH_SIZE": (int, 1, GMAIL_MAX_BATCH_SIZE),
+    "GMAIL_CONCURRENCY": (int, 1, None),
+    "GMAIL_PAGE_SIZE": (int, 1, GMAIL_MAX_PAGE_SIZE),
+    "GMAIL_TOKEN_REFRESH_MARGIN": (float, 0, None),
+    "INVOICE_CACHE_MAX_BYTES": (int, 0, None),
+    "PDF_PARSE_WORKERS": (int, 0, None),
+    "SELENIUM_NODE_MAX_SESSION": (int, 1, None),
+    "SELENIUM_POOL_SIZE": (int, 1, None),
+    "SELENIUM_WAIT_TIMEOUT": (float, 0, None),
+    "SUBMISSION_CLAIM_TIMEOUT": (float, 0, None),
+    "TASK_MAX_RETRIES": (int, 0, None),
+    "TASK_RETRY_BACKOFF": (int, 0, None),
+    "TASK_RETRY_BACKOFF_MAX": (int, 0, None),
+    "TRACKER_CLAIM_TTL": (int, 1, None),
+}
+STRING_KEYS = (
+    "BOOKKEPPING_IMPORT_PATH",
+    "BOOKKEPPING_LOGIN_PATH",
+    "BOOKKEPPING_SAVED_MARKER",
+    "DEAD_LETTERS_FILE",
+    "GMAIL_API_URL",
+    "INVOICE_CACHE_DIR",
+    "SUBMISSIONS_DIR",
+)
+
+Number = TypeVar("Number", int, float)
+
+REQUIRED_KEYS = (
+    "BOOKKEPPING_DATE_FORMAT",
+    "BOOKKEPPING_PLATFORM_PASS",
+    "BOOKKEPPING_PLATFORM_URL",
+    "BOOKKEPPING_PLATFORM_USER",
+    "EMAIL_DATE_FORMAT",
+    "FROM_EMAIL_FILTER",
+    "GMAIL_LABEL_4_INVOICES",
+    "GMAIL_USER_ID",
+    "GOOGLE_API_SCOPE",
+    "INVOICE_DIR",
+    "MESSAGE_SNIPPET_FILTER",
+    "PDF_INVOICE_DATE_FORMAT",
+)
+
+
+class ConfigurationError(ValueError):
+    def __init__(self, errors: List[str]) -> None:
+        super().__init__(errors)
+        self.errors = errors
+
+    def __str__(self) -> str:
+        return "Invalid configuration: " + "; ".join(self.errors)
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Configuration read from the environment once, at startup"""
+
+    bookkepping_date_format: str
+    bookkepping_platform_pass: str = field(repr=False)
+    bookkepping_platform_url: str
+    bookkepping_platform_user: str
+    email_date_format: str
+    from_email_filter: str
+    gmail_label_4_invoices: str
+    gmail_user_id: str
+    google_api_scope: str
+    invoice_dir: str
+    message_snippet_filter: str
+    pdf_invoice_date_format: str
+    bookkepping_backend: str = "selenium"
+    processed_emails_store: str = "log"
+    selenium_webdriver: Optional[str] = None
+    selenium_hub: Optional[str] = None
+    tracker_backend: str = "file"
+    tracker_redis_url: Optional[str] = None
+    # longer than a chain takes with the default retries
+    tracker_claim_ttl: int = 60 * 60
+    # gmail
+    gmail_api_url: Optional[str] = None
+    gmail_async: bool = False
+    gmail_batch_size: int = 1
+    gmail_concurrency: int = 10
+    gmail_page_size: int = 100
+    gmail_stream_attachments: bool = False
+    gmail_token_refresh_margin: float = 300.0
+    # pdf parsing
+    invoice_cache_dir: Optional[str] = None
+    invoice_cache_max_bytes: int = 256 * 2**20
+    pdf_fast_extraction: bool = False
+    pdf_parse_workers: int = 0
+    # bookkeeping
+    bookkepping_bulk: bool = False
+    bookkepping_http_timeout: float = 30.0
+    bookkepping_import_batch_size: int = 50
+    bookkepping_import_path: Optional[str] = None
+    bookkepping_login_path: str = "/"
+    # text of the page a saved invoice gets, when there's no redirect
+    bookkepping_saved_marker: Optional[str] = None
+    bookkepping_workers: int = 1
+    selenium_fast_fill: bool = False
+    selenium_node_max_session: Optional[int] = None
+    selenium_pool_size: int = 1
+    selenium_wait_timeout: float = 10.0
+    # celery tasks
+    dead_letters_file: str = ".dead_letters.log"
+    submission_claim_timeout: float = 15 * 60.0
+    submissions_dir: str = ".submissions"
+    task_max_retries: int = 5
+    task_retry_backoff: int = 60
+    task_retry_backoff_max: int = 60 * 60
+
+    @classmethod
+    def from_env(cls, environ: Mapping[str, str]) -> "Settings":
+        """Every problem is reported at once, not the first one found"""
+        errors = [
+            f"{key} is not set"
+            for key in REQUIRED_KEYS
+            if not environ.get(key)
+        ]
+
+        bookkepping_backend = environ.get("BOOKKEPPING_BACKEND", "selenium")
+        if bookkepping_backend not in BOOKKEPPING_BACKENDS:
+            errors.append(
+                f"Invalid BOOKKEPPING_BACKEND: {bookkepping_backend}"
+            )
+
+        processed_emails_store = environ.get("PROCESSED_EMAILS_STORE", "log")
+        if processed_emails_store not in PROCESSED_EMAIL_STORES:
+            errors.append(
+                f"Invalid PROCESSED_EMAILS_STORE: {processed_emails_store}"
+            )
+
+        # the http backend only needs a browser for its fallback
+        selenium_webdriver = environ.get("SELENIUM_WEBDRIVER")
+        if selenium_webdriver is None:
+            if bookkepping_backend == "selenium":
+                errors.append("SELENIUM_WEBDRIVER is not set")
+        elif selenium_webdriver not in SELENIUM_WEBDRIVERS:
+            errors.append(f"Invalid SELENIUM_WEBDRIVER: {selenium_webdriver}")
+        elif selenium_webdriver == "hub" and not environ.get("SELENIUM_HUB"):
+            errors.append("SELENIUM_HUB is not set")
+
+        tracker_backend = environ.get("TRACKER_BACKEND", "file")
+        if tracker_backend not in TRACKER_BACKENDS:
+            errors.append(f"Invalid TRACKER_BACKEND: {tracker_backend}")
+        elif tracker_backend == "redis" and not environ.get(
+            "TRACKER_REDIS_URL"
+        ):
+            errors.append("TRACKER_REDIS_URL is not set")
+
+        tuning = cls.tuning_from_env(environ, errors)
+        cls.check_bookkepping_workers(tuning, errors)
+
+        if errors:
+            raise ConfigurationError(errors)
+
+        required: Dict[str, Any] = {
+            key.lower(): environ[key] for key in REQUIRED_KEYS
+        }
+        return cls(
+            **required,
+            bookkepping_backend=bookkepping_backend,
+            processed_emails_store=processed_emails_store,
+            selenium_webdriver=selenium_webdriver,
+            selenium_hub=environ.get("SELENIUM_HUB"),
+            tracker_backend=tracker_backend,
+            tracker_redis_url=environ.get("TRACKER_REDIS_URL"),
+            **tuning,
+        )
+
+    @classmethod
+    def check_bookkepping_workers(
+        cls, tuning: Dict[str, Any], errors: List[str]
+    ) -> None:
+        """Every submitting thread holds a session, extra ones would wait"""
+        workers = tuning.get("bookkepping_workers") or cls.bookkepping_workers
+        sessions = tuning.get("selenium_pool_size") or cls.selenium_pool_size
+        limit = "SELENIUM_POOL_SIZE"
+        # the pool never grows over what the grid node allows
+        node_max_session = tuning.get("selenium_node_max_session")
+        if node_max_session is not None and node_max_session < sessions:
+            limit, sessions = "SELENIUM_NODE_MAX_SESSION", node_max_session
+        if workers > sessions:
+            errors.append(
+                f"Invalid BOOKKEPPING_WORKERS: {workers}, "
+                f"must be at most {limit} ({sessions})"
+            )
+
+    @staticmethod
+    def tuning_from_env(
+        environ: Mapping[str, str], errors: List[str]
+    ) -> Dict[str, Any]:
+        """The knobs set in environ, the others keep their default"""
+        tuning: Dict[str, Any] = {}
+        for key in FLAG_KEYS:
+            if key in environ:
+                tuning[key.lower()] = parse_flag(environ, key, errors)
+        for key, (kind, minimum, maximum) in NUMBER_KEYS.items():
+            if environ.get(key):
+                tuning[key.lower()] = parse_number(
+                    environ, key, kind, errors, minimum, maximum
+                )
+        for key in STRING_KEYS:
+            if environ.get(key):
+                tuning[key.lower()] = environ[key]
+        return tuning
+
+
+def parse_flag(
+    environ: Mapping[str, str], key: str, errors: List[str]
+) -> bool:
+    value = environ[key].lower()
+    if value not in TRUE_VALUES + FALSE_VALUES:
+        errors.append(f"Invalid {key}: {environ[key]}, must be true or false")
+    return value in TRUE_VALUES
+
+
+def parse_number(
+    environ: Mapping[str, str],
+    key: str,
+    kind: Type[Number],
+    errors: List[str],
+    minimum: Number,
+    maximum: Optional[Number],
+) -> Optional[Number]:
+    value = environ[key]
+    try:
+        number = kind(value)
+    except ValueError:
+        errors.append(f"Invalid {key}: {value}, must be a number")
+        return None
+    if maximum is not None and not minimum <= number <= maximum:
+        errors.append(
+            f"Invalid {key}: {value}, must be between {minimum} and {maximum}"
+        )
+    elif number < minimum:
+        errors.append(f"Invalid {key}: {value}, must be at least {minimum}")
+    return number
+
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    logging.info("Loading settings")
+    settings = Settings.from_env(os.environ)
+    logging.info("Settings loaded!")
+    return settings
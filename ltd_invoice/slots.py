@@ -0,0 +1,52 @@
+from dataclasses import FrozenInstanceError, fields
+from typing import Any, Callable, List, Type, TypeVar, cast
+
+T = TypeVar("T")
+
+
+def slotted(cls: Type[T]) -> Type[T]:
+    """Rebuild a dataclass with __slots__, its instances have no __dict__
+
+    What dataclass(slots=True) does from Python 3.10. Like there, methods
+    of the class can't use super() without arguments, and frozen
+    instances are set up with object.__setattr__. Their __setattr__ and
+    __delattr__ are replaced, the generated ones call super() with the
+    class before the rebuild.
+    """
+    field_names = tuple(f.name for f in fields(cls))  # type: ignore
+    cls_dict = dict(cls.__dict__)
+    cls_dict["__slots__"] = field_names
+    for name in field_names:
+        # defaults live on in the generated __init__
+        cls_dict.pop(name, None)
+    cls_dict.pop("__dict__", None)
+    cls_dict.pop("__weakref__", None)
+    cls_dict["__getstate__"] = _getstate
+    cls_dict["__setstate__"] = _setstate
+    if cls.__dataclass_params__.frozen:  # type: ignore
+        cls_dict["__setattr__"] = _frozen_setattr
+        cls_dict["__delattr__"] = _frozen_delattr
+
+    # the metaclass of cls, dataclass or not
+    metaclass = cast(Callable[..., Type[T]], type(cls))
+    slotted_cls = metaclass(cls.__name__, cls.__bases__, cls_dict)
+    slotted_cls.__qualname__ = cls.__qualname__
+    return slotted_cls
+
+
+def _getstate(self: Any) -> List[Any]:
+    return [getattr(self, f.name) for f in fields(self)]
+
+
+def _setstate(self: Any, state: List[Any]) -> None:
+    for f, value in zip(fields(self), state):
+        # frozen instances refuse setattr, unpickling included
+        object.__setattr__(self, f.name, value)
+
+
+def _frozen_setattr(self: Any, name: str, value: Any) -> None:
+    raise FrozenInstanceError(f"cannot assign to field {name!r}")
+
+
+def _frozen_delattr(self: Any, name: str) -> None:
+    raise FrozenInstanceError(f"cannot delete field {name!r}")
@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Optional, Set
+
+from ltd_invoice.settings import get_settings
+
+
+class SubmissionInProgress(Exception):
+    """Another worker holds the claim, retry later"""
+
+
+class SubmissionStateUnknown(Exception):
+    """The invoice may or may not be saved
+
+    The submission failed after reaching the platform, or a worker died
+    while submitting.
+    """
+
+
+class SubmissionClaims:
+    """One file per idempotency key, created with O_EXCL
+
+    A claim is pending while the invoice is being registered and done
+    once it's saved. Submissions failing before they reach the platform
+    release their claim, the others leave it pending.
+    """
+
+    PENDING = "pending"
+    DONE = "done"
+
+    def __init__(self, directory: str, timeout: float) -> None:
+        self.directory = directory
+        self.timeout = timeout
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(message_id: str, invoice_number: str) -> str:
+        return f"{message_id}-{invoice_number}"
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def claim(self, key: str) -> bool:
+        """Take the claim, False when the invoice was already submitted
+
+        Raises SubmissionInProgress when someone else holds the claim and
+        SubmissionStateUnknown when they held it for longer than timeout.
+        """
+        try:
+            fd = os.open(self.path(key), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return self.check_claim(key)
+        with os.fdopen(fd, "w") as f:
+            f.write(self.PENDING)
+        return True
+
+    def check_claim(self, key: str) -> bool:
+        try:
+            with open(self.path(key), "r") as f:
+                state = f.read()
+            age = time.time() - os.stat(self.path(key)).st_mtime
+        except FileNotFoundError:
+            # released in the meantime
+            return self.claim(key)
+
+        if state == self.DONE:
+            return False
+        if age > self.timeout:
+            raise SubmissionStateUnknown(
+                f"Submission {key} pending for {age:.0f}s"
+            )
+        raise SubmissionInProgress(key)
+
+    def complete(self, key: str) -> None:
+        tmp_path = f"{self.path(key)}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.DONE)
+        os.replace(tmp_path, self.path(key))
+
+    def release(self, key: str) -> None:
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+class DeadLetters:
+    """Emails that kept failing, one JSON record per line
+
+    They're skipped by the next runs until the record is removed.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def message_ids(self) -> Set[str]:
+        try:
+            with open(self.path, "r") as f:
+                return {
+                    json.loads(line)["message_id"]
+                    for line in f
+                    if line.strip()
+                }
+        except FileNotFoundError:
+            return set()
+
+    def add(
+        self,
+        message_id: str,
+        stage: str,
+        error: BaseException,
+        retries: int,
+        invoice_number: Optional[str] = None,
+    ) -> None:
+        logging.error(
+            "Dead letter for email %s at %s after %s retries: %r",
+            message_id,
+            stage,
+            retries,
+            error,
+        )
+        record = {
+            "message_id": message_id,
+            "invoice_number": invoice_number,
+            "stage": stage,
+            "error": repr(error),
+            "retries": retries,
+            "failed_at": datetime.now().isoformat(),
+        }
+        with open(self.path, "a") as f:
+            f.write(f"{json.dumps(record)}\n")
+
+
+def get_submission_claims() -> SubmissionClaims:
+    settings = get_settings()
+    return SubmissionClaims(
+        directory=settings.submissions_dir,
+        timeout=settings.submission_claim_timeout,
+    )
+
+
+def get_dead_letters() -> DeadLetters:
+    return DeadLetters(get_settings().dead_letters_file)
@@ -1,41 +1,306 @@
+import base64
 import logging
+import os
+import time
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
 
-from ltd_invoice.bookkepping import Bookkeper
+from celery import Task, chain, chord
+from celery.signals import worker_init, worker_process_shutdown
+from celery.utils.time import get_exponential_backoff_interval
+
+from ltd_invoice import metrics
 from ltd_invoice.celeryapp import app
-from ltd_invoice.gmail import GmailService
-from ltd_invoice.pdf_parse import extract_invoice
-from ltd_invoice.tracker import Tracker
+from ltd_invoice.gmail import EmailMessage, GmailService
+from ltd_invoice.invoice_cache import get_invoice_cache
+from ltd_invoice.pdf_parse import (
+    Invoice,
+    InvoiceParseError,
+    extract_invoice_fields,
+)
+from ltd_invoice.session_pool import get_session_pool
+from ltd_invoice.settings import Settings, get_settings
+from ltd_invoice.submissions import (
+    SubmissionStateUnknown,
+    get_dead_letters,
+    get_submission_claims,
+)
+from ltd_invoice.tracker import Tracker, new_tracker
+
+# Stages pass a JSON payload along the chain:
+#   message      Gmail metadata of the email, what EmailMessage is built from
+#   attachment   the pdf, base64 encoded
+#   invoice      the fields extracted from the pdf
+#   dead_letter  the stage that gave up on the email, later stages skip it
+Payload = Dict[str, Any]
+
+
+# celery ships without type hints, Task is Any to mypy
+class PipelineStage(Task):  # type: ignore[misc]
+    """Retry a failing email with exponential backoff, then dead letter it
+
+    Giving up on an email doesn't fail the chain, so the chord still
+    completes for the emails that went through.
+    """
+
+    # set from the settings when the worker starts
+    max_retries = Settings.task_max_retries
+    retry_backoff = Settings.task_retry_backoff
+    retry_backoff_max = Settings.task_retry_backoff_max
+    # retrying won't help with these
+    permanent_errors = (InvoiceParseError, SubmissionStateUnknown)
+
+    def __call__(self, payload: Payload) -> Payload:
+        if "dead_letter" in payload:
+            return payload
+
+        try:
+            result: Payload = self.run(payload)
+            return result
+        except self.permanent_errors as e:
+            return self.dead_letter(payload, e)
+        except Exception as e:
+            if self.request.retries >= self.max_retries:
+                return self.dead_letter(payload, e)
+            countdown = get_exponential_backoff_interval(
+                factor=self.retry_backoff,
+                retries=self.request.retries,
+                maximum=self.retry_backoff_max,
+                full_jitter=True,
+            )
+            metrics.TASK_RETRIES.labels(self.name).inc()
+            logging.warning(
+                "%s failed for email %s: %r, retrying in %ss",
+                self.name,
+                payload["message"]["id"],
+                e,
+                countdown,
+            )
+            raise self.retry(exc=e, countdown=countdown)
+
+    def dead_letter(self, payload: Payload, error: Exception) -> Payload:
+        get_dead_letters().add(
+            message_id=payload["message"]["id"],
+            stage=self.name,
+            error=error,
+            retries=self.request.retries,
+            invoice_number=payload.get("invoice", {}).get("invoice_number"),
+        )
+        metrics.email_done("dead_letter")
+        return {"message": payload["message"], "dead_letter": self.name}
+
+
+@lru_cache(maxsize=None)
+def get_gmail_service() -> GmailService:
+    return GmailService(attachment_cache=get_invoice_cache())
+
+
+@lru_cache(maxsize=None)
+def get_tracker() -> Tracker:
+    return new_tracker()
+
+
+def payload_attachment(payload: Payload) -> bytes:
+    return base64.b64decode(payload["attachment"])
+
+
+def payload_email(payload: Payload) -> EmailMessage:
+    return GmailService.build_email_message(
+        payload["message"], payload_attachment(payload)
+    )
+
+
+def payload_invoice(payload: Payload) -> Invoice:
+    return Invoice.from_fields(payload_attachment(payload), payload["invoice"])
 
 
 @app.task
 def process_invoices() -> None:
+    """Fan every new email out to its own fetch, parse, submit, record chain
+
+    The watermark of the tracker only moves once every chain succeeded,
+    emails recorded before a failure are skipped on the next run. While
+    another run holds some of the listed emails, it stays where it is.
+    """
     logging.info("Starting process_invoices")
+    started = time.time()
 
-    gmail = GmailService()
-    tracker = Tracker()
-    bookkeper = Bookkeper()
+    tracker = new_tracker()
+    dead_letters = get_dead_letters().message_ids()
+    gmail = get_gmail_service()
+    history_id = gmail.get_history_id()
+    listed_messages = gmail.get_messages_metadata(
+        tracker.last_email_processed_date, tracker.last_history_id
+    )
+    metrics.emails_found(len(listed_messages))
+    messages = []
+    for raw_message in listed_messages:
+        if (
+            raw_message["id"] in tracker.processed_emails
+            or raw_message["id"] in dead_letters
+            # dispatched by a run still going on
+            or not tracker.claim(raw_message["id"])
+        ):
+            metrics.email_done("skipped")
+        else:
+            messages.append(raw_message)
+    if not messages:
+        logging.info("No new emails to process")
+        # the history id still moves, before it expires
+        if not tracker.claimed_elsewhere:
+            tracker.update_watermark(None, history_id)
+        finish_run(started)
+        return
 
+    logging.info("Dispatching %s emails", len(messages))
     try:
-        for email_message in gmail.get_emails(
-            tracker.last_email_processed_date
-        ):
-            if email_message.id in tracker.processed_emails:
-                logging.info(
-                    "Skipping id=%s, email=%s",
-                    email_message.id,
-                    email_message.date,
-                )
-                continue
+        chord(
+            chain(
+                fetch_email.s({"message": raw_message}),
+                parse_invoice.s(),
+                submit_invoice.s(),
+                record_invoice.s(),
+            )
+            for raw_message in messages
+        )(
+            finish_processing.s(
+                started,
+                history_id=history_id,
+                move_watermark=not tracker.claimed_elsewhere,
+            )
+        )
+    except BaseException:
+        tracker.release_claims()
+        raise
 
-            invoice = extract_invoice(email_message.attachment)
+
+@app.task(base=PipelineStage)
+def fetch_email(payload: Payload) -> Payload:
+    email_message = get_gmail_service().fetch_email(payload["message"])
+    return {
+        **payload,
+        "attachment": base64.b64encode(email_message.attachment).decode(),
+    }
+
+
+@app.task(base=PipelineStage)
+def parse_invoice(payload: Payload) -> Payload:
+    return {
+        **payload,
+        "invoice": extract_invoice_fields(
+            payload_attachment(payload),
+            cache=get_invoice_cache(),
+            message_id=payload["message"]["id"],
+        ),
+    }
+
+
+@app.task(base=PipelineStage)
+def submit_invoice(payload: Payload) -> Payload:
+    """Register the invoice at most once, however many times it's retried
+
+    The idempotency key is the Gmail message id and the invoice number. A
+    submission failing after it reached the platform keeps its claim and
+    is dead lettered, someone has to check whether the invoice was saved.
+    """
+    invoice = payload_invoice(payload)
+    claims = get_submission_claims()
+    key = claims.key(payload["message"]["id"], invoice.invoice_number)
+    if not claims.claim(key):
+        logging.info("Invoice %s already submitted", invoice.invoice_number)
+        return payload
+
+    try:
+        with get_session_pool().session() as bookkeper, metrics.stage(
+            "submission"
+        ):
             bookkeper.register_invoice(invoice)
-            tracker.update(email_message)
-            logging.info(
-                "Processed email=%s, invoice=%s, timeshee=%s",
-                email_message.date,
-                invoice.invoice_date,
-                invoice.timesheet_id,
+    except SubmissionStateUnknown:
+        # the invoice reached the platform, retrying could register it twice
+        raise
+    except BaseException:
+        claims.release(key)
+        raise
+    claims.complete(key)
+    return payload
+
+
+@app.task(base=PipelineStage)
+def record_invoice(payload: Payload) -> Payload:
+    email_message = payload_email(payload)
+    invoice = payload_invoice(payload)
+
+    get_tracker().add_processed(email_message.id)
+    invoice.save()
+    metrics.email_done("processed")
+    logging.info(
+        "Processed email=%s, invoice=%s, timeshee=%s",
+        email_message.date,
+        invoice.invoice_date,
+        invoice.timesheet_id,
+    )
+    return {"message": payload["message"]}
+
+
+def finish_run(started: Optional[float]) -> None:
+    # wall clock, the run spans processes and machines
+    if started is not None:
+        metrics.RUN_SECONDS.observe(time.time() - started)
+    metrics.write_metrics()
+
+
+@app.task
+def finish_processing(
+    processed: List[Payload],
+    started: Optional[float] = None,
+    history_id: Optional[str] = None,
+    move_watermark: bool = True,
+) -> None:
+    """Move the watermark past every email, dead letters included
+
+    history_id is where the mailbox stood when the emails were listed.
+    """
+    logging.info(
+        "Processed %s emails, %s dead letters",
+        len(processed),
+        sum("dead_letter" in payload for payload in processed),
+    )
+    if move_watermark:
+        last_email_date = max(
+            EmailMessage.parse_date(
+                GmailService.get_attribute_from_header(
+                    attribute="date", message=payload["message"]
+                )
             )
-            invoice.save()
-    finally:
-        del bookkeper
+            for payload in processed
+        )
+        new_tracker().update_watermark(last_email_date, history_id)
+    else:
+        logging.info("Watermark kept, emails are processed by another run")
+    finish_run(started)
+
+
+@worker_init.connect
+def check_settings(**kwargs: Any) -> None:
+    # a misconfigured worker stops here instead of failing every task
+    settings = get_settings()
+    # the pool processes are forked after this, and inherit it
+    PipelineStage.max_retries = settings.task_max_retries
+    PipelineStage.retry_backoff = settings.task_retry_backoff
+    PipelineStage.retry_backoff_max = settings.task_retry_backoff_max
+
+
+@worker_init.connect
+def serve_metrics(**kwargs: Any) -> None:
+    # the main process serves what its pool processes record
+    metrics.start_metrics_server()
+
+
+@worker_process_shutdown.connect
+def close_session_pool(**kwargs: Any) -> None:
+    get_session_pool().close()
+
+
+@worker_process_shutdown.connect
+def drop_process_metrics(**kwargs: Any) -> None:
+    metrics.mark_process_dead(os.getpid())
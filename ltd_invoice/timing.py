@@ -0,0 +1,38 @@
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+from ltd_invoice.metrics import BOOKKEEPING_STEP_SECONDS
+
+
+@contextmanager
+def timed(what: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        logging.info("%s took %.3fs", what, time.perf_counter() - start)
+
+
+class StepTimings:
+    """Duration in seconds of the last run of every step"""
+
+    timings: Dict[str, float]
+
+    @contextmanager
+    def step(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = time.perf_counter() - start
+            BOOKKEEPING_STEP_SECONDS.labels(type(self).__name__, name).observe(
+                self.timings[name]
+            )
+            logging.info(
+                "%s %s took %.3fs",
+                type(self).__name__,
+                name,
+                self.timings[name],
+            )
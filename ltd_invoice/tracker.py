@@ -1,15 +1,24 @@
-import json
 import logging
 from datetime import datetime
-from typing import List
+from typing import Optional, Set
+
+from ltd_invoice import metrics
+from ltd_invoice.processed_store import (
+    LEGACY_PROCESSED_EMAILS_FILE,
+    ProcessedEmails,
+    get_processed_email_store,
+)
+from ltd_invoice.settings import Settings, get_settings
 
 
 class Tracker:
     TRACKER_FILE = ".tracker"
-    PROCESSED_EMAILS_FILE = ".processed_emails"
+    PROCESSED_EMAILS_FILE = LEGACY_PROCESSED_EMAILS_FILE
+    HISTORY_ID_FILE = ".history_id"
 
-    def __init__(self) -> None:
+    def __init__(self, settings: Optional[Settings] = None) -> None:
         logging.info("Creating Tracker")
+        self.settings = settings or get_settings()
         try:
             with open(self.TRACKER_FILE, "r+") as f:
                 last_email_processed_date = datetime.fromisoformat(f.read())
@@ -17,19 +26,70 @@ class Tracker:
             last_email_processed_date = None
 
         self.last_email_processed_date = last_email_processed_date
-        self.processed_emails = self.load_processed_emails()
+        self.last_history_id = self.load_history_id()
+        self.processed_emails: ProcessedEmails = get_processed_email_store(
+            self.settings.processed_emails_store
+        )
+        # the watermark must not move past these, another run may fail them
+        self.claimed_elsewhere: Set[str] = set()
         logging.info("Tracker created!")
 
+    def claim(self, email_id: str) -> bool:
+        """Whether this worker may process the email
+
+        The files belong to a single worker, every claim succeeds.
+        """
+        return True
+
+    def release_claims(self) -> None:
+        """Give up the claims of the emails this run didn't process"""
+
     def update(self, email_message) -> None:
-        self.processed_emails.append(email_message.id)
-        self.save_processed_emails()
-        with open(self.TRACKER_FILE, "w") as f:
-            f.write(email_message.date.date().isoformat())
-
-    def load_processed_emails(self) -> List[str]:
-        with open(self.PROCESSED_EMAILS_FILE, "r+") as f:
-            return list(set(json.loads(f.read())))
-
-    def save_processed_emails(self) -> None:
-        with open(self.PROCESSED_EMAILS_FILE, "w+") as f:
-            f.write(json.dumps(list(set(self.processed_emails)), indent=4))
+        self.add_processed(email_message.id)
+        self.update_watermark(email_message.date, email_message.history_id)
+
+    def add_processed(self, email_id: str) -> None:
+        with metrics.stage("processed_store_write"):
+            self.processed_emails.add(email_id)
+
+    def update_watermark(
+        self, last_email_date: Optional[datetime], history_id: Optional[str]
+    ) -> None:
+        """Where the next run starts looking for emails
+
+        A run without new emails has no date, only the history id moves.
+        """
+        with metrics.stage("watermark_write"):
+            if last_email_date is not None:
+                with open(self.TRACKER_FILE, "w") as f:
+                    f.write(last_email_date.date().isoformat())
+            self.update_history_id(history_id)
+
+    def load_history_id(self) -> Optional[str]:
+        try:
+            with open(self.HISTORY_ID_FILE, "r+") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def update_history_id(self, history_id: Optional[str]) -> None:
+        # history ids only grow, messages may be processed out of order
+        if history_id is None or (
+            self.last_history_id is not None
+            and int(history_id) <= int(self.last_history_id)
+        ):
+            return
+        self.last_history_id = history_id
+        with open(self.HISTORY_ID_FILE, "w") as f:
+            f.write(history_id)
+
+
+def new_tracker(settings: Optional[Settings] = None) -> Tracker:
+    """A tracker of the configured backend, with the state as of now"""
+    settings = settings or get_settings()
+    if settings.tracker_backend == "redis":
+        # redis is only imported by the workers sharing their state
+        from ltd_invoice.redis_tracker import RedisTracker
+
+        return RedisTracker(settings)
+    return Tracker(settings)
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from ltd_invoice.settings import get_settings
+
+# ltd_invoice.celeryapp reads the broker when imported
+os.environ.setdefault("CELERY_BROKER", "memory://")
+os.environ.setdefault("CELERY_RESULT_BACKEND", "cache+memory://")
+
+ENVIRONMENT = {
+    "BOOKKEPPING_DATE_FORMAT": "%Y-%m-%d",
+    "BOOKKEPPING_PLATFORM_PASS": "secret",
+    "BOOKKEPPING_PLATFORM_URL": "http://bookkeeping.test",
+    "BOOKKEPPING_PLATFORM_USER": "user@ltd.com",
+    "EMAIL_DATE_FORMAT": "%a, %d %b %Y %H:%M:%S %z (%Z)",
+    "FROM_EMAIL_FILTER": "invoices@agency.com",
+    "GMAIL_LABEL_4_INVOICES": "Label_1",
+    "GMAIL_USER_ID": "me",
+    "GOOGLE_API_SCOPE": "https://mail.google.com/",
+    "INVOICE_DIR": ".",
+    "MESSAGE_SNIPPET_FILTER": "Self bill invoice",
+    "PDF_INVOICE_DATE_FORMAT": "%d/%m/%Y",
+    "SELENIUM_WEBDRIVER": "local",
+}
+
+
+@pytest.fixture(autouse=True)
+def fresh_settings():
+    # every test loads the settings from its own environment
+    get_settings.cache_clear()
+    yield
+    get_settings.cache_clear()
+
+
+@pytest.fixture
+def environment(monkeypatch):
+    for key, value in ENVIRONMENT.items():
+        monkeypatch.setenv(key, value)
+    return ENVIRONMENT
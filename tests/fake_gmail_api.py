@@ -0,0 +1,129 @@
+"""Local aiohttp stand-in for the Gmail REST endpoints
+
+Kept apart from tests.fakes, aiohttp is an optional dependency.
+"""
+import asyncio
+import threading
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+from googleapiclient.errors import HttpError
+
+from tests.fakes import FakeAttachments, FakeGmailResource, FakeHistory
+
+
+class FakeGmailApi:
+    """Serve the messages of a FakeGmailResource over HTTP
+
+    Keeps count of the requests in flight, to check the client's limit.
+    """
+
+    def __init__(
+        self,
+        messages: List[Dict[str, Any]],
+        attachments: Optional[Dict[str, bytes]] = None,
+        oldest_history_id: int = 0,
+        latency: float = 0.0,
+    ) -> None:
+        self.resource = FakeGmailResource(
+            messages, attachments, oldest_history_id
+        )
+        self.latency = latency
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.tokens: List[str] = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.runner: Optional[web.AppRunner] = None
+        self.port = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/gmail/v1/"
+
+    def __enter__(self) -> "FakeGmailApi":
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        asyncio.run_coroutine_threadsafe(self.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def start(self) -> None:
+        app = web.Application(middlewares=[self.track])
+        prefix = "/gmail/v1/users/{user_id}"
+        app.router.add_get(f"{prefix}/messages", self.list_messages)
+        app.router.add_get(f"{prefix}/messages/{{id}}", self.get_message)
+        app.router.add_get(
+            f"{prefix}/messages/{{message_id}}/attachments/{{id}}",
+            self.get_attachment,
+        )
+        app.router.add_get(f"{prefix}/history", self.list_history)
+        app.router.add_get(f"{prefix}/profile", self.get_profile)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]  # type: ignore
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    @web.middleware
+    async def track(self, request: web.Request, handler: Any) -> Any:
+        self.requests += 1
+        self.tokens.append(request.headers.get("Authorization", ""))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            return await handler(request)
+        finally:
+            self.in_flight -= 1
+
+    @staticmethod
+    def page_params(request: web.Request) -> Dict[str, Any]:
+        return dict(
+            maxResults=int(request.query.get("maxResults", 100)),
+            pageToken=request.query.get("pageToken"),
+        )
+
+    async def list_messages(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            self.resource._list(**self.page_params(request))
+        )
+
+    async def get_message(self, request: web.Request) -> web.Response:
+        try:
+            return web.json_response(
+                self.resource._get(
+                    id=request.match_info["id"],
+                    fields=request.query.get("fields"),
+                )
+            )
+        except HttpError:
+            raise web.HTTPNotFound(text="Requested entity was not found.")
+
+    async def get_profile(self, request: web.Request) -> web.Response:
+        return web.json_response(self.resource._get_profile())
+
+    async def get_attachment(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            FakeAttachments(self.resource)._get(id=request.match_info["id"])
+        )
+
+    async def list_history(self, request: web.Request) -> web.Response:
+        try:
+            return web.json_response(
+                FakeHistory(self.resource)._list(
+                    startHistoryId=request.query["startHistoryId"],
+                    **self.page_params(request),
+                )
+            )
+        except HttpError:
+            raise web.HTTPNotFound(text="Requested entity was not found.")
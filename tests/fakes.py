@@ -0,0 +1,777 @@
+import base64
+import csv
+import email.parser
+import email.policy
+import io
+import threading
+import time
+import urllib.parse
+import uuid
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import httplib2
+from googleapiclient.errors import HttpError
+from selenium.common.exceptions import (
+    NoSuchElementException,
+    WebDriverException,
+)
+
+from ltd_invoice.bookkepping import (
+    FILL_FORM_SCRIPT,
+    FORM_OPTIONS_SCRIPT,
+    READ_FORM_SCRIPT,
+)
+
+
+def make_raw_message(
+    message_id: str,
+    date: str = "Tue, 8 Mar 2022 11:53:45 +0000 (GMT)",
+    snippet: str = "Self bill invoice attached",
+    sender: str = "invoices@agency.com",
+    history_id: str = "1000",
+) -> Dict[str, Any]:
+    return {
+        "id": message_id,
+        "threadId": f"thread-{message_id}",
+        "historyId": history_id,
+        "snippet": snippet,
+        "payload": {
+            "body": {"size": 0},
+            "headers": [
+                {"name": "Date", "value": date},
+                {"name": "From", "value": sender},
+                {"name": "To", "value": "myself@gmail.com"},
+                {"name": "Subject", "value": f"Invoice {message_id}"},
+            ],
+            "parts": [
+                {"partId": "0", "mimeType": "text/html", "body": {}},
+                {
+                    "partId": "1",
+                    "mimeType": "application/pdf",
+                    "filename": "invoice.pdf",
+                    "body": {"attachmentId": f"attachment-{message_id}"},
+                },
+            ],
+        },
+    }
+
+
+class FakeRequest:
+    def __init__(
+        self,
+        resource: "FakeGmailResource",
+        handler: Callable[..., Dict[str, Any]],
+        **kwargs: Any,
+    ) -> None:
+        self.resource = resource
+        self.handler = handler
+        self.kwargs = kwargs
+
+    def execute(self, http: Any = None) -> Dict[str, Any]:
+        self.resource.round_trip()
+        return self.handler(**self.kwargs)
+
+
+class FakeBatchRequest:
+    def __init__(
+        self, resource: "FakeGmailResource", callback: Callable[..., None]
+    ) -> None:
+        self.resource = resource
+        self.callback = callback
+        self.requests: List[Any] = []
+
+    def add(
+        self,
+        request: FakeRequest,
+        callback: Any = None,
+        request_id: Any = None,
+    ) -> None:
+        self.requests.append((request_id, request))
+
+    def execute(self, http: Any = None) -> None:
+        self.resource.round_trip()
+        self.resource.batch_sizes.append(len(self.requests))
+        # googleapiclient does not guarantee callback order
+        for request_id, request in reversed(self.requests):
+            try:
+                response = request.handler(**request.kwargs)
+            except HttpError as e:
+                self.callback(request_id, None, e)
+            else:
+                self.callback(request_id, response, None)
+
+
+class FakeGmailResource:
+    """In-memory stand-in for the discovery Resource of the Gmail API"""
+
+    def __init__(
+        self,
+        messages: List[Dict[str, Any]],
+        attachments: Optional[Dict[str, bytes]] = None,
+        oldest_history_id: int = 0,
+        latency: float = 0.0,
+    ) -> None:
+        self.messages_by_id = {message["id"]: message for message in messages}
+        self.attachments_by_id = attachments or {
+            f"attachment-{message['id']}": f"%PDF {message['id']}".encode()
+            for message in messages
+        }
+        self.oldest_history_id = oldest_history_id
+        # where the mailbox history stands, getProfile returns it
+        self.history_id = str(
+            max(
+                (int(message["historyId"]) for message in messages),
+                default=oldest_history_id,
+            )
+        )
+        # still in the history, but gone from the mailbox
+        self.deleted_ids: Set[str] = set()
+        self.latency = latency
+        self.round_trips = 0
+        self.batch_sizes: List[int] = []
+        self.list_calls: List[Dict[str, Any]] = []
+        self.get_calls: List[Dict[str, Any]] = []
+        self.attachment_calls: List[str] = []
+
+    def round_trip(self) -> None:
+        self.round_trips += 1
+        time.sleep(self.latency)
+
+    # users().messages().attachments() all resolve to this object
+    def users(self) -> "FakeGmailResource":
+        return self
+
+    def messages(self) -> "FakeGmailResource":
+        return self
+
+    def attachments(self) -> "FakeAttachments":
+        return FakeAttachments(self)
+
+    def history(self) -> "FakeHistory":
+        return FakeHistory(self)
+
+    def getProfile(self, **kwargs: Any) -> FakeRequest:
+        return FakeRequest(self, self._get_profile, **kwargs)
+
+    def _get_profile(self, **kwargs: Any) -> Dict[str, Any]:
+        return {
+            "emailAddress": "myself@gmail.com",
+            "historyId": self.history_id,
+        }
+
+    def list(self, **kwargs: Any) -> FakeRequest:
+        return FakeRequest(self, self._list, **kwargs)
+
+    def get(self, **kwargs: Any) -> FakeRequest:
+        return FakeRequest(self, self._get, **kwargs)
+
+    def new_batch_http_request(
+        self, callback: Callable[..., None]
+    ) -> FakeBatchRequest:
+        return FakeBatchRequest(self, callback)
+
+    def _list(
+        self,
+        maxResults: int = 100,
+        pageToken: Optional[str] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        self.list_calls.append(
+            dict(maxResults=maxResults, pageToken=pageToken)
+        )
+        start = int(pageToken or 0)
+        end = start + maxResults
+        message_ids = [
+            message_id
+            for message_id in self.messages_by_id
+            if message_id not in self.deleted_ids
+        ]
+        response: Dict[str, Any] = {
+            "messages": [
+                {"id": message_id, "threadId": f"thread-{message_id}"}
+                for message_id in message_ids[start:end]
+            ],
+            "resultSizeEstimate": len(message_ids),
+        }
+        if end < len(message_ids):
+            response["nextPageToken"] = str(end)
+        return response
+
+    def _get(self, id: str, **kwargs: Any) -> Dict[str, Any]:
+        self.get_calls.append(dict(id=id, **kwargs))
+        if id in self.deleted_ids:
+            raise HttpError(
+                httplib2.Response({"status": 404}),
+                b"Requested entity was not found.",
+                uri=f"users/me/messages/{id}",
+            )
+        return self.messages_by_id[id]
+
+
+class FakeAttachments:
+    def __init__(self, resource: FakeGmailResource) -> None:
+        self.resource = resource
+
+    def get(self, **kwargs: Any) -> FakeRequest:
+        return FakeRequest(self.resource, self._get, **kwargs)
+
+    def _get(self, id: str, **kwargs: Any) -> Dict[str, Any]:
+        self.resource.attachment_calls.append(id)
+        return {
+            "data": base64.urlsafe_b64encode(
+                self.resource.attachments_by_id[id]
+            ).decode()
+        }
+
+
+class FakeHistory:
+    def __init__(self, resource: FakeGmailResource) -> None:
+        self.resource = resource
+
+    def list(self, **kwargs: Any) -> FakeRequest:
+        return FakeRequest(self.resource, self._list, **kwargs)
+
+    def _list(
+        self,
+        startHistoryId: str,
+        maxResults: int = 100,
+        pageToken: Optional[str] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        if int(startHistoryId) < self.resource.oldest_history_id:
+            raise HttpError(
+                httplib2.Response({"status": 404}),
+                b"Requested entity was not found.",
+            )
+        history = [
+            {
+                "id": message["historyId"],
+                "messagesAdded": [
+                    {
+                        "message": {
+                            "id": message["id"],
+                            "threadId": message["threadId"],
+                        }
+                    }
+                ],
+            }
+            for message in self.resource.messages_by_id.values()
+            if int(message["historyId"]) > int(startHistoryId)
+        ]
+        start = int(pageToken or 0)
+        end = start + maxResults
+        response: Dict[str, Any] = {
+            "history": history[start:end],
+            "historyId": max(
+                (record["id"] for record in history), default=startHistoryId
+            ),
+        }
+        if end < len(history):
+            response["nextPageToken"] = str(end)
+        return response
+
+
+INVOICE_FIELDS = dict(
+    client_name="ACME LIMITED",
+    invoice_date="01/03/2022",
+    timesheet_id="TS_123456",
+    hours_worked="37:30",
+    hour_rate="25.00",
+    invoice_number="SB-000123",
+    net_value="937.50",
+    vat_value="187.50",
+    vat_rate="20.00",
+    gross_value="1,125.00",
+    payment_due_date="31/03/2022",
+)
+
+
+def make_invoice_lines(**fields: str) -> List[str]:
+    """Text of a self bill invoice, in the layout InvoicePattern expects"""
+    values = {**INVOICE_FIELDS, **fields}
+    return [
+        "SELF BILL INVOICE",
+        values["client_name"],
+        f"Date: {values['invoice_date']}",
+        f"Sheet: {values['timesheet_id']}",
+        f"Week work {values['hours_worked']} hrs",
+        "STD",
+        values["hour_rate"],
+        f"SELF BILL INVOICE Number: {values['invoice_number']}",
+        f"Net {values['net_value']}",
+        f"VAT {values['vat_value']}",
+        f"Rate {values['vat_rate']}",
+        f"Gross {values['gross_value']}",
+        f"Amount is due by {values['payment_due_date']}",
+    ]
+
+
+def make_pdf(pages: List[List[str]]) -> bytes:
+    """Minimal PDF with one text box per line"""
+    page_ids = [4 + 2 * index for index in range(len(pages))]
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [%s] /Count %d >>"
+        % (b" ".join(b"%d 0 R" % i for i in page_ids), len(pages)),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for page_id, lines in zip(page_ids, pages):
+        content = b"\n".join(
+            b"BT /F1 11 Tf 72 %d Td (%s) Tj ET"
+            % (
+                800 - 40 * index,
+                line.replace("\\", "\\\\")
+                .replace("(", "\\(")
+                .replace(")", "\\)")
+                .encode("latin-1"),
+            )
+            for index, line in enumerate(lines)
+        )
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % (page_id + 1)
+        )
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream"
+            % (len(content), content)
+        )
+
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    return bytes(pdf)
+
+
+def make_invoice_pdf(extra_pages: int = 0, **fields: str) -> bytes:
+    terms = [
+        f"Term {number}: the agency may amend this self bill at any time."
+        for number in range(18)
+    ]
+    return make_pdf([make_invoice_lines(**fields)] + [terms] * extra_pages)
+
+
+class FakeElement:
+    def __init__(self, driver: "FakeWebDriver", name: str) -> None:
+        self.driver = driver
+        self.name = name
+        self.value = ""
+
+    def send_keys(self, *keys: str) -> None:
+        self.value += "".join(keys)
+
+    def is_displayed(self) -> bool:
+        return True
+
+    def is_enabled(self) -> bool:
+        return True
+
+    def click(self) -> None:
+        self.driver.clicks.append(self.name)
+        if self.name == "kt_login_singin_form_submit_button":
+            self.driver.logged_in = True
+
+
+class FakeWebDriver:
+    """Just enough of a remote WebDriver to log in, load pages and click"""
+
+    # elements never found, the popup is gone as soon as it's confirmed
+    MISSING_ELEMENTS = {"swal2-popup"}
+    # option text -> value of the dropdowns of the invoice form
+    FORM_OPTIONS = {
+        "client": {"Select a client": "", "ACME LIMITED": "17"},
+        "Service": {"Timesheet": "3", "Expenses": "4"},
+        "Type": {"Hours": "1", "Days": "2"},
+        "Vat": {"0%": "0", "20%": "20"},
+    }
+
+    def __init__(self) -> None:
+        self.alive = True
+        self.logged_in = False
+        self.pages: List[str] = []
+        self.clicks: List[str] = []
+        self.elements: Dict[str, FakeElement] = {}
+        self.form_resets = 0
+        self.quit_calls = 0
+        self.scripts: List[str] = []
+
+    @property
+    def current_url(self) -> str:
+        if not self.alive:
+            raise WebDriverException("Session timed out")
+        return self.pages[-1] if self.pages else "about:blank"
+
+    def get(self, url: str) -> None:
+        self.pages.append(url)
+
+    def get_window_size(self) -> Dict[str, int]:
+        return {"width": 1024, "height": 768}
+
+    def maximize_window(self) -> None:
+        pass
+
+    def element(self, name: str) -> FakeElement:
+        return self.elements.setdefault(name, FakeElement(self, name))
+
+    def find_element(self, by: str, value: str) -> FakeElement:
+        if value in self.MISSING_ELEMENTS or (
+            value == "UserName" and self.logged_in
+        ):
+            raise NoSuchElementException(value)
+        return self.element(value)
+
+    def find_elements(self, by: str, value: str) -> List[FakeElement]:
+        try:
+            return [self.find_element(by, value)]
+        except NoSuchElementException:
+            return []
+
+    def execute_script(self, script: str, *args: Any) -> Any:
+        self.scripts.append(script)
+        if script == FORM_OPTIONS_SCRIPT:
+            return {
+                name: dict(options)
+                for name, options in self.FORM_OPTIONS.items()
+                if name in args[0] and name not in self.MISSING_ELEMENTS
+            }
+        elif script == FILL_FORM_SCRIPT:
+            missing = []
+            for name, value in args[0].items():
+                if name in self.MISSING_ELEMENTS:
+                    missing.append(name)
+                else:
+                    self.element(name).value = value
+            return missing
+        elif script == READ_FORM_SCRIPT:
+            return {name: self.element(name).value for name in args[0]}
+        elif script == "arguments[0].click();":
+            args[0].click()
+        elif "form.reset()" in script:
+            self.form_resets += 1
+            return True
+        return None
+
+    def quit(self) -> None:
+        self.quit_calls += 1
+        self.alive = False
+
+    def close(self) -> None:
+        self.alive = False
+
+
+LOGIN_PAGE = """<html><body>
+<form id="kt_login_signin_form" method="post" action="/">
+<input type="hidden" name="__RequestVerificationToken" value="{token}">
+<input type="text" name="UserName">
+<input type="password" name="UserPassword">
+<button id="kt_login_singin_form_submit_button" type="submit">Sign In</button>
+</form>
+</body></html>"""
+
+INVOICE_PAGE = """<html><body>
+<form id="invoice_form" method="post" action="/salesinvoice/save">
+<input type="hidden" name="__RequestVerificationToken" value="{token}">
+<select id="client" name="ClientId">
+<option value="">Select a client</option>
+{clients}
+</select>
+<textarea id="INVOICE_NOTE" name="InvoiceNote"></textarea>
+<input id="INVOICE_DATE" name="InvoiceDate" readonly>
+<input id="INVOICE_DUE_ON" name="InvoiceDueOn" readonly>
+<select id="Service" name="ServiceId">
+<option value="3">Timesheet</option>
+<option value="4">Expenses</option>
+</select>
+<select id="Type" name="RateType">
+<option value="1">Hours</option>
+<option value="2">Days</option>
+</select>
+<select id="Vat" name="VatRate">
+<option value="0">0%</option>
+<option value="20" selected>20%</option>
+</select>
+<input id="Workdescription" name="Workdescription">
+<input id="Quantity" name="Quantity">
+<input id="Rate" name="Rate">
+<textarea id="CUSTOMER_NOTE" name="CustomerNote"></textarea>
+<textarea id="Terms" name="Terms">
+Net 30</textarea>
+<input id="SendEmail" type="checkbox" name="SendEmail" value="1">
+<input id="Currency-GBP" type="radio" name="Currency" value="GBP" checked>
+<input id="Currency-EUR" type="radio" name="Currency" value="EUR">
+<input id="0" type="radio" name="SendOption" value="0" checked>
+<input id="1" type="radio" name="SendOption" value="1">
+<button id="btnSaveInvoice" type="button">Save</button>
+</form>
+<script>
+document.getElementById("btnSaveInvoice").addEventListener("click", () => {
+  const popup = document.createElement("div");
+  popup.className = "swal2-popup";
+  popup.innerHTML = '<button class="swal2-confirm" type="button">OK</button>';
+  popup.querySelector(".swal2-confirm").addEventListener("click", () => {
+    document.getElementById("invoice_form").submit();
+  });
+  document.body.appendChild(popup);
+});
+</script>
+</body></html>"""
+
+INVOICE_FORM_FIELDS = (
+    "__RequestVerificationToken",
+    "ClientId",
+    "InvoiceNote",
+    "InvoiceDate",
+    "InvoiceDueOn",
+    "ServiceId",
+    "RateType",
+    "VatRate",
+    "Workdescription",
+    "Quantity",
+    "Rate",
+    "CustomerNote",
+)
+
+
+def parse_multipart(
+    content_type: str, body: bytes
+) -> Tuple[Dict[str, str], str]:
+    """Fields and uploaded file content of a multipart/form-data body"""
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+    )
+    form, content = {}, ""
+    for part in message.iter_parts():
+        value = part.get_content()
+        if isinstance(value, bytes):
+            value = value.decode()
+        if part.get_filename():
+            content = value
+        else:
+            form[part.get_param("name", header="content-disposition")] = value
+    return form, content
+
+
+class FakeBookkeepingServer:
+    """Local stand-in for the login and invoice pages of the platform"""
+
+    TOKEN = "csrf-token"
+
+    def __init__(
+        self,
+        user: str = "user@ltd.com",
+        password: str = "secret",
+        clients: Optional[Dict[str, str]] = None,
+        latency: float = 0.0,
+        form_after_save: bool = False,
+        redirect_after_save: bool = True,
+        rejects_invoices: bool = False,
+    ) -> None:
+        self.user = user
+        self.password = password
+        self.clients = clients or {"17": "ACME LIMITED", "18": "GLOBEX LTD"}
+        self.latency = latency
+        # answer a save with a new invoice form, like a "save and new"
+        self.form_after_save = form_after_save
+        # or with a page of its own, instead of redirecting
+        self.redirect_after_save = redirect_after_save
+        # every invoice fails validation, the form comes back with errors
+        self.rejects_invoices = rejects_invoices
+        self.sessions: Set[str] = set()
+        self.logins = 0
+        self.invoices: List[Dict[str, str]] = []
+        self.page_loads = 0
+        self.imports = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(
+            ("127.0.0.1", 0), self.handler_class()
+        )
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever,
+            kwargs=dict(poll_interval=0.05),
+            daemon=True,
+        )
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "FakeBookkeepingServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def expire_sessions(self) -> None:
+        self.sessions.clear()
+
+    def login_page(self) -> str:
+        return LOGIN_PAGE.format(token=self.TOKEN)
+
+    def invoice_page(self, errors: str = "") -> str:
+        # not format, the page script has braces of its own
+        return (
+            INVOICE_PAGE.replace("{token}", self.TOKEN)
+            .replace(
+                "{clients}",
+                "\n".join(
+                    f'<option value="{value}">{name}</option>'
+                    for value, name in self.clients.items()
+                ),
+            )
+            .replace("<body>", f"<body>{errors}", 1)
+        )
+
+    def login(self, form: Dict[str, str]) -> Optional[str]:
+        if (
+            form.get("UserName") != self.user
+            or form.get("UserPassword") != self.password
+            or form.get("__RequestVerificationToken") != self.TOKEN
+        ):
+            return None
+        session_id = uuid.uuid4().hex
+        with self.lock:
+            self.logins += 1
+            self.sessions.add(session_id)
+        return session_id
+
+    def save_invoice(self, form: Dict[str, str]) -> bool:
+        if any(not form.get(name) for name in INVOICE_FORM_FIELDS) or (
+            form["ClientId"] not in self.clients
+        ):
+            return False
+        with self.lock:
+            self.invoices.append(form)
+        return True
+
+    def import_invoices(self, form: Dict[str, str], content: str) -> bool:
+        if form.get("__RequestVerificationToken") != self.TOKEN:
+            return False
+        rows = list(csv.DictReader(io.StringIO(content, newline="")))
+        if not rows or not all(
+            self.save_invoice({**form, **row}) for row in rows
+        ):
+            return False
+        with self.lock:
+            self.imports += 1
+        return True
+
+    def handler_class(self) -> type:
+        return type(
+            "Handler", (BookkeepingRequestHandler,), {"bookkeeping": self}
+        )
+
+
+class BookkeepingRequestHandler(BaseHTTPRequestHandler):
+    bookkeeping: "FakeBookkeepingServer"
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+    def session_id(self) -> Optional[str]:
+        cookie = SimpleCookie(self.headers.get("Cookie", ""))
+        if "session" in cookie:
+            return cookie["session"].value
+        return None
+
+    def is_logged(self) -> bool:
+        return self.session_id() in self.bookkeeping.sessions
+
+    def form(self) -> Dict[str, str]:
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        return dict(urllib.parse.parse_qsl(body.decode()))
+
+    def respond(
+        self,
+        body: str,
+        status: int = 200,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        time.sleep(self.bookkeeping.latency)
+        content = body.encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def redirect(self, location: str, **headers: str) -> None:
+        self.respond("", 302, {"Location": location, **headers})
+
+    def do_GET(self) -> None:
+        if not self.is_logged():
+            self.respond(self.bookkeeping.login_page())
+        elif self.path == "/salesinvoice/show":
+            with self.bookkeeping.lock:
+                self.bookkeeping.page_loads += 1
+            self.respond(self.bookkeeping.invoice_page())
+        elif self.path == "/salesinvoice/new":
+            self.respond(self.bookkeeping.invoice_page())
+        else:
+            self.respond("<html><body>Dashboard</body></html>")
+
+    def do_POST(self) -> None:
+        if self.path == "/":
+            session_id = self.bookkeeping.login(self.form())
+            if session_id is None:
+                self.respond(self.bookkeeping.login_page())
+            else:
+                self.redirect(
+                    "/dashboard",
+                    **{"Set-Cookie": f"session={session_id}; Path=/"},
+                )
+        elif self.path == "/salesinvoice/save":
+            if not self.is_logged():
+                self.redirect("/")
+            elif self.bookkeeping.rejects_invoices:
+                self.form()
+                self.respond(
+                    self.bookkeeping.invoice_page(
+                        errors='<div class="validation-summary-errors">'
+                        "Invoice date is not valid</div>"
+                    )
+                )
+            elif not self.bookkeeping.save_invoice(self.form()):
+                self.respond("Invalid invoice", 400)
+            elif not self.bookkeeping.redirect_after_save:
+                self.respond("<html><body>Invoice saved</body></html>")
+            elif self.bookkeeping.form_after_save:
+                self.redirect("/salesinvoice/new")
+            else:
+                self.redirect("/salesinvoice/list")
+        elif self.path == "/salesinvoice/import":
+            if not self.is_logged():
+                self.redirect("/")
+                return
+            form, content = parse_multipart(
+                self.headers["Content-Type"],
+                self.rfile.read(int(self.headers["Content-Length"])),
+            )
+            if self.bookkeeping.rejects_invoices:
+                self.respond(
+                    '<html><body><div class="validation-summary-errors">'
+                    "Invoice date is not valid</div></body></html>"
+                )
+            elif not self.bookkeeping.import_invoices(form, content):
+                self.respond("Invalid import", 400)
+            elif not self.bookkeeping.redirect_after_save:
+                self.respond("<html><body>Invoice saved</body></html>")
+            else:
+                self.redirect("/salesinvoice/list")
+        else:
+            self.respond("Not found", 404)
@@ -0,0 +1,164 @@
+import pytest
+from selenium.common.exceptions import (
+    InvalidElementStateException,
+    NoSuchElementException,
+    TimeoutException,
+)
+
+from ltd_invoice.bookkepping import (
+    FILL_FORM_SCRIPT,
+    FORM_OPTIONS_SCRIPT,
+    READ_FORM_SCRIPT,
+    Bookkeper,
+)
+from ltd_invoice.pdf_parse import Invoice
+from ltd_invoice.submissions import SubmissionStateUnknown
+from tests.fakes import INVOICE_FIELDS, FakeWebDriver
+
+
+@pytest.fixture
+def driver():
+    return FakeWebDriver()
+
+
+@pytest.fixture
+def bookkeper(environment, driver):
+    return Bookkeper(driver=driver)
+
+
+def test_login_and_page_load_are_timed(bookkeper, driver):
+    bookkeper.open_invoice_page()
+
+    assert driver.elements["UserName"].value == "user@ltd.com"
+    assert driver.elements["UserPassword"].value == "secret"
+    assert set(bookkeper.timings) == {"login", "page_load"}
+    assert all(duration >= 0 for duration in bookkeper.timings.values())
+
+
+def test_submit_invoice(bookkeper, driver):
+    bookkeper.submit_invoice()
+
+    assert driver.clicks == ["btnSaveInvoice", "1", "swal2-confirm"]
+    assert {"submit", "popup_confirm"} <= set(bookkeper.timings)
+
+
+def test_missing_element_times_out(environment, monkeypatch, driver):
+    monkeypatch.setenv("SELENIUM_WAIT_TIMEOUT", "0.1")
+    monkeypatch.setattr(
+        FakeWebDriver, "MISSING_ELEMENTS", {"swal2-popup", "btnSaveInvoice"}
+    )
+    bookkeper = Bookkeper(driver=driver)
+
+    with pytest.raises(TimeoutException):
+        bookkeper.submit_invoice()
+    assert "submit" in bookkeper.timings
+
+
+def test_failure_after_save_leaves_the_state_unknown(
+    environment, monkeypatch, driver
+):
+    monkeypatch.setenv("SELENIUM_WAIT_TIMEOUT", "0.1")
+    monkeypatch.setattr(FakeWebDriver, "MISSING_ELEMENTS", {"swal2-confirm"})
+    bookkeper = Bookkeper(driver=driver)
+
+    with pytest.raises(SubmissionStateUnknown):
+        bookkeper.submit_invoice()
+    assert driver.clicks == ["btnSaveInvoice", "1"]
+
+
+def test_register_invoices_keeps_the_form_page_open(
+    monkeypatch, bookkeper, driver
+):
+    filled = []
+    monkeypatch.setattr(bookkeper, "fill_invoice", filled.append)
+    invoices = [
+        Invoice.from_fields(b"", {**INVOICE_FIELDS, "invoice_number": str(n)})
+        for n in range(3)
+    ]
+
+    registered = list(bookkeper.register_invoices(invoices))
+
+    assert registered == filled == invoices
+    invoice_pages = [url for url in driver.pages if url.endswith("/show")]
+    assert len(invoice_pages) == 1
+    assert driver.form_resets == 3
+    assert driver.clicks.count("btnSaveInvoice") == 3
+
+
+def make_invoice(**fields):
+    return Invoice.from_fields(b"", {**INVOICE_FIELDS, **fields})
+
+
+def test_fast_fill_takes_one_script_and_one_read_back(
+    environment, monkeypatch, driver
+):
+    monkeypatch.setenv("SELENIUM_FAST_FILL", "true")
+    bookkeper = Bookkeper(driver=driver)
+    invoice = make_invoice()
+
+    bookkeper.fill_invoice(invoice)
+    bookkeper.fill_invoice(invoice)
+
+    # the dropdown options are read once per session
+    assert driver.scripts == [
+        FORM_OPTIONS_SCRIPT,
+        FILL_FORM_SCRIPT,
+        READ_FORM_SCRIPT,
+        FILL_FORM_SCRIPT,
+        READ_FORM_SCRIPT,
+    ]
+    values = {name: element.value for name, element in driver.elements.items()}
+    assert values == {
+        "client": "17",
+        "Service": "3",
+        "Type": "1",
+        "Vat": "20",
+        "INVOICE_NOTE": invoice.details,
+        "INVOICE_DATE": "2022-03-01",
+        "INVOICE_DUE_ON": "2022-03-31",
+        "Workdescription": "Week work",
+        "Quantity": "37.3",
+        "Rate": "25.00",
+        "CUSTOMER_NOTE": invoice.internal_note,
+    }
+    assert {"form_options", "form_fill", "form_check"} <= set(
+        bookkeper.timings
+    )
+
+
+def test_fast_fill_reads_the_options_again_for_a_new_client(
+    environment, monkeypatch, driver
+):
+    bookkeper = Bookkeper(driver=driver, fast_fill=True)
+    bookkeper.fill_invoice(make_invoice())
+    monkeypatch.setitem(
+        FakeWebDriver.FORM_OPTIONS,
+        "client",
+        {**FakeWebDriver.FORM_OPTIONS["client"], "GLOBEX LTD": "18"},
+    )
+
+    bookkeper.fill_invoice(make_invoice(client_name="GLOBEX LTD"))
+
+    assert driver.elements["client"].value == "18"
+    assert driver.scripts.count(FORM_OPTIONS_SCRIPT) == 2
+    with pytest.raises(NoSuchElementException):
+        bookkeper.fill_invoice(make_invoice(client_name="INITECH LTD"))
+
+
+def test_fast_fill_fails_when_the_form_does_not_keep_a_value(
+    environment, monkeypatch, driver
+):
+    bookkeper = Bookkeper(driver=driver, fast_fill=True)
+    execute_script = driver.execute_script
+
+    def reset_due_date(script, *args):
+        result = execute_script(script, *args)
+        if script == FILL_FORM_SCRIPT:
+            # like a date picker rejecting the value
+            driver.element("INVOICE_DUE_ON").value = ""
+        return result
+
+    monkeypatch.setattr(driver, "execute_script", reset_due_date)
+
+    with pytest.raises(InvalidElementStateException, match="INVOICE_DUE_ON"):
+        bookkeper.fill_invoice(make_invoice())
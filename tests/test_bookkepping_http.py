@@ -0,0 +1,199 @@
+import pytest
+import requests
+
+from ltd_invoice.bookkepping_http import BookkeepingHttpError, HttpBookkeper
+from ltd_invoice.pdf_parse import Invoice
+from ltd_invoice.settings import get_settings
+from ltd_invoice.submissions import SubmissionStateUnknown
+from tests.fakes import INVOICE_FIELDS, FakeBookkeepingServer
+
+
+@pytest.fixture
+def server(environment, monkeypatch):
+    with FakeBookkeepingServer() as server:
+        monkeypatch.setenv("BOOKKEPPING_PLATFORM_URL", server.url)
+        yield server
+
+
+@pytest.fixture
+def invoice(environment):
+    return Invoice.from_fields(b"", INVOICE_FIELDS)
+
+
+class FallbackBookkeper:
+    def __init__(self):
+        self.invoices = []
+
+    def register_invoice(self, invoice):
+        self.invoices.append(invoice)
+
+
+def test_register_invoice(server, invoice):
+    bookkeper = HttpBookkeper()
+
+    bookkeper.register_invoice(invoice)
+    bookkeper.register_invoice(invoice)
+
+    assert server.logins == 1
+    assert len(server.invoices) == 2
+    saved = server.invoices[0]
+    assert saved["ClientId"] == "17"
+    assert saved["ServiceId"] == "3"
+    assert saved["RateType"] == "1"
+    assert saved["VatRate"] == "20"
+    assert saved["InvoiceDate"] == "2022-03-01"
+    assert saved["InvoiceDueOn"] == "2022-03-31"
+    assert saved["Quantity"] == "37.3"
+    assert saved["Rate"] == "25.00"
+    assert saved["InvoiceNote"] == invoice.details
+    assert saved["CustomerNote"] == invoice.internal_note
+    # what the browser posts of the fields left as they are
+    assert saved["Terms"] == "Net 30"
+    assert saved["Currency"] == "GBP"
+    assert "SendEmail" not in saved
+    assert saved["SendOption"] == "1"
+    assert set(bookkeper.timings) == {"login", "page_load", "submit"}
+
+
+def test_expired_session_logs_in_again(server, invoice):
+    bookkeper = HttpBookkeper()
+    bookkeper.register_invoice(invoice)
+    server.expire_sessions()
+
+    bookkeper.register_invoice(invoice)
+
+    assert server.logins == 2
+    assert len(server.invoices) == 2
+
+
+@pytest.mark.parametrize(
+    "environ,fields",
+    [
+        pytest.param(
+            {"BOOKKEPPING_PLATFORM_PASS": "wrong"}, {}, id="login failure"
+        ),
+        pytest.param({}, {"client_name": "INITECH"}, id="unknown client"),
+    ],
+)
+def test_falls_back_to_selenium(server, monkeypatch, environ, fields):
+    for key, value in environ.items():
+        monkeypatch.setenv(key, value)
+    invoice = Invoice.from_fields(b"", {**INVOICE_FIELDS, **fields})
+
+    with pytest.raises(BookkeepingHttpError):
+        HttpBookkeper().register_invoice(invoice)
+
+    fallback = FallbackBookkeper()
+    HttpBookkeper(fallback=lambda: fallback).register_invoice(invoice)
+
+    assert fallback.invoices == [invoice]
+    assert server.invoices == []
+
+
+def test_register_invoices_loads_the_form_once(server, invoice):
+    invoices = [invoice] * 5
+
+    registered = list(HttpBookkeper().register_invoices(invoices))
+
+    assert registered == invoices
+    assert len(server.invoices) == 5
+    assert server.page_loads == 1
+
+
+def test_register_invoices_posts_the_form_of_the_save_response(
+    server, invoice
+):
+    server.form_after_save = True
+
+    registered = list(HttpBookkeper().register_invoices([invoice] * 3))
+
+    assert len(registered) == len(server.invoices) == 3
+    assert server.page_loads == 1
+
+
+def test_invoice_form_sent_back_with_errors_is_not_saved(server, invoice):
+    # a 200 re-rendering the form, the invoice mustn't count as registered
+    server.rejects_invoices = True
+    fallback = FallbackBookkeper()
+    registered = []
+
+    with pytest.raises(SubmissionStateUnknown, match="not saved"):
+        registered.extend(
+            HttpBookkeper(fallback=lambda: fallback).register_invoices(
+                [invoice]
+            )
+        )
+
+    assert registered == []
+    assert fallback.invoices == []
+
+
+def test_unanswered_save_is_not_registered_again(server, monkeypatch, invoice):
+    fallback = FallbackBookkeper()
+    bookkeper = HttpBookkeper(fallback=lambda: fallback)
+    post = bookkeper.post
+
+    def timing_out_post(url, data):
+        if url.endswith("/salesinvoice/save"):
+            raise requests.ReadTimeout(url)
+        return post(url, data)
+
+    monkeypatch.setattr(bookkeper, "post", timing_out_post)
+
+    with pytest.raises(SubmissionStateUnknown):
+        bookkeper.register_invoice(invoice)
+    assert fallback.invoices == []
+
+
+def test_saved_marker_confirms_pages_without_redirect(
+    server, monkeypatch, invoice
+):
+    server.redirect_after_save = False
+    with pytest.raises(SubmissionStateUnknown, match="not saved"):
+        HttpBookkeper().register_invoice(invoice)
+
+    monkeypatch.setenv("BOOKKEPPING_SAVED_MARKER", "Invoice saved")
+    # the invoice loaded the settings already
+    get_settings.cache_clear()
+    HttpBookkeper().register_invoice(invoice)
+
+    assert len(server.invoices) == 2
+
+
+def test_register_invoices_logs_in_again_between_invoices(server, invoice):
+    bookkeper = HttpBookkeper()
+    registered = bookkeper.register_invoices([invoice] * 3)
+    next(registered)
+    server.expire_sessions()
+
+    assert len(list(registered)) == 2
+    assert server.logins == 2
+    assert len(server.invoices) == 3
+
+
+def test_register_invoices_with_import(server, monkeypatch, invoice):
+    monkeypatch.setenv("BOOKKEPPING_IMPORT_PATH", "/salesinvoice/import")
+    monkeypatch.setenv("BOOKKEPPING_IMPORT_BATCH_SIZE", "4")
+    # the invoice loaded the settings already
+    get_settings.cache_clear()
+    invoices = [invoice] * 6
+
+    registered = list(HttpBookkeper().register_invoices(invoices))
+
+    assert registered == invoices
+    assert server.imports == 2
+    assert len(server.invoices) == 6
+    assert server.invoices[0]["ClientId"] == "17"
+    assert server.invoices[0]["CustomerNote"] == invoice.internal_note
+
+
+def test_import_with_errors_is_not_registered(server, monkeypatch, invoice):
+    monkeypatch.setenv("BOOKKEPPING_IMPORT_PATH", "/salesinvoice/import")
+    get_settings.cache_clear()
+    server.rejects_invoices = True
+    registered = []
+
+    with pytest.raises(SubmissionStateUnknown, match="not confirmed"):
+        registered.extend(HttpBookkeper().register_invoices([invoice] * 3))
+
+    assert registered == []
@@ -0,0 +1,298 @@
+import json
+import pickle
+from datetime import datetime, timedelta
+
+import pytest
+from google.oauth2.credentials import Credentials
+from googleapiclient import discovery
+
+from ltd_invoice.gmail import MESSAGE_METADATA_FIELDS, GmailService
+from ltd_invoice.settings import get_settings
+from tests.fakes import FakeGmailResource, make_raw_message
+
+
+@pytest.fixture
+def raw_messages():
+    return [
+        make_raw_message(
+            f"msg-{day:02}",
+            date=f"Tue, {day} Mar 2022 11:53:45 +0000 (GMT)",
+        )
+        for day in (9, 3, 21, 15, 1, 28, 7)
+    ]
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 3, 7, 100])
+def test_get_emails_in_date_order(environment, raw_messages, batch_size):
+    resource = FakeGmailResource(raw_messages)
+    gmail = GmailService(service=resource, batch_size=batch_size)
+
+    emails = list(gmail.get_emails(None))
+
+    assert [email.id for email in emails] == sorted(
+        message["id"] for message in raw_messages
+    )
+    assert [email.attachment for email in emails] == [
+        f"%PDF {email.id}".encode() for email in emails
+    ]
+
+
+def test_batching_reduces_round_trips(environment, raw_messages):
+    unbatched = FakeGmailResource(raw_messages)
+    list(GmailService(service=unbatched, batch_size=1).get_emails(None))
+
+    batched = FakeGmailResource(raw_messages)
+    list(GmailService(service=batched, batch_size=50).get_emails(None))
+
+    # 1 list + 1 get per message + 1 attachment per message
+    assert unbatched.round_trips == 1 + 2 * len(raw_messages)
+    # 1 list + 1 batch of gets + 1 batch of attachments
+    assert batched.round_trips == 3
+    assert batched.batch_sizes == [len(raw_messages), len(raw_messages)]
+
+
+def test_batched_fetch_applies_snippet_filter(environment, raw_messages):
+    raw_messages.append(make_raw_message("msg-spam", snippet="Newsletter"))
+    resource = FakeGmailResource(raw_messages)
+    gmail = GmailService(service=resource, batch_size=4)
+
+    assert "msg-spam" not in {email.id for email in gmail.get_emails(None)}
+
+
+def test_settings_are_read_at_creation_only(
+    environment, raw_messages, monkeypatch
+):
+    gmail = GmailService(service=FakeGmailResource(raw_messages))
+    for key in environment:
+        monkeypatch.delenv(key)
+
+    assert len(list(gmail.get_emails(None))) == len(raw_messages)
+
+
+def test_bst_dates_are_parsed(environment):
+    raw_message = make_raw_message(
+        "msg-bst", date="Tue, 5 Apr 2022 11:53:45 +0100 (BST)"
+    )
+
+    email = GmailService.build_email_message(raw_message, b"")
+
+    assert email.date.utcoffset() == timedelta(hours=1)
+
+
+def test_email_message_is_slotted(environment):
+    email = GmailService.build_email_message(make_raw_message("msg-1"), b"")
+
+    assert not hasattr(email, "__dict__")
+    assert pickle.loads(pickle.dumps(email)) == email
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 3, 7, 500])
+def test_listing_follows_next_page_token(environment, raw_messages, page_size):
+    resource = FakeGmailResource(raw_messages)
+    gmail = GmailService(service=resource, page_size=page_size)
+
+    emails = list(gmail.get_emails(None))
+
+    assert len(emails) == len(raw_messages)
+    pages = -(-len(raw_messages) // page_size)
+    assert len(resource.list_calls) == pages
+    assert {call["maxResults"] for call in resource.list_calls} == {page_size}
+
+
+def test_listing_is_streamed(environment, raw_messages):
+    resource = FakeGmailResource(raw_messages)
+    gmail = GmailService(service=resource, page_size=2)
+
+    listing = gmail.list_messages("")
+    assert next(listing)["id"] == raw_messages[0]["id"]
+    # at most the current page and the prefetched one
+    assert len(resource.list_calls) <= 2
+    listing.close()
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_stream_emails_in_date_order(environment, raw_messages, batch_size):
+    resource = FakeGmailResource(raw_messages)
+    gmail = GmailService(
+        service=resource, batch_size=batch_size, stream_attachments=True
+    )
+
+    emails = list(gmail.get_emails(None))
+
+    assert [email.id for email in emails] == sorted(
+        message["id"] for message in raw_messages
+    )
+    assert [email.attachment for email in emails] == [
+        f"%PDF {email.id}".encode() for email in emails
+    ]
+    assert {call["fields"] for call in resource.get_calls} == {
+        MESSAGE_METADATA_FIELDS
+    }
+
+
+def test_stream_emails_downloads_attachments_lazily(environment, raw_messages):
+    resource = FakeGmailResource(raw_messages)
+    gmail = GmailService(service=resource, stream_attachments=True)
+
+    emails = gmail.get_emails(None)
+    first_email = next(emails)
+
+    assert resource.attachment_calls == [f"attachment-{first_email.id}"]
+    next(emails)
+    assert len(resource.attachment_calls) == 2
+
+
+@pytest.fixture
+def history_messages():
+    return [
+        make_raw_message(
+            f"msg-{day:02}",
+            date=f"Tue, {day} Mar 2022 11:53:45 +0000 (GMT)",
+            history_id=str(1000 + day),
+        )
+        for day in (9, 3, 21, 15, 1, 28, 7)
+    ]
+
+
+@pytest.mark.parametrize("stream_attachments", [False, True])
+def test_history_sync_only_lists_changed_messages(
+    environment, history_messages, stream_attachments
+):
+    resource = FakeGmailResource(history_messages)
+    gmail = GmailService(
+        service=resource, page_size=2, stream_attachments=stream_attachments
+    )
+
+    emails = list(gmail.get_emails(None, last_history_id="1009"))
+
+    assert [email.id for email in emails] == ["msg-15", "msg-21", "msg-28"]
+    assert [email.history_id for email in emails] == ["1015", "1021", "1028"]
+    assert resource.list_calls == []
+
+
+def test_history_sync_filters_sender(environment, history_messages):
+    history_messages.append(
+        make_raw_message(
+            "msg-other", sender="someone@else.com", history_id="1100"
+        )
+    )
+    resource = FakeGmailResource(history_messages)
+    gmail = GmailService(service=resource)
+
+    emails = list(gmail.get_emails(None, last_history_id="1000"))
+
+    assert "msg-other" not in {email.id for email in emails}
+    assert len(emails) == len(history_messages) - 1
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_history_sync_skips_deleted_messages(
+    environment, history_messages, batch_size
+):
+    resource = FakeGmailResource(history_messages)
+    resource.deleted_ids.add("msg-21")
+    gmail = GmailService(service=resource, batch_size=batch_size)
+
+    emails = list(gmail.get_emails(None, last_history_id="1009"))
+
+    assert [email.id for email in emails] == ["msg-15", "msg-28"]
+
+
+def test_history_id_is_the_one_of_the_mailbox(environment, history_messages):
+    resource = FakeGmailResource(history_messages)
+    # changed since it was added, by more than its own history id
+    resource.history_id = "1100"
+    gmail = GmailService(service=resource)
+
+    assert gmail.get_history_id() == "1100"
+
+
+def test_expired_history_falls_back_to_query(environment, history_messages):
+    resource = FakeGmailResource(history_messages, oldest_history_id=1005)
+    gmail = GmailService(service=resource)
+
+    emails = list(gmail.get_emails(None, last_history_id="1001"))
+
+    assert len(emails) == len(history_messages)
+    assert len(resource.list_calls) == 1
+
+
+@pytest.mark.parametrize("batch_size", [0, -1, 101])
+def test_invalid_batch_size(environment, batch_size):
+    with pytest.raises(ValueError):
+        GmailService(service=FakeGmailResource([]), batch_size=batch_size)
+
+
+@pytest.mark.parametrize("page_size", [0, 501])
+def test_invalid_page_size(environment, page_size):
+    with pytest.raises(ValueError):
+        GmailService(service=FakeGmailResource([]), page_size=page_size)
+
+
+def test_build_is_cached(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        discovery, "build", lambda *args, **kwargs: calls.append(kwargs)
+    )
+    monkeypatch.setattr(GmailService, "get_credentials", lambda: "creds")
+    GmailService.build.cache_clear()
+
+    GmailService.build()
+    GmailService.build()
+    GmailService.build.cache_clear()
+
+    assert calls == [dict(credentials="creds", cache_discovery=False)]
+
+
+@pytest.fixture
+def token_file(environment, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    refreshed = []
+
+    def refresh(creds, request):
+        refreshed.append(creds.token)
+        creds.token = f"token-{len(refreshed)}"
+        creds.expiry = datetime.utcnow() + timedelta(hours=1)
+
+    monkeypatch.setattr(Credentials, "refresh", refresh)
+
+    def write(expires_in):
+        expiry = datetime.utcnow() + timedelta(seconds=expires_in)
+        (tmp_path / "token.json").write_text(
+            json.dumps(
+                {
+                    "token": "token-0",
+                    "refresh_token": "refresh",
+                    "client_id": "client",
+                    "client_secret": "secret",
+                    "expiry": expiry.isoformat() + "Z",
+                }
+            )
+        )
+        return refreshed
+
+    return write
+
+
+def test_valid_token_is_not_refreshed(token_file):
+    refreshed = token_file(expires_in=3600)
+
+    assert GmailService.get_credentials().token == "token-0"
+    assert refreshed == []
+
+
+def test_token_without_expiry_does_not_expire(environment):
+    creds = Credentials(token="token-0", refresh_token="refresh")
+
+    assert not GmailService.expires_soon(creds, get_settings())
+
+
+def test_token_is_refreshed_ahead_of_expiry_once(token_file, tmp_path):
+    refreshed = token_file(expires_in=60)
+
+    assert GmailService.get_credentials().token == "token-1"
+    # the refreshed token is shared through token.json
+    assert GmailService.get_credentials().token == "token-1"
+    assert refreshed == ["token-0"]
+    saved = json.loads((tmp_path / "token.json").read_text())
+    assert saved["token"] == "token-1"
@@ -0,0 +1,106 @@
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from ltd_invoice.gmail_async import AsyncGmailService  # noqa: E402
+from ltd_invoice.invoice_cache import InvoiceCache  # noqa: E402
+from tests.fake_gmail_api import FakeGmailApi  # noqa: E402
+from tests.fakes import make_raw_message  # noqa: E402
+
+
+@pytest.fixture
+def raw_messages():
+    return [
+        make_raw_message(
+            f"msg-{day:02}",
+            date=f"Tue, {day} Mar 2022 11:53:45 +0000 (GMT)",
+            history_id=str(1000 + day),
+        )
+        for day in (9, 3, 21, 15, 1, 28, 7)
+    ]
+
+
+def async_gmail(api, **kwargs):
+    return AsyncGmailService(token="access-token", base_url=api.url, **kwargs)
+
+
+@pytest.mark.parametrize("page_size", [1, 3, 500])
+def test_get_emails_in_date_order(environment, raw_messages, page_size):
+    with FakeGmailApi(raw_messages) as api:
+        emails = list(async_gmail(api, page_size=page_size).get_emails(None))
+
+    assert [email.id for email in emails] == sorted(
+        message["id"] for message in raw_messages
+    )
+    assert [email.attachment for email in emails] == [
+        f"%PDF {email.id}".encode() for email in emails
+    ]
+    assert set(api.tokens) == {"Bearer access-token"}
+
+
+def test_downloads_are_concurrent_and_bounded(environment, raw_messages):
+    with FakeGmailApi(raw_messages, latency=0.02) as api:
+        list(async_gmail(api, concurrency=3).get_emails(None))
+
+    # 1 list + 1 get per message + 1 attachment per message
+    assert api.requests == 1 + 2 * len(raw_messages)
+    assert api.max_in_flight == 3
+
+
+def test_snippet_filter(environment, raw_messages):
+    raw_messages.append(make_raw_message("msg-spam", snippet="Newsletter"))
+
+    with FakeGmailApi(raw_messages) as api:
+        emails = list(async_gmail(api).get_emails(None))
+
+    assert "msg-spam" not in {email.id for email in emails}
+
+
+@pytest.mark.parametrize("oldest_history_id", [0, 2000])
+def test_history_listing(environment, raw_messages, oldest_history_id):
+    raw_messages.append(
+        make_raw_message("msg-other", sender="friend@mail.com")
+    )
+
+    with FakeGmailApi(
+        raw_messages, oldest_history_id=oldest_history_id
+    ) as api:
+        emails = list(
+            async_gmail(api).get_emails(
+                datetime(2022, 3, 10), last_history_id="1010"
+            )
+        )
+
+    if oldest_history_id:
+        # expired history id, the search query lists everything here
+        assert len(emails) == len(raw_messages) - 1
+    else:
+        assert [email.id for email in emails] == ["msg-15", "msg-21", "msg-28"]
+
+
+def test_cached_attachments_are_not_downloaded(
+    environment, raw_messages, tmp_path
+):
+    cache = InvoiceCache(str(tmp_path), max_bytes=2**20)
+    key = cache.key(b"%PDF msg-09")
+    cache.put(key, b"%PDF msg-09", {})
+    cache.link_message("msg-09", key)
+
+    with FakeGmailApi(raw_messages) as api:
+        list(async_gmail(api, attachment_cache=cache).get_emails(None))
+
+    assert "attachment-msg-09" not in api.resource.attachment_calls
+    assert len(api.resource.attachment_calls) == len(raw_messages) - 1
+
+
+def test_history_listing_skips_deleted_messages(environment, raw_messages):
+    with FakeGmailApi(raw_messages) as api:
+        api.resource.deleted_ids.add("msg-21")
+        gmail = async_gmail(api)
+        emails = list(gmail.get_emails(None, last_history_id="1010"))
+        history_id = gmail.get_history_id()
+
+    assert [email.id for email in emails] == ["msg-15", "msg-28"]
+    assert history_id == "1028"
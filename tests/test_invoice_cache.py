@@ -0,0 +1,121 @@
+import os
+
+import pytest
+
+from ltd_invoice import pdf_parse
+from ltd_invoice.gmail import GmailService
+from ltd_invoice.invoice_cache import InvoiceCache
+from ltd_invoice.pdf_parse import extract_invoice
+from tests.fakes import FakeGmailResource, make_invoice_pdf, make_raw_message
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return InvoiceCache(directory=str(tmp_path), max_bytes=2**20)
+
+
+@pytest.fixture
+def extractions(monkeypatch):
+    calls = []
+    extract_fields = pdf_parse.extract_fields
+
+    def spy_extract_fields(*args, **kwargs):
+        calls.append(args)
+        return extract_fields(*args, **kwargs)
+
+    monkeypatch.setattr(pdf_parse, "extract_fields", spy_extract_fields)
+    return calls
+
+
+def test_cache_hit_skips_pdf_parsing(environment, cache, extractions):
+    attachment = make_invoice_pdf()
+
+    first = extract_invoice(attachment, cache=cache)
+    second = extract_invoice(attachment, cache=cache)
+
+    assert first == second
+    assert len(extractions) == 1
+
+
+def test_get_by_message_id(environment, cache):
+    attachment = make_invoice_pdf()
+    assert cache.get_by_message_id("msg-1") is None
+
+    invoice = extract_invoice(attachment, cache=cache, message_id="msg-1")
+
+    cached_attachment, fields = cache.get_by_message_id("msg-1")
+    assert cached_attachment == attachment
+    assert fields["invoice_number"] == invoice.invoice_number
+
+
+def test_least_recently_used_are_evicted(environment, tmp_path):
+    attachments = [
+        make_invoice_pdf(invoice_number=f"SB-{number:06}")
+        for number in range(4)
+    ]
+    entry_size = len(attachments[0]) + 400
+    cache = InvoiceCache(directory=str(tmp_path), max_bytes=3 * entry_size)
+
+    for mtime, attachment in enumerate(attachments[:3]):
+        extract_invoice(attachment, cache=cache)
+        os.utime(cache.fields_path(cache.key(attachment)), (mtime, mtime))
+    # the oldest entry is used again
+    assert cache.get(cache.key(attachments[0])) is not None
+
+    extract_invoice(attachments[3], cache=cache)
+
+    cached = [cache.get(cache.key(attachment)) for attachment in attachments]
+    assert [fields is not None for fields in cached] == [
+        True,
+        False,
+        True,
+        True,
+    ]
+
+
+def test_evicted_entries_take_their_messages_along(environment, tmp_path):
+    attachments = [
+        make_invoice_pdf(invoice_number=f"SB-{number:06}")
+        for number in range(2)
+    ]
+    cache = InvoiceCache(
+        directory=str(tmp_path), max_bytes=len(attachments[0]) + 400
+    )
+
+    for number, attachment in enumerate(attachments):
+        extract_invoice(attachment, cache=cache, message_id=f"msg-{number}")
+
+    assert cache.get_by_message_id("msg-1") is not None
+    assert not os.path.exists(cache.message_path("msg-0"))
+    assert sorted(os.listdir(tmp_path / cache.MESSAGES_DIR)) == ["msg-1"]
+
+
+def test_puts_do_not_scan_the_directory(environment, cache, monkeypatch):
+    scans = []
+    scan = cache.scan
+    monkeypatch.setattr(cache, "scan", lambda: scans.append(scan()))
+    monkeypatch.setattr(cache, "SCAN_INTERVAL", 3)
+
+    for number in range(5):
+        cache.put(f"key-{number}", b"%PDF", {})
+
+    assert len(scans) == 2
+    assert cache._size == 5 * len(b"%PDF{}")
+
+
+def test_cached_attachments_are_not_downloaded(environment, cache):
+    raw_messages = [make_raw_message(f"msg-{number}") for number in range(3)]
+    resource = FakeGmailResource(raw_messages)
+    cache.put(cache.key(b"%PDF cached"), b"%PDF cached", {})
+    cache.link_message("msg-1", cache.key(b"%PDF cached"))
+    gmail = GmailService(
+        service=resource, attachment_cache=cache, batch_size=3
+    )
+
+    emails = {email.id: email for email in gmail.get_emails(None)}
+
+    assert emails["msg-1"].attachment == b"%PDF cached"
+    assert sorted(resource.attachment_calls) == [
+        "attachment-msg-0",
+        "attachment-msg-2",
+    ]
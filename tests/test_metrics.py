@@ -0,0 +1,70 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from ltd_invoice import metrics
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_stage_is_timed():
+    before = sample("ltd_invoice_stage_seconds_count", stage="pdf_parse")
+
+    with metrics.stage("pdf_parse"):
+        pass
+
+    assert (
+        sample("ltd_invoice_stage_seconds_count", stage="pdf_parse")
+        == before + 1
+    )
+
+
+def test_stage_failures_are_counted():
+    before = sample("ltd_invoice_stage_failures_total", stage="submission")
+
+    with pytest.raises(RuntimeError):
+        with metrics.stage("submission"):
+            raise RuntimeError("Could not register invoice")
+
+    assert (
+        sample("ltd_invoice_stage_failures_total", stage="submission")
+        == before + 1
+    )
+
+
+def test_backlog():
+    before = sample("ltd_invoice_backlog_emails")
+
+    metrics.emails_found(3)
+    metrics.email_done("processed")
+    metrics.email_done("skipped")
+
+    assert sample("ltd_invoice_backlog_emails") == before + 1
+    metrics.email_done("dead_letter")
+    assert sample("ltd_invoice_backlog_emails") == before
+
+
+def test_run_writes_textfile(monkeypatch, tmp_path):
+    path = tmp_path / "ltd_invoice.prom"
+    monkeypatch.setenv("METRICS_TEXTFILE", str(path))
+    before = sample("ltd_invoice_run_seconds_count")
+
+    with pytest.raises(RuntimeError):
+        with metrics.run():
+            raise RuntimeError("Gmail is down")
+
+    assert sample("ltd_invoice_run_seconds_count") == before + 1
+    text = path.read_text()
+    for stage in metrics.STAGES:
+        assert f'ltd_invoice_stage_seconds_count{{stage="{stage}"}}' in text
+    assert "ltd_invoice_backlog_emails" in text
+
+
+def test_no_textfile_by_default(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("METRICS_TEXTFILE", raising=False)
+
+    metrics.write_metrics()
+
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,112 @@
+import pickle
+from dataclasses import FrozenInstanceError
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from ltd_invoice import pdf_parse
+from ltd_invoice.pdf_parse import (
+    Invoice,
+    InvoiceParseError,
+    extract_fields_fast,
+    extract_invoice,
+    match_invoice_fields,
+)
+from tests.fakes import (
+    INVOICE_FIELDS,
+    make_invoice_lines,
+    make_invoice_pdf,
+    make_pdf,
+)
+
+
+@pytest.mark.parametrize("extra_pages", [0, 3])
+def test_fast_extraction_matches_full_extraction(environment, extra_pages):
+    attachment = make_invoice_pdf(extra_pages=extra_pages)
+
+    assert extract_invoice(attachment, fast=True) == extract_invoice(
+        attachment, fast=False
+    )
+
+
+def test_fast_extraction_falls_back_on_missing_field(environment, monkeypatch):
+    *first_page, due_date = make_invoice_lines()
+    attachment = make_pdf([first_page, [due_date]])
+    assert extract_fields_fast(attachment) is None
+
+    full_extractions = []
+    extract_text = pdf_parse.extract_text
+
+    def spy_extract_text(*args, **kwargs):
+        full_extractions.append(kwargs)
+        return extract_text(*args, **kwargs)
+
+    monkeypatch.setattr(pdf_parse, "extract_text", spy_extract_text)
+
+    invoice = extract_invoice(attachment, fast=True)
+
+    assert invoice.payment_due_date == date(2022, 3, 31)
+    assert [kwargs.get("maxpages", 0) for kwargs in full_extractions] == [
+        1,
+        0,
+    ]
+
+
+def test_match_invoice_fields():
+    fields = match_invoice_fields("\n\n".join(make_invoice_lines()))
+
+    assert fields == INVOICE_FIELDS
+
+
+@pytest.mark.parametrize("fast", [False, True])
+def test_missing_fields_are_reported(environment, fast):
+    lines = [
+        line
+        for line in make_invoice_lines()
+        if not line.startswith(("Sheet", "Gross"))
+    ]
+
+    with pytest.raises(InvoiceParseError) as error:
+        extract_invoice(make_pdf([lines]), fast=fast)
+
+    assert error.value.missing_fields == ["gross_value", "timesheet_id"]
+    assert "gross_value, timesheet_id" in str(error.value)
+
+
+def test_invoice_fields_are_typed(environment):
+    invoice = Invoice.from_fields(b"%PDF", INVOICE_FIELDS)
+
+    assert invoice.gross_value == Decimal("1125.00")
+    assert invoice.hours_worked == Decimal("37.30")
+    assert invoice.invoice_date == date(2022, 3, 1)
+    assert invoice.quantity == "37.3"
+    assert invoice.vat_percent == "20"
+    assert invoice.internal_note == (
+        "Client Name = ACME LIMITED\n"
+        "Gross Value = 1,125.00\n"
+        "Hour Rate = 25.00\n"
+        "Hours Worked = 37.3\n"
+        "Invoice Date = 2022-03-01\n"
+        "Invoice Number = SB-000123\n"
+        "Net Value = 937.50\n"
+        "Payment Due Date = 2022-03-31\n"
+        "Timesheet Id = TS_123456\n"
+        "Vat Rate = 20\n"
+        "Vat Value = 187.50"
+    )
+
+
+def test_invoice_is_slotted(environment):
+    attachment = b"%PDF"
+    invoice = Invoice.from_fields(attachment, INVOICE_FIELDS)
+
+    assert not hasattr(invoice, "__dict__")
+    assert invoice.raw_pdf is attachment
+    assert pickle.loads(pickle.dumps(invoice)) == invoice
+    with pytest.raises(FrozenInstanceError):
+        invoice.client_name = "OTHER LIMITED"
+    with pytest.raises(FrozenInstanceError):
+        invoice.unknown = "OTHER LIMITED"
+    with pytest.raises(FrozenInstanceError):
+        del invoice.client_name
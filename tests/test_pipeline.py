@@ -0,0 +1,291 @@
+import threading
+import time
+from datetime import date
+
+import pytest
+
+from ltd_invoice import pipeline
+from ltd_invoice.gmail import EmailMessage
+from ltd_invoice.pdf_parse import InvoiceParseError
+from ltd_invoice.pipeline import (
+    parse_invoices,
+    process_emails,
+    skip_processed,
+    submit_invoices,
+)
+from ltd_invoice.session_pool import SessionPool
+from ltd_invoice.settings import get_settings
+from ltd_invoice.tracker import Tracker
+from tests.fakes import make_invoice_pdf
+
+
+def email_message(number, **invoice_fields):
+    return EmailMessage(
+        id=f"msg-{number}",
+        thread_id=f"thread-{number}",
+        subject="Invoice",
+        body="",
+        attachment=make_invoice_pdf(
+            **{"invoice_number": f"SB-{number:06}", **invoice_fields}
+        ),
+        sender="invoices@agency.com",
+        receiver="myself@gmail.com",
+        date=f"Tue, {number} Mar 2022 11:53:45 +0000 (GMT)",
+    )
+
+
+@pytest.fixture
+def email_messages(environment):
+    return [email_message(number) for number in range(1, 8)]
+
+
+@pytest.mark.parametrize("workers", [0, 1, 3])
+def test_parse_invoices_keeps_email_order(email_messages, workers):
+    parsed = list(parse_invoices(email_messages, workers=workers))
+
+    assert [email.id for email, _ in parsed] == [
+        email.id for email in email_messages
+    ]
+    assert [invoice.invoice_number for _, invoice in parsed] == [
+        f"SB-{number:06}" for number in range(1, 8)
+    ]
+    # the pdf is shared with the email, not copied back from the workers
+    assert all(
+        invoice.raw_pdf is email.attachment for email, invoice in parsed
+    )
+    assert parsed[0][1].invoice_date == date(2022, 3, 1)
+
+
+def test_parse_invoices_propagates_errors(email_messages):
+    email_messages.insert(2, email_message(9, timesheet_id="missing"))
+    parsed = parse_invoices(email_messages, workers=2)
+
+    assert next(parsed)[0].id == "msg-1"
+    assert next(parsed)[0].id == "msg-2"
+    with pytest.raises(InvoiceParseError):
+        next(parsed)
+
+
+def test_skip_processed(email_messages):
+    class Tracker:
+        processed_emails = {"msg-2", "msg-5"}
+
+        def claim(self, email_id):
+            return email_id != "msg-6"
+
+    assert [
+        email.id for email in skip_processed(email_messages, Tracker())
+    ] == ["msg-1", "msg-3", "msg-4", "msg-7"]
+
+
+class FakeBookkeper:
+    registered = []
+    lock = threading.Lock()
+
+    def __init__(self, delays, failing=()):
+        self.delays = delays
+        self.failing = failing
+
+    def is_alive(self):
+        return True
+
+    def register_invoice(self, invoice):
+        time.sleep(self.delays.get(invoice, 0))
+        if invoice in self.failing:
+            raise RuntimeError(f"Could not register {invoice}")
+        with self.lock:
+            self.registered.append(invoice)
+
+    def register_invoices(self, invoices):
+        for invoice in invoices:
+            self.register_invoice(invoice)
+            yield invoice
+
+
+@pytest.fixture
+def bookkeepers():
+    FakeBookkeper.registered = []
+    return FakeBookkeper
+
+
+@pytest.mark.parametrize("workers", [1, 2, 4])
+def test_submit_invoices_yields_in_order(bookkeepers, workers):
+    invoices = [(f"email-{n}", f"invoice-{n}") for n in range(8)]
+    # the first invoices are the slowest to register
+    delays = {
+        invoice: (8 - n) * 0.01 for n, (_, invoice) in enumerate(invoices)
+    }
+    pool = SessionPool(size=workers, factory=lambda: bookkeepers(delays))
+
+    submitted = list(submit_invoices(invoices, pool=pool, workers=workers))
+
+    assert submitted == invoices
+    assert sorted(bookkeepers.registered) == sorted(i for _, i in invoices)
+
+
+def test_submit_invoices_stops_at_first_failure(bookkeepers):
+    invoices = [(f"email-{n}", f"invoice-{n}") for n in range(8)]
+    delays = {"invoice-2": 0.05}
+    pool = SessionPool(
+        size=3,
+        factory=lambda: bookkeepers(delays, failing={"invoice-2"}),
+    )
+
+    submitted = []
+    with pytest.raises(RuntimeError):
+        for email_message, invoice in submit_invoices(
+            invoices, pool=pool, workers=3
+        ):
+            submitted.append(email_message)
+
+    # whatever finished after the failure is not reported as submitted
+    assert submitted == ["email-0", "email-1"]
+
+
+def test_submit_invoices_in_bulk_uses_one_session(bookkeepers):
+    invoices = [(f"email-{n}", f"invoice-{n}") for n in range(5)]
+    sessions = []
+
+    def factory():
+        sessions.append(bookkeepers({}))
+        return sessions[-1]
+
+    pool = SessionPool(size=2, factory=factory)
+
+    submitted = list(submit_invoices(invoices, pool=pool, bulk=True))
+
+    assert submitted == invoices
+    assert len(sessions) == 1
+    assert bookkeepers.registered == [i for _, i in invoices]
+
+
+class RunTracker(Tracker):
+    """A file tracker, but other runs hold the claims of some emails"""
+
+    def __init__(self, claimed_elsewhere, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.held_elsewhere = claimed_elsewhere
+        self.released = False
+
+    def claim(self, email_id):
+        if email_id in self.held_elsewhere:
+            self.claimed_elsewhere.add(email_id)
+            return False
+        return True
+
+    def release_claims(self):
+        self.released = True
+
+
+@pytest.fixture
+def run(email_messages, tmp_path, monkeypatch):
+    """process_emails over email_messages, with the tracker it used"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("INVOICE_DIR", str(tmp_path))
+
+    class Gmail:
+        history_id = "2000"
+
+        def __init__(self, **kwargs):
+            pass
+
+        def get_history_id(self):
+            return self.history_id
+
+        def get_emails(self, last_email_processed_date, last_history_id):
+            return iter(email_messages)
+
+    monkeypatch.setattr(pipeline, "GmailService", Gmail)
+
+    trackers = []
+    registered = []
+
+    def run(failing=(), claimed_elsewhere=()):
+        def new_tracker(settings):
+            trackers.append(RunTracker(set(claimed_elsewhere), settings))
+            return trackers[-1]
+
+        failing_invoices = {f"SB-{number:06}" for number in failing}
+
+        class Bookkeper:
+            def is_alive(self):
+                return True
+
+            def register_invoice(self, invoice):
+                if invoice.invoice_number in failing_invoices:
+                    # slow enough for the next invoices to be on their way
+                    time.sleep(0.05)
+                    raise RuntimeError(f"Could not register {invoice}")
+                registered.append(invoice.invoice_number)
+
+        monkeypatch.setattr(pipeline, "new_tracker", new_tracker)
+        monkeypatch.setattr(
+            pipeline,
+            "get_session_pool",
+            lambda: SessionPool(size=3, factory=Bookkeper),
+        )
+        # every run loads the settings, as a new process does
+        get_settings.cache_clear()
+        process_emails()
+        return trackers[-1]
+
+    run.gmail = Gmail
+    run.trackers = trackers
+    run.registered = registered
+    return run
+
+
+def test_process_emails_moves_the_watermark_once_done(run):
+    tracker = run()
+
+    assert len(tracker.processed_emails) == 7
+    assert Tracker().last_email_processed_date.date() == date(2022, 3, 7)
+    # taken before the emails were listed
+    assert Tracker().last_history_id == "2000"
+    assert not tracker.released
+
+
+def test_run_without_new_emails_moves_the_history_id(run):
+    run()
+    run.gmail.history_id = "2100"
+
+    tracker = run()
+
+    assert len(run.registered) == 7
+    assert len(tracker.processed_emails) == 7
+    assert Tracker().last_email_processed_date.date() == date(2022, 3, 7)
+    assert Tracker().last_history_id == "2100"
+
+
+def test_failed_run_keeps_the_watermark_and_releases_claims(run):
+    with pytest.raises(RuntimeError):
+        run(failing=[4])
+
+    assert run.trackers[-1].released
+    tracker = Tracker()
+    assert set(tracker.processed_emails) == {"msg-1", "msg-2", "msg-3"}
+    assert tracker.last_email_processed_date is None
+
+
+def test_watermark_waits_for_emails_claimed_elsewhere(run):
+    tracker = run(claimed_elsewhere=["msg-2"])
+
+    assert "msg-2" not in tracker.processed_emails
+    assert len(tracker.processed_emails) == 6
+    assert Tracker().last_email_processed_date is None
+
+
+def test_invoices_registered_after_a_failure_are_not_registered_again(
+    run, monkeypatch
+):
+    monkeypatch.setenv("BOOKKEPPING_WORKERS", "3")
+    monkeypatch.setenv("SELENIUM_POOL_SIZE", "3")
+    with pytest.raises(RuntimeError):
+        run(failing=[2])
+    # 3 and 4 were on their way when 2 failed
+    assert sorted(run.registered) == ["SB-000001", "SB-000003", "SB-000004"]
+    assert set(Tracker().processed_emails) == {"msg-1", "msg-3", "msg-4"}
+
+    run()
+
+    assert sorted(run.registered) == [f"SB-{n:06}" for n in range(1, 8)]
@@ -0,0 +1,143 @@
+from datetime import datetime
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from ltd_invoice import redis_tracker  # noqa: E402
+from ltd_invoice.pipeline import skip_processed  # noqa: E402
+from ltd_invoice.redis_tracker import RedisTracker  # noqa: E402
+from ltd_invoice.settings import ConfigurationError  # noqa: E402
+from ltd_invoice.tracker import Tracker, new_tracker  # noqa: E402
+from tests.test_tracker import email_message  # noqa: E402
+
+
+@pytest.fixture
+def server(environment, tmp_path, monkeypatch):
+    # migrations look for the tracker files in the working directory
+    monkeypatch.chdir(tmp_path)
+    return fakeredis.FakeServer()
+
+
+def worker(server, owner=None, **kwargs):
+    """A tracker of its own, as every worker process has"""
+    tracker = RedisTracker(client=fakeredis.FakeRedis(server=server), **kwargs)
+    # workers of one test share the process, hence its owner
+    tracker.owner = owner or f"worker-{id(tracker)}"
+    return tracker
+
+
+def test_processed_emails_are_shared(server):
+    first, second = worker(server), worker(server)
+
+    first.update(email_message("a", history_id="1005"))
+    second.add_processed("b")
+
+    assert "a" in second.processed_emails
+    assert "b" in first.processed_emails
+    assert "c" not in first.processed_emails
+    assert set(first.processed_emails) == {"a", "b"}
+    assert len(second.processed_emails) == 2
+
+
+def test_an_email_is_claimed_once(server):
+    first, second = worker(server, claim_ttl=60), worker(server)
+
+    assert first.claim("a")
+    assert not second.claim("a")
+    assert second.claim("b")
+    assert 0 < first.client.ttl(first.claim_key("a")) <= 60
+    assert second.claimed_elsewhere == {"a"}
+
+
+def test_a_worker_takes_its_own_claims_again(server):
+    # a run of this worker failed and the next one lists the email again
+    worker(server, owner="host:1").claim("a")
+
+    assert worker(server, owner="host:1").claim("a")
+    assert not worker(server, owner="host:2").claim("a")
+
+
+def test_claims_of_unprocessed_emails_are_released(server):
+    first, second = worker(server), worker(server)
+    first.claim("a")
+    first.claim("b")
+    first.add_processed("a")
+
+    first.release_claims()
+
+    assert not second.claim("a")
+    assert second.claim("b")
+    # releasing never drops the claim of another worker
+    first.claims.add("b")
+    first.release_claims()
+    assert not worker(server).claim("b")
+
+
+def test_claimed_emails_are_skipped_by_other_workers(server):
+    email_messages = [email_message(f"msg-{n}") for n in range(4)]
+    first, second = worker(server), worker(server)
+    second.add_processed("msg-0")
+
+    assert [
+        email.id for email in skip_processed(email_messages[:2], first)
+    ] == ["msg-1"]
+    assert [email.id for email in skip_processed(email_messages, second)] == [
+        "msg-2",
+        "msg-3",
+    ]
+
+
+def test_watermark_only_moves_forward(server):
+    first, second = worker(server), worker(server)
+    assert first.last_email_processed_date is None
+    assert first.last_history_id is None
+
+    first.update_watermark(datetime(2022, 3, 8, 11, 53), "1005")
+    # a worker finishing later with older emails
+    second.update_watermark(datetime(2022, 3, 1, 9, 0), "1003")
+    second.update_watermark(datetime(2022, 3, 1, 9, 0), None)
+    # a run without new emails
+    second.update_watermark(None, "1007")
+
+    tracker = worker(server)
+    assert tracker.last_email_processed_date == datetime(2022, 3, 8)
+    assert tracker.last_history_id == "1007"
+
+
+def test_tracker_files_are_migrated(server):
+    tracker = Tracker()
+    tracker.update(email_message("a", history_id="1005"))
+    tracker.add_processed("b")
+
+    tracker = worker(server)
+    assert set(tracker.processed_emails) == {"a", "b"}
+    assert tracker.last_email_processed_date == datetime(2022, 3, 8)
+    assert tracker.last_history_id == "1005"
+
+    # the files are only read while Redis has no watermark
+    Tracker().add_processed("c")
+    assert "c" not in worker(server).processed_emails
+
+
+def test_new_tracker_uses_the_configured_backend(server, monkeypatch):
+    assert type(new_tracker()) is Tracker
+
+    monkeypatch.setenv("TRACKER_BACKEND", "redis")
+    monkeypatch.setenv("TRACKER_REDIS_URL", "redis://redis:6379/1")
+    urls = []
+
+    def from_url(url):
+        urls.append(url)
+        return fakeredis.FakeRedis(server=server)
+
+    monkeypatch.setattr(redis_tracker.redis.Redis, "from_url", from_url)
+    redis_tracker.get_settings.cache_clear()
+
+    assert isinstance(new_tracker(), RedisTracker)
+    assert urls == ["redis://redis:6379/1"]
+
+
+def test_redis_url_is_required(server):
+    with pytest.raises(ConfigurationError, match="TRACKER_REDIS_URL"):
+        RedisTracker()
@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+from ltd_invoice.bookkepping import Bookkeper
+from ltd_invoice.session_pool import SessionPool
+from tests.fakes import FakeWebDriver
+
+
+@pytest.fixture
+def drivers():
+    return []
+
+
+@pytest.fixture
+def pool(environment, drivers):
+    def factory():
+        driver = FakeWebDriver()
+        drivers.append(driver)
+        return Bookkeper(driver=driver)
+
+    return SessionPool(size=2, factory=factory)
+
+
+def test_sessions_are_reused(pool, drivers):
+    with pool.session() as first:
+        first.open_invoice_page()
+    with pool.session() as second:
+        second.open_invoice_page()
+
+    assert first is second
+    assert len(drivers) == 1
+    # logged in once, then straight to the invoice page
+    assert drivers[0].clicks == ["kt_login_singin_form_submit_button"]
+
+
+def test_expired_login_logs_in_again(pool, drivers):
+    with pool.session() as bookkeper:
+        bookkeper.open_invoice_page()
+    drivers[0].logged_in = False
+
+    with pool.session() as bookkeper:
+        bookkeper.open_invoice_page()
+
+    assert drivers[0].clicks == ["kt_login_singin_form_submit_button"] * 2
+    assert drivers[0].pages[-1].endswith("/salesinvoice/show")
+
+
+def test_dead_sessions_are_replaced(pool, drivers):
+    with pool.session():
+        pass
+    drivers[0].alive = False
+
+    with pool.session() as bookkeper:
+        assert bookkeper.driver is drivers[1]
+    assert drivers[0].quit_calls == 1
+
+
+def test_pool_size_is_bounded(pool, drivers):
+    with pool.session(), pool.session():
+        acquired = threading.Event()
+
+        def third_session():
+            with pool.session():
+                acquired.set()
+
+        thread = threading.Thread(target=third_session)
+        thread.start()
+        assert not acquired.wait(timeout=0.1)
+
+    thread.join(timeout=1)
+    assert acquired.is_set()
+    assert len(drivers) == 2
+
+
+def test_close(pool, drivers):
+    with pool.session(), pool.session():
+        pass
+    pool.close()
+
+    assert [driver.quit_calls for driver in drivers] == [1, 1]
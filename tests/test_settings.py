@@ -0,0 +1,128 @@
+import pytest
+
+from ltd_invoice.settings import ConfigurationError, Settings, get_settings
+
+
+def test_settings_from_environment(environment):
+    settings = get_settings()
+
+    assert settings.gmail_user_id == "me"
+    assert settings.email_date_format == environment["EMAIL_DATE_FORMAT"]
+    assert settings.bookkepping_backend == "selenium"
+    assert settings.processed_emails_store == "log"
+    assert "secret" not in repr(settings)
+
+
+def test_settings_are_loaded_once(environment, monkeypatch):
+    settings = get_settings()
+    monkeypatch.setenv("GMAIL_USER_ID", "someone-else")
+
+    assert get_settings() is settings
+    assert get_settings().gmail_user_id == "me"
+
+
+def test_every_missing_key_is_reported(environment):
+    environ = {
+        key: value
+        for key, value in environment.items()
+        if key not in ("GMAIL_USER_ID", "EMAIL_DATE_FORMAT")
+    }
+
+    with pytest.raises(ConfigurationError) as e:
+        Settings.from_env(environ)
+
+    assert e.value.errors == [
+        "EMAIL_DATE_FORMAT is not set",
+        "GMAIL_USER_ID is not set",
+    ]
+
+
+@pytest.mark.parametrize(
+    "environ,error",
+    [
+        ({"BOOKKEPPING_BACKEND": "ftp"}, "Invalid BOOKKEPPING_BACKEND: ftp"),
+        (
+            {"PROCESSED_EMAILS_STORE": "csv"},
+            "Invalid PROCESSED_EMAILS_STORE: csv",
+        ),
+        (
+            {"SELENIUM_WEBDRIVER": "chrome"},
+            "Invalid SELENIUM_WEBDRIVER: chrome",
+        ),
+        ({"SELENIUM_WEBDRIVER": "hub"}, "SELENIUM_HUB is not set"),
+        ({"TRACKER_BACKEND": "s3"}, "Invalid TRACKER_BACKEND: s3"),
+        ({"TRACKER_BACKEND": "redis"}, "TRACKER_REDIS_URL is not set"),
+        (
+            {"BOOKKEPPING_WORKERS": "four"},
+            "Invalid BOOKKEPPING_WORKERS: four, must be a number",
+        ),
+        (
+            {"BOOKKEPPING_WORKERS": "0"},
+            "Invalid BOOKKEPPING_WORKERS: 0, must be at least 1",
+        ),
+        (
+            {"BOOKKEPPING_WORKERS": "3", "SELENIUM_POOL_SIZE": "2"},
+            "Invalid BOOKKEPPING_WORKERS: 3, must be at most "
+            "SELENIUM_POOL_SIZE (2)",
+        ),
+        (
+            {
+                "BOOKKEPPING_WORKERS": "3",
+                "SELENIUM_POOL_SIZE": "4",
+                "SELENIUM_NODE_MAX_SESSION": "2",
+            },
+            "Invalid BOOKKEPPING_WORKERS: 3, must be at most "
+            "SELENIUM_NODE_MAX_SESSION (2)",
+        ),
+        (
+            {"GMAIL_BATCH_SIZE": "101"},
+            "Invalid GMAIL_BATCH_SIZE: 101, must be between 1 and 100",
+        ),
+        (
+            {"PDF_FAST_EXTRACTION": "maybe"},
+            "Invalid PDF_FAST_EXTRACTION: maybe, must be true or false",
+        ),
+    ],
+)
+def test_invalid_settings(environment, environ, error):
+    with pytest.raises(ConfigurationError) as e:
+        Settings.from_env({**environment, **environ})
+
+    assert e.value.errors == [error]
+
+
+def test_http_backend_without_browser(environment):
+    environ = {
+        key: value
+        for key, value in environment.items()
+        if key != "SELENIUM_WEBDRIVER"
+    }
+
+    with pytest.raises(ConfigurationError):
+        Settings.from_env(environ)
+    settings = Settings.from_env({**environ, "BOOKKEPPING_BACKEND": "http"})
+    assert settings.selenium_webdriver is None
+
+
+def test_tuning_knobs(environment):
+    settings = Settings.from_env(
+        {
+            **environment,
+            "BOOKKEPPING_BULK": "Yes",
+            "BOOKKEPPING_WORKERS": "4",
+            "SELENIUM_POOL_SIZE": "4",
+            "GMAIL_STREAM_ATTACHMENTS": "false",
+            "SELENIUM_WAIT_TIMEOUT": "2.5",
+            "SUBMISSIONS_DIR": "/var/lib/submissions",
+        }
+    )
+
+    assert settings.bookkepping_bulk is True
+    assert settings.bookkepping_workers == 4
+    assert settings.gmail_stream_attachments is False
+    assert settings.selenium_wait_timeout == 2.5
+    assert settings.submissions_dir == "/var/lib/submissions"
+    # the knobs not set keep their default
+    assert settings.pdf_parse_workers == 0
+    assert settings.selenium_node_max_session is None
+    assert settings.dead_letters_file == ".dead_letters.log"
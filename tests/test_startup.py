@@ -0,0 +1,101 @@
+import os
+import subprocess
+import sys
+from functools import lru_cache
+
+import pytest
+
+# loaded by the stage using them, never by importing the entry points
+HEAVY_MODULES = (
+    "aiohttp",
+    "celery",
+    "google_auth_oauthlib",
+    "googleapiclient",
+    "pdfminer",
+    "redis",
+    "requests",
+    "selenium.webdriver",
+)
+
+
+def python(*args):
+    # without the broker, importing ltd_invoice.celeryapp fails
+    environ = {
+        key: value
+        for key, value in os.environ.items()
+        if not key.startswith("CELERY_")
+    }
+    return subprocess.run(
+        [sys.executable, *args],
+        capture_output=True,
+        text=True,
+        env=environ,
+        check=True,
+    )
+
+
+def imported_modules(module):
+    """Modules imported by module, with their cumulative import time"""
+    lines = python("-X", "importtime", "-c", f"import {module}").stderr
+    modules = {}
+    for line in lines.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def heavy_modules(modules):
+    return sorted(
+        name
+        for name in modules
+        for heavy in HEAVY_MODULES
+        if name == heavy or name.startswith(f"{heavy}.")
+    )
+
+
+@pytest.mark.parametrize(
+    "module", ["ltd_invoice.__main__", "ltd_invoice.pipeline"]
+)
+def test_entry_points_import_no_heavy_dependency(module):
+    modules = imported_modules(module)
+
+    assert heavy_modules(modules) == [], sorted(
+        modules.items(), key=lambda item: item[1]
+    )[-10:]
+
+
+def test_run_does_not_initialise_celery():
+    script = (
+        "import sys\n"
+        "from ltd_invoice import __main__, pipeline\n"
+        "pipeline.process_emails = lambda: print('processed')\n"
+        "__main__.main(['run'])\n"
+        "print('celery' in sys.modules)\n"
+    )
+
+    assert python("-c", script).stdout.split() == ["processed", "False"]
+
+
+def test_run_closes_the_sessions(monkeypatch):
+    from ltd_invoice import __main__, pipeline, session_pool
+
+    closed = []
+
+    class Pool:
+        def close(self):
+            closed.append(self)
+
+    def process_emails():
+        session_pool.get_session_pool()
+        raise RuntimeError("Run failed")
+
+    monkeypatch.setattr(pipeline, "process_emails", process_emails)
+    monkeypatch.setattr(
+        session_pool, "get_session_pool", lru_cache(maxsize=1)(Pool)
+    )
+
+    with pytest.raises(RuntimeError):
+        __main__.main(["run"])
+    assert len(closed) == 1
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from ltd_invoice.submissions import (
+    DeadLetters,
+    SubmissionClaims,
+    SubmissionInProgress,
+    SubmissionStateUnknown,
+)
+
+
+@pytest.fixture
+def claims(tmp_path):
+    return SubmissionClaims(str(tmp_path / "submissions"), timeout=60)
+
+
+def test_claim_is_taken_once(claims):
+    key = claims.key("msg-1", "SB-000001")
+
+    assert claims.claim(key)
+    with pytest.raises(SubmissionInProgress):
+        claims.claim(key)
+
+    claims.complete(key)
+    assert not claims.claim(key)
+
+
+def test_released_claim_can_be_taken_again(claims):
+    key = claims.key("msg-1", "SB-000001")
+    claims.claim(key)
+
+    claims.release(key)
+
+    assert claims.claim(key)
+
+
+def test_stale_claim_state_is_unknown(claims):
+    key = claims.key("msg-1", "SB-000001")
+    claims.claim(key)
+    an_hour_ago = os.stat(claims.path(key)).st_mtime - 60 * 60
+    os.utime(claims.path(key), (an_hour_ago, an_hour_ago))
+
+    with pytest.raises(SubmissionStateUnknown):
+        claims.claim(key)
+
+
+def test_dead_letters(tmp_path):
+    dead_letters = DeadLetters(str(tmp_path / ".dead_letters.log"))
+    assert dead_letters.message_ids() == set()
+
+    dead_letters.add("msg-1", "parse", ValueError("boom"), retries=0)
+    dead_letters.add("msg-2", "submit", RuntimeError(), retries=5)
+
+    assert dead_letters.message_ids() == {"msg-1", "msg-2"}
@@ -0,0 +1,284 @@
+import json
+from datetime import date
+
+import pytest
+from prometheus_client import REGISTRY
+
+from ltd_invoice import tasks
+from ltd_invoice.celeryapp import app
+from ltd_invoice.gmail import GmailService
+from ltd_invoice.session_pool import SessionPool
+from ltd_invoice.submissions import (
+    SubmissionInProgress,
+    SubmissionStateUnknown,
+)
+from ltd_invoice.tracker import Tracker
+from tests.fakes import FakeGmailResource, make_invoice_pdf, make_raw_message
+
+
+class FakeBookkeper:
+    def __init__(self, registered, failing, unconfirmed):
+        self.registered = registered
+        # invoice number -> times registering it fails
+        self.failing = failing
+        # invoice number -> times it fails once posted
+        self.unconfirmed = unconfirmed
+
+    def is_alive(self):
+        return True
+
+    def close(self):
+        pass
+
+    def register_invoice(self, invoice):
+        if self.failing.get(invoice.invoice_number, 0) > 0:
+            self.failing[invoice.invoice_number] -= 1
+            raise RuntimeError(f"Could not register {invoice}")
+        self.registered.append(invoice.invoice_number)
+        if self.unconfirmed.get(invoice.invoice_number, 0) > 0:
+            self.unconfirmed[invoice.invoice_number] -= 1
+            raise SubmissionStateUnknown(f"No answer for {invoice}")
+
+
+@pytest.fixture
+def workdir(environment, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("INVOICE_DIR", str(tmp_path))
+    monkeypatch.setattr(app.conf, "task_always_eager", True)
+    monkeypatch.setattr(tasks.PipelineStage, "retry_backoff", 0)
+    tasks.get_tracker.cache_clear()
+    yield tmp_path
+    tasks.get_tracker.cache_clear()
+
+
+@pytest.fixture
+def gmail(monkeypatch):
+    raw_messages = [
+        make_raw_message(
+            f"msg-{day}",
+            date=f"Tue, {day} Mar 2022 11:53:45 +0000 (GMT)",
+            history_id=str(1000 + day),
+        )
+        for day in (8, 1, 15)
+    ]
+    resource = FakeGmailResource(
+        raw_messages,
+        attachments={
+            f"attachment-msg-{day}": make_invoice_pdf(
+                invoice_number=f"SB-{day:06}"
+            )
+            for day in (8, 1, 15)
+        },
+    )
+    monkeypatch.setattr(
+        tasks, "get_gmail_service", lambda: GmailService(service=resource)
+    )
+    return resource
+
+
+def use_bookkeeper(monkeypatch, failing=None, unconfirmed=None):
+    registered = []
+    pool = SessionPool(
+        size=1,
+        factory=lambda: FakeBookkeper(
+            registered, failing or {}, unconfirmed or {}
+        ),
+    )
+    monkeypatch.setattr(tasks, "get_session_pool", lambda: pool)
+    return registered
+
+
+def test_process_invoices_runs_a_chain_per_email(workdir, gmail, monkeypatch):
+    registered = use_bookkeeper(monkeypatch)
+
+    tasks.process_invoices()
+
+    assert sorted(registered) == ["SB-000001", "SB-000008", "SB-000015"]
+    for number in registered:
+        assert (workdir / f"invoice-{number}.pdf").exists()
+    tracker = Tracker()
+    assert set(tracker.processed_emails) == {"msg-1", "msg-8", "msg-15"}
+    assert tracker.last_email_processed_date.date() == date(2022, 3, 15)
+    assert tracker.last_history_id == "1015"
+
+
+def test_transient_failures_are_retried(workdir, gmail, monkeypatch):
+    registered = use_bookkeeper(monkeypatch, failing={"SB-000008": 2})
+
+    tasks.process_invoices()
+
+    assert sorted(registered) == ["SB-000001", "SB-000008", "SB-000015"]
+    assert Tracker().last_history_id == "1015"
+    assert not (workdir / ".dead_letters.log").exists()
+
+
+def test_failing_email_goes_to_dead_letters(workdir, gmail, monkeypatch):
+    monkeypatch.setattr(tasks.PipelineStage, "max_retries", 2)
+    registered = use_bookkeeper(monkeypatch, failing={"SB-000008": 10})
+
+    tasks.process_invoices()
+
+    assert sorted(registered) == ["SB-000001", "SB-000015"]
+    tracker = Tracker()
+    assert set(tracker.processed_emails) == {"msg-1", "msg-15"}
+    # the watermark moves on, the dead letter is skipped from now on
+    assert tracker.last_history_id == "1015"
+    (dead_letter,) = [
+        json.loads(line) for line in open(workdir / ".dead_letters.log")
+    ]
+    assert dead_letter["message_id"] == "msg-8"
+    assert dead_letter["invoice_number"] == "SB-000008"
+    assert dead_letter["stage"] == "ltd_invoice.tasks.submit_invoice"
+    assert dead_letter["retries"] == 2
+
+
+def test_parse_errors_are_not_retried(workdir, gmail, monkeypatch):
+    gmail.attachments_by_id["attachment-msg-8"] = make_invoice_pdf(
+        invoice_number="missing"
+    )
+    registered = use_bookkeeper(monkeypatch)
+
+    tasks.process_invoices()
+
+    assert sorted(registered) == ["SB-000001", "SB-000015"]
+    assert tasks.get_dead_letters().message_ids() == {"msg-8"}
+
+
+def test_invoice_failing_once_posted_is_not_posted_again(
+    workdir, gmail, monkeypatch
+):
+    registered = use_bookkeeper(monkeypatch, unconfirmed={"SB-000008": 1})
+
+    tasks.process_invoices()
+    tasks.process_invoices()
+
+    assert sorted(registered) == ["SB-000001", "SB-000008", "SB-000015"]
+    (dead_letter,) = [
+        json.loads(line) for line in open(workdir / ".dead_letters.log")
+    ]
+    assert dead_letter["message_id"] == "msg-8"
+    assert dead_letter["retries"] == 0
+    # pending until someone checks whether the invoice was saved
+    claims = tasks.get_submission_claims()
+    with pytest.raises(SubmissionInProgress):
+        claims.claim(claims.key("msg-8", "SB-000008"))
+
+
+def test_submitted_invoice_is_not_registered_again(
+    workdir, gmail, monkeypatch
+):
+    claims = tasks.get_submission_claims()
+    key = claims.key("msg-8", "SB-000008")
+    claims.claim(key)
+    claims.complete(key)
+    registered = use_bookkeeper(monkeypatch)
+
+    tasks.process_invoices()
+
+    assert sorted(registered) == ["SB-000001", "SB-000015"]
+    assert "msg-8" in Tracker().processed_emails
+
+
+def test_history_id_is_taken_before_listing(workdir, gmail, monkeypatch):
+    # emails changed since they were added have newer history ids
+    gmail.messages_by_id["msg-8"]["historyId"] = "1500"
+    gmail.history_id = "1020"
+    use_bookkeeper(monkeypatch)
+
+    tasks.process_invoices()
+
+    assert Tracker().last_history_id == "1020"
+
+
+def test_history_id_moves_without_new_emails(workdir, gmail, monkeypatch):
+    registered = use_bookkeeper(monkeypatch)
+    tasks.process_invoices()
+    gmail.history_id = "1100"
+
+    tasks.process_invoices()
+
+    assert len(registered) == 3
+    assert Tracker().last_history_id == "1100"
+    assert Tracker().last_email_processed_date.date() == date(2022, 3, 15)
+
+
+def test_watermark_waits_for_emails_claimed_elsewhere(
+    workdir, gmail, monkeypatch
+):
+    def claim(tracker, email_id):
+        if email_id == "msg-8":
+            tracker.claimed_elsewhere.add(email_id)
+            return False
+        return True
+
+    monkeypatch.setattr(Tracker, "claim", claim)
+    registered = use_bookkeeper(monkeypatch)
+
+    tasks.process_invoices()
+
+    assert sorted(registered) == ["SB-000001", "SB-000015"]
+    tracker = Tracker()
+    assert set(tracker.processed_emails) == {"msg-1", "msg-15"}
+    assert tracker.last_email_processed_date is None
+
+
+def test_retries_follow_the_settings(environment, monkeypatch):
+    for name in ("max_retries", "retry_backoff", "retry_backoff_max"):
+        monkeypatch.setattr(
+            tasks.PipelineStage, name, getattr(tasks.PipelineStage, name)
+        )
+    monkeypatch.setenv("TASK_MAX_RETRIES", "2")
+    monkeypatch.setenv("TASK_RETRY_BACKOFF", "5")
+
+    tasks.check_settings()
+
+    assert tasks.parse_invoice.max_retries == 2
+    assert tasks.parse_invoice.retry_backoff == 5
+    assert tasks.parse_invoice.retry_backoff_max == 60 * 60
+
+
+def test_stages_are_measured(workdir, gmail, monkeypatch):
+    monkeypatch.setattr(tasks.PipelineStage, "max_retries", 1)
+    use_bookkeeper(monkeypatch, failing={"SB-000008": 10})
+    monkeypatch.setenv("METRICS_TEXTFILE", str(workdir / "metrics.prom"))
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    stages = ["attachment_download", "pdf_parse", "submission"]
+    before = {
+        stage: sample("ltd_invoice_stage_seconds_count", stage=stage)
+        for stage in stages
+    }
+    outcomes = ["processed", "dead_letter"]
+    invoices_before = {
+        outcome: sample("ltd_invoice_invoices_total", outcome=outcome)
+        for outcome in outcomes
+    }
+    retries_before = sample(
+        "ltd_invoice_task_retries_total", task=tasks.submit_invoice.name
+    )
+
+    tasks.process_invoices()
+
+    # the failing submission is tried twice
+    assert {
+        stage: sample("ltd_invoice_stage_seconds_count", stage=stage)
+        - before[stage]
+        for stage in stages
+    } == {"attachment_download": 3, "pdf_parse": 3, "submission": 4}
+    assert {
+        outcome: sample("ltd_invoice_invoices_total", outcome=outcome)
+        - invoices_before[outcome]
+        for outcome in outcomes
+    } == {"processed": 2, "dead_letter": 1}
+    assert (
+        sample(
+            "ltd_invoice_task_retries_total", task=tasks.submit_invoice.name
+        )
+        == retries_before + 1
+    )
+    assert (
+        "ltd_invoice_run_seconds_count"
+        in (workdir / "metrics.prom").read_text()
+    )
@@ -0,0 +1,104 @@
+import json
+from datetime import datetime
+
+import pytest
+
+from ltd_invoice.gmail import EmailMessage
+from ltd_invoice.processed_store import (
+    PROCESSED_EMAIL_STORES,
+    ProcessedEmailStore,
+)
+from ltd_invoice.tracker import Tracker
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / Tracker.PROCESSED_EMAILS_FILE).write_text("[]")
+    return tmp_path
+
+
+def email_message(message_id, history_id=None):
+    return EmailMessage(
+        id=message_id,
+        thread_id=message_id,
+        subject="Invoice",
+        body="",
+        attachment=b"",
+        sender="invoices@agency.com",
+        receiver="myself@gmail.com",
+        date="Tue, 8 Mar 2022 11:53:45 +0000 (GMT)",
+        history_id=history_id,
+    )
+
+
+def test_history_id_is_persisted(environment, workdir):
+    tracker = Tracker()
+    assert tracker.last_history_id is None
+
+    tracker.update(email_message("a", history_id="1005"))
+    tracker.update(email_message("b", history_id="1003"))
+    tracker.update(email_message("c"))
+
+    tracker = Tracker()
+    assert tracker.last_history_id == "1005"
+    assert tracker.last_email_processed_date == datetime(2022, 3, 8)
+
+
+@pytest.fixture(params=list(PROCESSED_EMAIL_STORES))
+def store_backend(request, monkeypatch):
+    monkeypatch.setenv("PROCESSED_EMAILS_STORE", request.param)
+    return request.param
+
+
+def test_processed_emails_are_persisted(environment, workdir, store_backend):
+    tracker = Tracker()
+    tracker.update(email_message("a"))
+    tracker.update(email_message("b"))
+    tracker.update(email_message("a"))
+
+    processed_emails = Tracker().processed_emails
+    assert "a" in processed_emails
+    assert "b" in processed_emails
+    assert "c" not in processed_emails
+    assert len(processed_emails) == 2
+
+
+def test_legacy_processed_emails_are_migrated(
+    environment, workdir, store_backend
+):
+    (workdir / Tracker.PROCESSED_EMAILS_FILE).write_text(
+        json.dumps(["a", "b", "a"])
+    )
+    tracker = Tracker()
+    assert set(tracker.processed_emails) == {"a", "b"}
+
+    tracker.update(email_message("c"))
+    # the legacy file is only read on first start
+    (workdir / Tracker.PROCESSED_EMAILS_FILE).write_text(json.dumps(["d"]))
+
+    assert set(Tracker().processed_emails) == {"a", "b", "c"}
+
+
+def test_legacy_file_is_migrated_once(environment, workdir, store_backend):
+    # nothing to migrate, the store is still created empty
+    assert len(Tracker().processed_emails) == 0
+    (workdir / Tracker.PROCESSED_EMAILS_FILE).write_text(json.dumps(["d"]))
+
+    assert len(Tracker().processed_emails) == 0
+
+
+def test_missing_legacy_file(environment, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert len(Tracker().processed_emails) == 0
+
+
+def test_invalid_store_backend(environment, workdir, monkeypatch):
+    monkeypatch.setenv("PROCESSED_EMAILS_STORE", "csv")
+    with pytest.raises(ValueError):
+        Tracker()
+
+
+def test_store_backends_implement_the_store():
+    with pytest.raises(TypeError):
+        ProcessedEmailStore(".processed_emails.log")